@@ -0,0 +1,21 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Benchmarks of magneticod.
+
+Run them from the root of the repository, e.g. `python -m benchmarks.dht_load --help`. Every benchmark prints a
+summary and, with `--json PATH`, appends its parameters and results (along with the git commit) as a JSON line to PATH
+so that the runs can be compared across commits.
+"""
@@ -0,0 +1,90 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import typing
+
+
+def add_common_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--json", metavar="PATH", default=None,
+        help="append the parameters and the results as a JSON line to PATH"
+    )
+    parser.add_argument(
+        "-d", "--debug",
+        action="store_const", dest="loglevel", const=logging.DEBUG, default=logging.WARNING,
+        help="print debugging information of magneticod too"
+    )
+
+
+def mix_type(kinds: typing.Sequence[str]) -> typing.Callable[[str], typing.Dict[str, float]]:
+    """ Returns an argparse type parsing KIND=WEIGHT[,KIND=WEIGHT...] into a dict, for the given kinds. """
+    def parse_mix(value: str) -> typing.Dict[str, float]:
+        try:
+            mix = {kind: float(weight) for kind, weight in (item.split("=") for item in value.split(","))}
+        except ValueError:
+            raise argparse.ArgumentTypeError("expected KIND=WEIGHT[,KIND=WEIGHT...]")
+        if not set(mix) <= set(kinds) or sum(mix.values()) <= 0:
+            raise argparse.ArgumentTypeError("kinds must be among %s, with a positive total weight" % (tuple(kinds),))
+        return mix
+
+    return parse_mix
+
+
+def git_commit() -> typing.Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(values: typing.Sequence[float], p: float) -> float:
+    """ Nearest-rank percentile of `values` (which need not be sorted); 0 if it is empty. """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+
+def report(name: str, arguments: argparse.Namespace, results: typing.Dict[str, typing.Any]) -> None:
+    """ Prints the results, and appends them to `arguments.json` if given. """
+    print("%s @ %s" % (name, git_commit() or "unknown commit"))
+    for key, value in results.items():
+        if isinstance(value, float):
+            print("  %-32s %14.3f" % (key, value))
+        else:
+            print("  %-32s %14s" % (key, value))
+
+    if arguments.json:
+        parameters = {k: v for k, v in vars(arguments).items() if k not in ("json", "loglevel")}
+        with open(arguments.json, "a") as file:
+            file.write(json.dumps({
+                "benchmark": name,
+                "commit": git_commit(),
+                "date": datetime.datetime.now().isoformat(),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "parameters": parameters,
+                "results": results,
+            }, sort_keys=True) + "\n")
@@ -0,0 +1,137 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Decoding (and filtering) of the compact node info of find_node responses.
+
+    python -m benchmarks.decode_nodes --sizes 8,64,1024
+
+For every buffer size (in nodes; responses have 8), reports the ns per node of:
+
+    strings   the previous decoder, to (node ID, (dotted IP, port)) with inet_ntoa
+    struct    SybilNode's decoder, to (node ID, IP as integer, port) with struct.iter_unpack
+    numpy     the same with a NumPy structured array (only if NumPy is installed)
+
+and of decoding followed by the filters applied to every response (port 0, excluded networks, recently seen nodes),
+with the addresses as strings (`strings+filter`, the previous way) and as integers (`struct+filter`).
+"""
+import argparse
+import collections
+import random
+import socket
+import sys
+import timeit
+import typing
+
+from magneticod import constants
+from magneticod import dedup
+from magneticod import dht
+from magneticod import iprange
+
+from . import common
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def decode_strings(infos: bytes) -> typing.List[typing.Tuple[bytes, typing.Tuple[str, int]]]:
+    inet_ntoa = socket.inet_ntoa
+    int_from_bytes = int.from_bytes
+    return [
+        (infos[i:i+20], (inet_ntoa(infos[i+20:i+24]), int_from_bytes(infos[i+24:i+26], "big")))
+        for i in range(0, len(infos), 26)
+    ]
+
+
+decode_struct = dht.SybilNode._SybilNode__decode_nodes  # type: ignore
+
+if numpy:
+    # "V20" rather than "S20", as NumPy strips the trailing NUL bytes of the latter.
+    _NODE_DTYPE = numpy.dtype([("id", "V20"), ("ip", ">u4"), ("port", ">u2")])
+
+    def decode_numpy(infos: bytes) -> typing.List[typing.Tuple[bytes, int, int]]:
+        return numpy.frombuffer(infos, dtype=_NODE_DTYPE).tolist()
+
+
+def make_buffer(rng: random.Random, n_nodes: int) -> bytes:
+    """ Nodes with random IDs and public addresses, with a few ports 0, private and repeated addresses in between. """
+    data = bytearray()
+    for i in range(n_nodes):
+        if i % 16 == 1:
+            ip = b"\x0a" + bytes(rng.getrandbits(8) for _ in range(3))  # 10.0.0.0/8
+        elif i % 16 == 2 and i > 16:
+            ip = data[(i - 16) * 26 + 20:(i - 16) * 26 + 24]  # seen already
+        else:
+            ip = bytes([rng.randint(1, 9)]) + bytes(rng.getrandbits(8) for _ in range(3))
+        port = 0 if i % 16 == 3 else rng.randint(1024, 65535)
+        data += rng.getrandbits(160).to_bytes(20, "big") + ip + port.to_bytes(2, "big")
+    return bytes(data)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="8,64,1024", type=lambda value: [int(x) for x in value.split(",")],
+                        help="buffer sizes, in nodes")
+    parser.add_argument("--nodes", default=1000000, type=int, help="nodes to decode per measurement")
+    parser.add_argument("--repeat", default=5, type=int, help="take the best of that many measurements")
+    parser.add_argument("--seed", type=int, default=1910)
+    common.add_common_arguments(parser)
+    arguments = parser.parse_args()
+
+    rng = random.Random(arguments.seed)
+    excluded = iprange.IPv4RangeSet.parse(constants.EXCLUDE)
+
+    for size in arguments.sizes:
+        infos = make_buffer(rng, size)
+        assert [(n[0], (socket.inet_ntoa(n[1].to_bytes(4, "big")), n[2])) for n in decode_struct(infos)] \
+            == decode_strings(infos)
+
+        def filter_strings() -> None:
+            recent = set()  # type: typing.Set[int]
+            inet_aton = socket.inet_aton
+            int_from_bytes = int.from_bytes
+            nodes = [n for n in decode_strings(infos) if n[1][1] != 0 and not excluded.contains_str(n[1][0])]
+            for n in nodes:
+                ip = int_from_bytes(inet_aton(n[1][0]), "big")
+                if ip not in recent:
+                    recent.add(ip)
+
+        def filter_struct() -> None:
+            add_recent_node = dedup.TTLSet(900).add
+            nodes = [n for n in decode_struct(infos) if n[2] != 0 and n[1] not in excluded]
+            [n for n in nodes if add_recent_node(n[1])]
+
+        candidates = [
+            ("strings", lambda: decode_strings(infos)),
+            ("struct", lambda: decode_struct(infos)),
+            ("numpy", (lambda: decode_numpy(infos)) if numpy else None),
+            ("strings+filter", filter_strings),
+            ("struct+filter", filter_struct),
+        ]
+
+        number = max(1, arguments.nodes // size)
+        results = collections.OrderedDict([("nodes_per_buffer", size)])  # type: typing.Dict[str, typing.Any]
+        for name, function in candidates:
+            if function is None:
+                continue
+            best = min(timeit.repeat(function, number=number, repeat=arguments.repeat))
+            results["%s_ns_per_node" % (name,)] = best / (number * size) * 1e9
+        common.report("decode_nodes", arguments, results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
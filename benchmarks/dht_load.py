@@ -0,0 +1,237 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Load generator for the UDP side: starts a SybilNode on localhost (in a process of its own) and drives it with a
+synthetic swarm of fake DHT nodes sending a configurable mix of find_node responses, get_peers queries and
+announce_peer queries at a target rate.
+
+    python -m benchmarks.dht_load --rate 20000 --duration 10 --mix find_node=6,get_peers=3,announce_peer=1
+
+Reports the sustained packets/s handled by the node, the latency of its replies, the drop rate and its CPU time per
+packet. The fake nodes advertised in find_node responses all point back to the swarm, so nothing leaves localhost.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import sys
+import time
+import typing
+
+from magneticod import dht
+
+from . import common
+
+KINDS = ("find_node", "get_peers", "announce_peer")
+
+
+def _run_node(conn, arguments: argparse.Namespace) -> None:
+    logging.basicConfig(level=arguments.loglevel, format="%(asctime)s  %(levelname)-8s  %(message)s")
+    event_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(event_loop)
+
+    seen = set()  # type: typing.Set[bytes]
+
+    def is_infohash_new(info_hash, skip_check=False):
+        if skip_check:
+            return
+        if info_hash in seen:
+            return False
+        seen.add(info_hash)
+        return True
+
+    node = dht.SybilNode(
+        is_infohash_new, 1024 * 1024, arguments.max_neighbours, None, 1, arguments.peers_per_hash,
+        bootstrapping_nodes=()  # The swarm is the whole DHT: stay off the public bootstrapping nodes.
+    )
+    event_loop.run_until_complete(node.launch(("127.0.0.1", 0)))
+    conn.send(node._transport.get_extra_info("sockname")[1])
+
+    # Every packet the node did not drop was handled, whatever its kind.
+    def handled() -> int:
+        return sum(child.value for child in dht.PACKETS_RECEIVED.children())
+
+    def dropped() -> int:
+        return sum(child.value for child in dht.PACKETS_DROPPED.children())
+
+    state = {}
+
+    def on_command() -> None:
+        command = conn.recv()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        if command == "start":
+            state["cpu"] = usage.ru_utime + usage.ru_stime
+            state["handled"] = handled()
+            state["dropped"] = dropped()
+        elif command == "stop":
+            conn.send({
+                "cpu": usage.ru_utime + usage.ru_stime - state["cpu"],
+                "handled": handled() - state["handled"],
+                "dropped": dropped() - state["dropped"],
+            })
+            event_loop.stop()
+
+    event_loop.add_reader(conn.fileno(), on_command)
+    event_loop.run_forever()
+    event_loop.run_until_complete(node.shutdown())
+
+
+class Swarm(asyncio.DatagramProtocol):
+    def __init__(self) -> None:
+        self.sent_on = {}  # type: typing.Dict[bytes, float]
+        self.latencies = []  # type: typing.List[float]
+        self.replies = 0
+        self.find_node_queries = 0
+        self.transport = None  # type: typing.Optional[asyncio.DatagramTransport]
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:  # type: ignore
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        if b"9:find_node" in data:
+            self.find_node_queries += 1
+            return
+        # All our transaction IDs are 4 bytes long.
+        i = data.rfind(b"1:t4:")
+        if i == -1:
+            return
+        sent_on = self.sent_on.pop(data[i + 5:i + 9], None)
+        if sent_on is not None:
+            self.replies += 1
+            self.latencies.append(time.perf_counter() - sent_on)
+
+
+async def drive(arguments: argparse.Namespace, node_port: int) -> typing.Dict[str, typing.Any]:
+    event_loop = asyncio.get_event_loop()
+    rng = random.Random(arguments.seed)
+    swarms = []  # type: typing.List[Swarm]
+    for _ in range(arguments.sources):
+        _, swarm = await event_loop.create_datagram_endpoint(Swarm, local_addr=("127.0.0.1", 0))
+        swarm.transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        swarms.append(swarm)
+    swarm_ports = [swarm.transport.get_extra_info("sockname")[1] for swarm in swarms]
+
+    kinds = list(arguments.mix)
+    weights = [arguments.mix[kind] for kind in kinds]
+    # Precompute the sequence of kinds (and the payloads that need not be unique) so that the swarm spends its time
+    # sending, not generating.
+    schedule = rng.choices(kinds, weights, k=4096)
+    info_hashes = [rng.getrandbits(160).to_bytes(20, "big") for _ in range(arguments.info_hashes)]
+    nodes_payloads = [
+        b"".join(
+            rng.getrandbits(160).to_bytes(20, "big") + socket.inet_aton("127.0.0.1") +
+            rng.choice(swarm_ports).to_bytes(2, "big")
+            for _ in range(8)
+        )
+        for _ in range(256)
+    ]
+    node_id = rng.getrandbits(160).to_bytes(20, "big")
+
+    sent = {kind: 0 for kind in KINDS}
+    seq = 0
+    started_on = event_loop.time()
+    while True:
+        elapsed = event_loop.time() - started_on
+        if elapsed >= arguments.duration:
+            break
+        due = int(arguments.rate * elapsed) - seq
+        for _ in range(due):
+            kind = schedule[seq % len(schedule)]
+            tid = seq.to_bytes(4, "big")
+            swarm = swarms[seq % len(swarms)]
+            if kind == "find_node":
+                data = b"d1:rd2:id20:%s5:nodes208:%se1:t4:%s1:y1:re" % (
+                    node_id, nodes_payloads[seq % len(nodes_payloads)], tid)
+            elif kind == "get_peers":
+                data = b"d1:ad2:id20:%s9:info_hash20:%se1:q9:get_peers1:t4:%s1:y1:qe" % (
+                    node_id, info_hashes[seq % len(info_hashes)], tid)
+                swarm.sent_on[tid] = time.perf_counter()
+            else:
+                data = b"d1:ad2:id20:%s9:info_hash20:%s4:porti%de5:token4:abcde1:q13:announce_peer1:t4:%s1:y1:qe" % (
+                    node_id, info_hashes[seq % len(info_hashes)], swarm_ports[0], tid)
+                swarm.sent_on[tid] = time.perf_counter()
+            swarm.transport.sendto(data, ("127.0.0.1", node_port))
+            sent[kind] += 1
+            seq += 1
+        await asyncio.sleep(0.001)
+    duration = event_loop.time() - started_on
+
+    # Grace period for the replies that are still in flight.
+    await asyncio.sleep(0.5)
+    for swarm in swarms:
+        swarm.transport.close()
+
+    expected = sent["get_peers"] + sent["announce_peer"]
+    replies = sum(swarm.replies for swarm in swarms)
+    latencies = [latency for swarm in swarms for latency in swarm.latencies]
+    return {
+        "duration_s": duration,
+        "sent": seq,
+        "sent_find_node": sent["find_node"],
+        "sent_get_peers": sent["get_peers"],
+        "sent_announce_peer": sent["announce_peer"],
+        "offered_pps": seq / duration,
+        "replies": replies,
+        "reply_drop_rate": 1 - replies / expected if expected else 0.0,
+        "latency_p50_ms": common.percentile(latencies, 50) * 1000,
+        "latency_p99_ms": common.percentile(latencies, 99) * 1000,
+        "latency_max_ms": max(latencies) * 1000 if latencies else 0.0,
+        "find_node_queries_received": sum(swarm.find_node_queries for swarm in swarms),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=int, default=10000, help="target packets/s sent to the node")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--mix", type=common.mix_type(KINDS), default="find_node=6,get_peers=3,announce_peer=1",
+                        help="relative weights of the message kinds")
+    parser.add_argument("--sources", type=int, default=16, help="number of UDP sockets the swarm sends from")
+    parser.add_argument("--info-hashes", type=int, default=100000, help="number of distinct info hashes in queries")
+    parser.add_argument("--max-neighbours", type=int, default=2000)
+    parser.add_argument("--peers-per-hash", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1910)
+    common.add_common_arguments(parser)
+    arguments = parser.parse_args()
+
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_run_node, args=(child_conn, arguments), daemon=True)
+    process.start()
+    node_port = parent_conn.recv()
+
+    event_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(event_loop)
+    parent_conn.send("start")
+    results = event_loop.run_until_complete(drive(arguments, node_port))
+    parent_conn.send("stop")
+    node = parent_conn.recv()
+    process.join(timeout=10)
+
+    results["node_handled"] = node["handled"]
+    results["node_dropped"] = node["dropped"]
+    results["node_handled_pps"] = node["handled"] / results["duration_s"]
+    results["lost_before_node"] = results["sent"] - node["handled"] - node["dropped"]
+    results["node_cpu_s"] = node["cpu"]
+    results["node_cpu_us_per_packet"] = node["cpu"] * 1e6 / node["handled"] if node["handled"] else 0.0
+    common.report("dht_load", arguments, results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+In-process fake BitTorrent peers serving metadata over the extension protocol (BEP 10) and ut_metadata (BEP 9).
+
+Every FakePeer listens on a port of its own with one of the behaviours below, and serves the metadata of all the
+torrents it has been given:
+
+    honest     serves the metadata as requested
+    slow       like honest, but waits `delay` seconds before sending every piece
+    lying      serves metadata that does not hash to the info hash
+    rejecting  rejects every request
+    oversized  advertises a metadata size far larger than anyone should accept
+"""
+import asyncio
+import hashlib
+import logging
+import random
+import typing
+
+from magneticod import bencode
+
+HONEST = "honest"
+SLOW = "slow"
+LYING = "lying"
+REJECTING = "rejecting"
+OVERSIZED = "oversized"
+BEHAVIOURS = (HONEST, SLOW, LYING, REJECTING, OVERSIZED)
+
+PIECE_SIZE = 2 ** 14
+OUR_UT_METADATA = 3  # the ut_metadata extension ID we advertise
+
+
+def make_metadata(rng: random.Random, size: int, n_files: int = 10) -> bytes:
+    """ Returns a bencoded info dictionary of (roughly) `size` bytes. """
+    info = {
+        b"name": b"magneticod-benchmark-%d" % (rng.getrandbits(32),),
+        b"piece length": 2 ** 18,
+        b"files": [{b"length": rng.randint(1, 2 ** 30), b"path": [b"dir", b"file-%d" % (i,)]} for i in range(n_files)],
+        b"pieces": b"",
+    }
+    overhead = len(bencode.dumps(info))
+    info[b"pieces"] = bytes(rng.getrandbits(8) for _ in range(max(20, (size - overhead) // 20 * 20)))
+    return bencode.dumps(info)
+
+
+class FakePeer:
+    def __init__(self, behaviour: str, torrents: typing.Dict[bytes, bytes], delay: float = 0.05) -> None:
+        assert behaviour in BEHAVIOURS
+        self.behaviour = behaviour
+        self.delay = delay
+        self.port = None  # type: typing.Optional[int]
+        self.__torrents = torrents  # info hash -> metadata
+        self.__server = None  # type: typing.Optional[asyncio.AbstractServer]
+        self.connections = 0
+        self.bytes_sent = 0
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self.__server = await asyncio.start_server(self.__handle, host, port)
+        self.port = self.__server.sockets[0].getsockname()[1]
+        return self.port
+
+    def close(self) -> None:
+        if self.__server:
+            self.__server.close()
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        try:
+            handshake = await reader.readexactly(68)
+            info_hash = handshake[28:48]
+            metadata = self.__torrents.get(info_hash)
+            if handshake[1:20] != b"BitTorrent protocol" or metadata is None:
+                return
+            if self.behaviour == LYING:
+                metadata = bytes(reversed(metadata))
+
+            # Reserved bit 20 (0x10 of the 6th byte) means we support the extension protocol.
+            writer.write(b"\x13BitTorrent protocol\x00\x00\x00\x00\x00\x10\x00\x00%s%s" % (info_hash, b"F" * 20))
+            metadata_size = len(metadata) if self.behaviour != OVERSIZED else 2 ** 31
+            self.__write_extended(writer, 0, bencode.dumps({
+                b"m": {b"ut_metadata": OUR_UT_METADATA},
+                b"metadata_size": metadata_size,
+            }))
+
+            their_ut_metadata = None
+            while True:
+                length = int.from_bytes(await reader.readexactly(4), "big")
+                message = await reader.readexactly(length)
+                if length < 2 or message[0] != 20:
+                    continue
+                if message[1] == 0:
+                    their_ut_metadata = bencode.loads(message[2:])[b"m"][b"ut_metadata"]
+                elif message[1] == OUR_UT_METADATA and their_ut_metadata is not None:
+                    request = bencode.loads(message[2:])
+                    piece = request[b"piece"]
+                    if self.behaviour == REJECTING:
+                        self.__write_extended(writer, their_ut_metadata, bencode.dumps({
+                            b"msg_type": 2, b"piece": piece
+                        }))
+                        continue
+                    if self.behaviour == SLOW:
+                        await asyncio.sleep(self.delay)
+                    self.__write_extended(writer, their_ut_metadata, bencode.dumps({
+                        b"msg_type": 1, b"piece": piece, b"total_size": len(metadata)
+                    }) + metadata[piece * PIECE_SIZE:(piece + 1) * PIECE_SIZE])
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            logging.exception("FakePeer (%s) error", self.behaviour)
+        finally:
+            writer.close()
+
+    def __write_extended(self, writer: asyncio.StreamWriter, extension_id: int, payload: bytes) -> None:
+        writer.write((2 + len(payload)).to_bytes(4, "big") + bytes((20, extension_id)) + payload)
+        self.bytes_sent += 6 + len(payload)
+
+
+def make_torrents(rng: random.Random, n: int, size: int) -> typing.Dict[bytes, bytes]:
+    torrents = {}
+    for _ in range(n):
+        metadata = make_metadata(rng, size)
+        torrents[hashlib.sha1(metadata).digest()] = metadata
+    return torrents
@@ -0,0 +1,129 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Metadata fetch throughput, through `bittorrent.fetch_metadata_from_peer`, against in-process fake peers.
+
+    python -m benchmarks.fetch_throughput --fetches 2000 --concurrency 200 --metadata-size 64K \
+        --mix honest=8,slow=1,lying=1,rejecting=1,oversized=1
+
+Reports fetches/s, the outcome per peer behaviour, the metadata bytes received per fetch and the peak (traced) memory.
+Bytes *copied* cannot be counted from Python, so `traced_peak_per_inflight_fetch / metadata_size` is reported as the
+copy amplification instead: the extra copies of the metadata alive at once for every fetch in flight.
+"""
+import argparse
+import asyncio
+import collections
+import random
+import resource
+import sys
+import time
+import tracemalloc
+import typing
+
+import humanfriendly
+
+from magneticod import bittorrent
+
+from . import common
+from . import fake_peer
+
+
+async def run(arguments: argparse.Namespace) -> typing.Dict[str, typing.Any]:
+    rng = random.Random(arguments.seed)
+    torrents = fake_peer.make_torrents(rng, arguments.torrents, arguments.metadata_size)
+    info_hashes = list(torrents)
+    peers = {}
+    for behaviour in arguments.mix:
+        peers[behaviour] = fake_peer.FakePeer(behaviour, torrents, delay=arguments.slow_delay)
+        await peers[behaviour].start()
+
+    behaviours = list(arguments.mix)
+    plan = list(zip(
+        rng.choices(behaviours, [arguments.mix[b] for b in behaviours], k=arguments.fetches),
+        (rng.choice(info_hashes) for _ in range(arguments.fetches))
+    ))
+    outcomes = collections.Counter()  # type: typing.Counter[typing.Tuple[str, bool]]
+    semaphore = asyncio.Semaphore(arguments.concurrency)
+
+    async def fetch(behaviour: str, info_hash: bytes) -> None:
+        async with semaphore:
+            metadata = await bittorrent.fetch_metadata_from_peer(
+                info_hash, ("127.0.0.1", peers[behaviour].port), arguments.max_metadata_size,
+                timeout=arguments.timeout
+            )
+            outcomes[behaviour, metadata is not None] += 1
+
+    if arguments.tracemalloc:
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+    started_on = time.perf_counter()
+    await asyncio.gather(*(fetch(behaviour, info_hash) for behaviour, info_hash in plan))
+    duration = time.perf_counter() - started_on
+    if arguments.tracemalloc:
+        traced_peak = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+
+    for peer in peers.values():
+        peer.close()
+
+    metadata_size = sum(len(m) for m in torrents.values()) / len(torrents)
+    succeeded = sum(n for (_, ok), n in outcomes.items() if ok)
+    results = collections.OrderedDict([
+        ("duration_s", duration),
+        ("fetches", arguments.fetches),
+        ("fetches_per_s", arguments.fetches / duration),
+        ("succeeded", succeeded),
+        ("succeeded_per_s", succeeded / duration),
+        ("metadata_size", metadata_size),
+        ("bytes_served_per_fetch", sum(p.bytes_sent for p in peers.values()) / arguments.fetches),
+    ])  # type: typing.Dict[str, typing.Any]
+    for behaviour in behaviours:
+        results["%s_ok" % (behaviour,)] = outcomes[behaviour, True]
+        results["%s_failed" % (behaviour,)] = outcomes[behaviour, False]
+    if arguments.tracemalloc:
+        inflight = min(arguments.concurrency, arguments.fetches)
+        results["traced_peak_bytes"] = traced_peak
+        results["traced_peak_per_inflight_fetch"] = traced_peak / inflight
+        results["copy_amplification"] = traced_peak / inflight / metadata_size
+    results["max_rss_kib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fetches", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--torrents", type=int, default=50, help="number of distinct torrents served")
+    parser.add_argument("--metadata-size", type=humanfriendly.parse_size, default="64K")
+    parser.add_argument("--max-metadata-size", type=humanfriendly.parse_size, default="10M")
+    parser.add_argument("--mix", type=common.mix_type(fake_peer.BEHAVIOURS), default="honest=1",
+                        help="relative weights of peer behaviours")
+    parser.add_argument("--slow-delay", type=float, default=0.05, help="seconds slow peers wait before every piece")
+    parser.add_argument("--timeout", type=float, default=5)
+    parser.add_argument("--no-tracemalloc", dest="tracemalloc", action="store_false",
+                        help="do not trace memory (faster, but no peak memory and copy amplification)")
+    parser.add_argument("--seed", type=int, default=1910)
+    common.add_common_arguments(parser)
+    arguments = parser.parse_args()
+
+    event_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(event_loop)
+    results = event_loop.run_until_complete(run(arguments))
+    common.report("fetch_throughput", arguments, results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -54,13 +54,16 @@ class DisposablePeer:
         self._run_task = None
         self._writer = None
 
+    @property
+    def metadata_received(self) -> int:
+        return self.__metadata_received
 
     async def run(self) -> typing.Optional[bytes]:
         event_loop = asyncio.get_event_loop()
         self._metadata_future = event_loop.create_future()
 
         try:
-            self._reader, self._writer = await asyncio.open_connection(*self.__peer_addr, loop=event_loop)  # type: ignore
+            self._reader, self._writer = await asyncio.open_connection(*self.__peer_addr)  # type: ignore
             # Send the BitTorrent handshake message (0x13 = 19 in decimal, the length of the handshake message)
             self._writer.write(b"\x13BitTorrent protocol%s%s%s" % (  # type: ignore
                 b"\x00\x00\x00\x00\x00\x10\x00\x01",
@@ -0,0 +1,74 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Capture files of raw DHT datagrams (`--capture`), to be replayed offline with `magneticod replay`.
+
+Every file starts with an 8 bytes header (magic, version, 3 reserved bytes) followed by variable-width records, each a
+little-endian fixed header (timestamp (f64), IPv4 (4 bytes), port (u16), length of the datagram (u16)) followed by the
+datagram itself, as received (or, for the captures of a replay, as sent).
+"""
+import socket
+import struct
+import time
+import typing
+
+MAGIC = b"MGCP"
+VERSION = 1
+HEADER = struct.Struct("<4sBxxx")
+RECORD = struct.Struct("<d4sHH")
+
+NodeAddress = typing.Tuple[str, int]
+
+
+class CaptureWriter:
+    """
+    Appends datagrams to a capture file.
+
+    Records are written through a large userspace buffer, so that appending one costs a memcpy most of the time and the
+    disk is hit (synchronously, in the event loop) once in every `buffer_size` bytes only.
+    """
+    def __init__(self, path: str, buffer_size: int = 1024 * 1024) -> None:
+        self.__file = open(path, "wb", buffering=buffer_size)
+        self.__file.write(HEADER.pack(MAGIC, VERSION))
+        self.n_records = 0
+
+    def append(self, data: bytes, addr: NodeAddress, timestamp: typing.Optional[float] = None) -> None:
+        try:
+            ip = socket.inet_aton(addr[0])
+        except OSError:  # not an IPv4 address
+            return
+        self.__file.write(RECORD.pack(time.time() if timestamp is None else timestamp, ip, addr[1], len(data)))
+        self.__file.write(data)
+        self.n_records += 1
+
+    def close(self) -> None:
+        self.__file.close()
+
+
+def read_capture(path: str) -> typing.Iterator[typing.Tuple[float, NodeAddress, bytes]]:
+    """ Yields (timestamp, address, datagram) tuples from a capture file. """
+    with open(path, "rb") as file:
+        header = file.read(HEADER.size)
+        if len(header) != HEADER.size or HEADER.unpack(header) != (MAGIC, VERSION):
+            raise ValueError("%s is not a capture file (or of an unknown version)" % (path,))
+        while True:
+            record = file.read(RECORD.size)
+            if len(record) != RECORD.size:
+                return  # a file that is being written to might end with a partial record
+            timestamp, ip, port, length = RECORD.unpack(record)
+            data = file.read(length)
+            if len(data) != length:
+                return
+            yield timestamp, (socket.inet_ntoa(ip), port), data
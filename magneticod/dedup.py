@@ -0,0 +1,81 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+In-process deduplication of recently seen keys (e.g. the IPv4 addresses of the DHT nodes, as integers).
+"""
+import math
+import time
+import typing
+
+from . import metrics
+
+TTLSET_ROTATIONS = metrics.counter(
+    "magneticod_ttlset_rotations_total",
+    "Buckets of the recently seen keys expired, by reason (a bucket expires early if it gets full).", ["reason"])
+_ROTATIONS_EXPIRED = TTLSET_ROTATIONS.labels("expired")
+_ROTATIONS_FULL = TTLSET_ROTATIONS.labels("full")
+
+
+class TTLSet:
+    """
+    Set of the keys seen in the last `ttl` seconds, as a ring of `n_buckets` sets each holding the keys first seen in a
+    `ttl / n_buckets` seconds long window; the oldest bucket is dropped as a whole once its window is over.
+
+    Memory is bounded by `max_size` keys: a bucket that gets full expires the oldest one early, which shortens the
+    suppression under heavy load instead of growing. Keys expire between `ttl * (1 - 1 / n_buckets)` and `ttl` seconds
+    after they are first seen; seeing a key again does not extend its life.
+    """
+    def __init__(self, ttl: float, n_buckets: int = 4, max_size: int = 1 << 20) -> None:
+        self.__width = ttl / n_buckets
+        self.__bucket_size = max(1, max_size // n_buckets)
+        # Newest first.
+        self.__buckets = [set() for _ in range(n_buckets)]  # type: typing.List[typing.Set[typing.Hashable]]
+        self.__rotate_on = time.monotonic() + self.__width
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self.__buckets)
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        for bucket in self.__buckets:
+            if key in bucket:
+                return True
+        return False
+
+    def add(self, key: typing.Hashable) -> bool:
+        """ Adds `key` unless it has been seen recently; returns True if it is new. """
+        for bucket in self.__buckets:
+            if key in bucket:
+                return False
+
+        newest = self.__buckets[0]
+        if len(newest) >= self.__bucket_size:
+            _ROTATIONS_FULL.inc()
+            self.__rotate(1)
+            newest = self.__buckets[0]
+        else:
+            now = time.monotonic()
+            if now >= self.__rotate_on:
+                n = min(len(self.__buckets), 1 + math.floor((now - self.__rotate_on) / self.__width))
+                _ROTATIONS_EXPIRED.inc(n)
+                self.__rotate(n)
+                newest = self.__buckets[0]
+        newest.add(key)
+        return True
+
+    def __rotate(self, n: int) -> None:
+        for _ in range(n):
+            self.__buckets.pop()
+            self.__buckets.insert(0, set())
+        self.__rotate_on = time.monotonic() + self.__width
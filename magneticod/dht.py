@@ -13,7 +13,10 @@
 # You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
 # <http://www.gnu.org/licenses/>.
 import asyncio
-import datetime
+import collections
+import functools
+import heapq
+import itertools
 import traceback
 import time
 import sys
@@ -22,91 +25,415 @@ import errno
 import zlib
 import logging
 import socket
+import struct
 import typing
 import os
-import ipaddress
-from collections import Counter
+import weakref
 from .constants import BOOTSTRAPPING_NODES, TRANSPORT_BUFFER_SIZE, EXCLUDE
 from . import bencode
 from . import bittorrent
-from pymemcache.client.base import Client
+from . import capture
+from . import dedup
+from . import fetch
+from . import iprange
+from . import memcached
+from . import metrics
+from . import profiling
+from . import statslog
+from . import workers
 
 NodeID = bytes
 NodeAddress = typing.Tuple[str, int]
 PeerAddress = typing.Tuple[str, int]
 InfoHash = bytes
 Metadata = bytes
-
-
-def exclude_ip(ip):
-    return False
-    # ip = ipaddress.ip_address(ip)
-    # for network in EXCLUDE:
-    #     if ip in ipaddress.ip_network(network):
-    #         return True
-    # return False
+# Node ID, IP address (as an integer), port
+#
+# IPv4 and IPv6 addresses share the same integers: we only ever accept global unicast IPv6 addresses (2000::/3), which
+# are all greater than 2**125, hence an address is an IPv4 one if and only if it is less than 2**32.
+CompactNode = typing.Tuple[NodeID, int, int]
+
+_COMPACT_NODE = struct.Struct("!20sIH")
+# BEP 32: nodes6 are 38 bytes long, and the IPv6 address is unpacked as two 64 bits halves.
+_COMPACT_NODE6 = struct.Struct("!20sQQH")
+_IPV4_END = 1 << 32
+
+# Kinds of the queries we keep track of (by their transaction IDs), to route their responses.
+_SAMPLE_INFOHASHES = 0
+_GET_PEERS = 1
+
+# All the SybilNodes of this process, for the gauges below.
+_nodes = weakref.WeakSet()  # type: typing.MutableSet[SybilNode]
+
+# IPv4 addresses (as integers) of the nodes we have come across recently, shared by all the SybilNodes of the process
+# unless they are given their own.
+RECENT_NODES = dedup.TTLSet(15 * 60)
+# Info hashes received in BEP 51 samples recently, shared by all the SybilNodes of the process.
+RECENT_SAMPLES = dedup.TTLSet(15 * 60)
+# Info hashes looked up recently (successfully or not), shared by all the SybilNodes of the process.
+RECENT_LOOKUPS = dedup.TTLSet(60 * 60)
+
+TRANSACTION_TIMEOUT = 10
+MAX_TRANSACTIONS = 1 << 16
+
+# BEP 51: nodes tell us how many seconds to wait (up to 6 hours) before sampling them again. Nodes that do not respond
+# are retried after an hour, and the ones that do not support sample_infohashes after 6 hours.
+SAMPLE_MIN_INTERVAL = 60
+SAMPLE_MAX_INTERVAL = 6 * 3600
+SAMPLE_NO_RESPONSE_INTERVAL = 3600
+SAMPLE_UNSUPPORTED_INTERVAL = 6 * 3600
+MAX_SAMPLE_SCHEDULE = 1 << 20
+
+# get_peers lookups query at most LOOKUP_ALPHA nodes at once and LOOKUP_MAX_QUERIES in total, starting with the
+# LOOKUP_SEEDS nodes of the routing table that are the closest to the info hash, and stop once they have found
+# LOOKUP_ENOUGH_PEERS peers.
+LOOKUP_ALPHA = 4
+LOOKUP_MAX_QUERIES = 32
+LOOKUP_SEEDS = 8
+LOOKUP_ENOUGH_PEERS = 8
+MAX_LOOKUPS = 1000
+
+# Backpressure from the database writer: the pressure is the depth of the metadata queue over MAX_QUEUE_DEPTH, or the
+# time its oldest metadata has been waiting over MAX_WRITER_LAG, whichever is greater. From PRESSURE_LOW on, fewer and
+# fewer peers are tried per info hash (down to one at 1), and from 1 on, the peers of new info hashes are deferred to
+# a spill of SPILL_SIZE (the oldest ones are dropped when it is full) and no lookups are started. The spill is drained
+# SPILL_DRAIN_PER_TICK at a time once the pressure is below PRESSURE_LOW again.
+MAX_QUEUE_DEPTH = 1000
+MAX_WRITER_LAG = 30
+PRESSURE_LOW = 0.5
+SPILL_SIZE = 10000
+SPILL_DRAIN_PER_TICK = 1000
+
+
+class GetPeersLookup:
+    """
+    State of an iterative (Kademlia) get_peers lookup, where the nodes closest to the info hash (by XOR distance) are
+    queried first, and the nodes they return are queried in turn.
+    """
+    __slots__ = ("info_hash", "target", "candidates", "seen", "in_flight", "n_queries", "n_peers")
+
+    def __init__(self, info_hash: InfoHash) -> None:
+        self.info_hash = info_hash
+        self.target = int.from_bytes(info_hash, "big")
+        # (XOR distance to the info hash, IP address (as an integer), port) of the nodes not queried yet
+        self.candidates = []  # type: typing.List[typing.Tuple[int, int, int]]
+        self.seen = set()  # type: typing.Set[int]
+        self.in_flight = 0
+        self.n_queries = 0
+        self.n_peers = 0
+
+    def add_node(self, node_id: typing.Optional[NodeID], ip: int, port: int) -> None:
+        """ A node without an ID is queried before all the others. """
+        if ip in self.seen:
+            return
+        self.seen.add(ip)
+        distance = int.from_bytes(node_id, "big") ^ self.target if node_id else -1
+        heapq.heappush(self.candidates, (distance, ip, port))
+
+
+class VirtualIdentity:
+    """
+    One of the identities a SybilNode hosts on its socket, each with its own neighbours and token secret.
+
+    Identities split the ID space evenly by the first byte of the IDs: each one looks for neighbours around its own
+    region (by the targets of its find_node queries), and answers for the info hashes in it. Responses to the find_node
+    queries of an identity are told apart by their transaction IDs.
+    """
+    __slots__ = ("index", "id", "token_secret", "target_prefix", "find_node_transaction_id", "routing_table",
+                 "routing_table6")
+
+    def __init__(self, index: int, n_identities: int) -> None:
+        self.index = index
+        first, last = index * 256 // n_identities, (index + 1) * 256 // n_identities
+        self.id = os.urandom(20)
+        if n_identities > 1:
+            self.id = bytes([first + self.id[0] % (last - first)]) + self.id[1:]
+        self.token_secret = os.urandom(4)
+        # A single identity looks for neighbours all over the ID space.
+        self.target_prefix = self.id[:1] if n_identities > 1 else b""
+        self.find_node_transaction_id = b"n" + bytes([index])
+        # The routing tables of IPv4 and IPv6 nodes are capped separately (by the same, congestion controlled limit),
+        # so that neither family can crowd the other out.
+        self.routing_table = {}  # type: typing.Dict[NodeID, CompactNode]
+        self.routing_table6 = {}  # type: typing.Dict[NodeID, CompactNode]
+
+    def forge_id(self, target: bytes) -> NodeID:
+        """ An ID as close to `target` as it gets while still being (partly) ours. """
+        return target[:15] + self.id[:5]
+
+
+def _is_global6(ip: int) -> bool:
+    """ True if the IPv6 address `ip` (as an integer) is in the global unicast range (2000::/3). """
+    return ip >> 125 == 1
+
+
+def _format_ip(ip: int) -> str:
+    if ip < _IPV4_END:
+        return socket.inet_ntoa(ip.to_bytes(4, "big"))
+    return socket.inet_ntop(socket.AF_INET6, ip.to_bytes(16, "big"))
+
+
+def _pack_ip(host: str) -> bytes:
+    """ Raises OSError if `host` is not an IP address. """
+    if ":" in host:
+        return socket.inet_pton(socket.AF_INET6, host)
+    return socket.inet_aton(host)
+
+
+def _has_nodes(response: typing.Any) -> bool:
+    return isinstance(response, dict) and (
+        type(response.get(b"nodes")) is bytes or type(response.get(b"nodes6")) is bytes)
+
+
+PACKETS_RECEIVED = metrics.counter(
+    "magneticod_dht_packets_received_total", "KRPC messages received, by type.", ["type"])
+_RECEIVED_FIND_NODE = PACKETS_RECEIVED.labels("find_node_response")
+_RECEIVED_GET_PEERS = PACKETS_RECEIVED.labels("get_peers")
+_RECEIVED_ANNOUNCE_PEER = PACKETS_RECEIVED.labels("announce_peer")
+_RECEIVED_SAMPLE_INFOHASHES = PACKETS_RECEIVED.labels("sample_infohashes_response")
+_RECEIVED_GET_PEERS_RESPONSE = PACKETS_RECEIVED.labels("get_peers_response")
+_RECEIVED_ERROR = PACKETS_RECEIVED.labels("error")
+_RECEIVED_OTHER = PACKETS_RECEIVED.labels("other")
+
+PACKETS_SENT = metrics.counter(
+    "magneticod_dht_packets_sent_total", "KRPC messages sent, by type.", ["type"])
+_SENT_FIND_NODE = PACKETS_SENT.labels("find_node")
+_SENT_GET_PEERS = PACKETS_SENT.labels("get_peers_response")
+_SENT_ANNOUNCE_PEER = PACKETS_SENT.labels("announce_peer_response")
+_SENT_SAMPLE_INFOHASHES = PACKETS_SENT.labels("sample_infohashes")
+_SENT_GET_PEERS_QUERY = PACKETS_SENT.labels("get_peers")
+
+PACKETS_DROPPED = metrics.counter(
+    "magneticod_dht_packets_dropped_total",
+    "Datagrams received but not handled, or not sent because the transport is paused, by reason.", ["reason"])
+_DROPPED_PORT_ZERO = PACKETS_DROPPED.labels("port_zero")
+_DROPPED_CLOSING = PACKETS_DROPPED.labels("closing")
+_DROPPED_UNDECODABLE = PACKETS_DROPPED.labels("undecodable")
+_DROPPED_MALFORMED = PACKETS_DROPPED.labels("malformed")
+_DROPPED_EXCLUDED = PACKETS_DROPPED.labels("excluded")
+_DROPPED_PAUSED = PACKETS_DROPPED.labels("writing_paused")
+
+NODES_SKIPPED = metrics.counter(
+    "magneticod_dht_nodes_skipped_total", "Nodes not added to the routing table because it is full.")
+NODES_COLLISIONS = metrics.counter(
+    "magneticod_dht_nodes_collisions_total", "Nodes ignored because they have been seen recently.")
+INFOHASH_COLLISIONS = metrics.counter(
+    "magneticod_dht_infohash_collisions_total", "Announced info hashes ignored because they are in the cache.")
+
+TRANSACTIONS_TIMED_OUT = metrics.counter(
+    "magneticod_dht_transactions_timed_out_total", "Queries of ours that have not been responded in time, by type.",
+    ["type"])
+_TIMED_OUT = {
+    _SAMPLE_INFOHASHES: TRANSACTIONS_TIMED_OUT.labels("sample_infohashes"),
+    _GET_PEERS: TRANSACTIONS_TIMED_OUT.labels("get_peers"),
+}
+SAMPLE_RESPONSES = metrics.counter(
+    "magneticod_dht_sample_infohashes_responses_total",
+    "Responses to our BEP 51 sample_infohashes queries, by whether the node supports them.", ["result"])
+_SAMPLE_RESPONSES_SUPPORTED = SAMPLE_RESPONSES.labels("supported")
+_SAMPLE_RESPONSES_UNSUPPORTED = SAMPLE_RESPONSES.labels("unsupported")
+SAMPLED_INFOHASHES = metrics.counter(
+    "magneticod_dht_sampled_infohashes_total",
+    "Info hashes received in BEP 51 samples, by whether they have been sampled recently.", ["result"])
+_SAMPLED_NEW = SAMPLED_INFOHASHES.labels("new")
+_SAMPLED_RECENT = SAMPLED_INFOHASHES.labels("recent")
+GET_PEERS_RESULTS = metrics.counter(
+    "magneticod_dht_get_peers_results_total", "Responses to our get_peers queries, by whether they have peers.",
+    ["result"])
+_GET_PEERS_PEERS = GET_PEERS_RESULTS.labels("peers")
+_GET_PEERS_NO_PEERS = GET_PEERS_RESULTS.labels("no_peers")
+LOOKUPS = metrics.counter(
+    "magneticod_dht_lookups_total", "Finished get_peers lookups, by whether they have found any peers.", ["result"])
+_LOOKUPS_PEERS = LOOKUPS.labels("peers")
+_LOOKUPS_NO_PEERS = LOOKUPS.labels("no_peers")
+_LOOKUPS_DROPPED = LOOKUPS.labels("dropped")
+
+SHED = metrics.counter(
+    "magneticod_dht_shed_total",
+    "Announced peers, info hashes and lookups not fetched (right away) because the database writer is falling behind, "
+    "by action.", ["action"])
+_SHED_PEER = SHED.labels("peer")  # a peer of an info hash being fetched already is not tried
+_SHED_DEFERRED = SHED.labels("deferred")  # a peer of a new info hash is put in the spill
+_SHED_DROPPED = SHED.labels("dropped")  # the oldest peer in the spill is dropped to make room
+_SHED_LOOKUP = SHED.labels("lookup")
+
+FETCHES = metrics.counter("magneticod_fetches_total", "Finished metadata fetches, by result.", ["result"])
+_FETCHES_SUCCEEDED = FETCHES.labels("succeeded")
+_FETCHES_FAILED = FETCHES.labels("failed")
+FETCH_DURATION = metrics.histogram(
+    "magneticod_fetch_duration_seconds", "Time from the first peer of an info hash until its fetch has finished.",
+    ["result"], buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+)
+_FETCH_DURATION_SUCCEEDED = FETCH_DURATION.labels("succeeded")
+_FETCH_DURATION_FAILED = FETCH_DURATION.labels("failed")
+FETCH_BYTES_RECEIVED = metrics.counter(
+    "magneticod_fetch_bytes_received_total", "Metadata bytes received from peers, including the wasted ones.")
+
+ROUTING_TABLE_NODES = metrics.gauge("magneticod_dht_routing_table_nodes", "Nodes in the routing tables, by family.",
+                                    ["family"])
+ROUTING_TABLE_NODES.labels("ipv4").set_function(
+    lambda: sum(len(identity.routing_table) for node in _nodes for identity in node._identities))
+ROUTING_TABLE_NODES.labels("ipv6").set_function(
+    lambda: sum(len(identity.routing_table6) for node in _nodes for identity in node._identities))
+metrics.gauge("magneticod_dht_max_neighbours", "Current (congestion controlled) maximum number of neighbours.") \
+    .set_function(lambda: sum(node._n_max_neighbours for node in _nodes))
+metrics.gauge("magneticod_fetch_jobs", "Info hashes whose metadata is being fetched.").set_function(
+    lambda: sum(node.metadata_jobs for node in _nodes))
+metrics.gauge("magneticod_fetch_peers", "Peers the metadata is being fetched from.").set_function(
+    lambda: sum(node.metadata_tasks for node in _nodes))
+metrics.gauge("magneticod_metadata_queue_depth", "Fetched metadata waiting to be added to the database.") \
+    .set_function(lambda: sum(node.metadata_q().qsize() for node in _nodes))
+metrics.gauge("magneticod_dht_transactions", "Queries of ours waiting for a response.").set_function(
+    lambda: sum(len(node._transactions) for node in _nodes))
+metrics.gauge("magneticod_dht_pressure", "Backpressure from the database writer (the highest of all nodes).") \
+    .set_function(lambda: max((node._pressure for node in _nodes), default=0))
+metrics.gauge("magneticod_metadata_writer_lag_seconds", "Time the oldest metadata in the queue has been waiting.") \
+    .set_function(lambda: max((node._writer_lag for node in _nodes), default=0))
+metrics.gauge("magneticod_dht_spilled", "Announced peers deferred until the database writer catches up.") \
+    .set_function(lambda: sum(node.n_spilled for node in _nodes))
+metrics.gauge("magneticod_dht_lookups", "get_peers lookups in progress.").set_function(
+    lambda: sum(node.n_lookups for node in _nodes))
+metrics.gauge("magneticod_dht_recent_nodes", "Nodes seen recently, that are not queried again until they expire.") \
+    .set_function(lambda: sum(len(s) for s in {id(node._recent_nodes): node._recent_nodes for node in _nodes}.values()))
+
+profiling.PROFILER.register(bencode, "loads", "bencode.loads")
+profiling.PROFILER.register(bittorrent.DisposablePeer, "_DisposablePeer__on_ext_message", "bittorrent.on_ext_message")
+
+
+# Networks we neither query nor respond to, unless the SybilNodes are given their own (e.g. with a blocklist).
+EXCLUDED = iprange.IPv4RangeSet.parse(EXCLUDE)
 
 
 class SybilNode(asyncio.DatagramProtocol):
-    def __init__(self, is_infohash_new, max_metadata_size, max_neighbours, memcache, peer_timeout, peers_per_hash, stats_interval=1, debug_path=None):
-        self._peer_timeout = peer_timeout
-        self._peers_per_hash = peers_per_hash
+    def __init__(self, is_infohash_new, max_metadata_size, max_neighbours, memcache, peer_timeout, peers_per_hash,
+                 stats_interval=1, debug_path=None, fetch_pool=None, debug_max_file_size=64 * 1024 * 1024,
+                 debug_rotate_interval=3600, capture_path=None, fetcher=None, recent_nodes=None, excluded=None,
+                 samples_per_tick=0, n_identities=1, max_queue_depth=MAX_QUEUE_DEPTH, max_writer_lag=MAX_WRITER_LAG,
+                 spill_size=SPILL_SIZE, bootstrapping_nodes=BOOTSTRAPPING_NODES):
+        # stats_interval is the interval between the ticks; if None, the owner is expected to call tick() itself.
+        # fetcher, if given, is called with the on_done callback to create the fetch engine (for replays).
+        # samples_per_tick is the maximum number of BEP 51 sample_infohashes queries sent at every tick (0 to disable).
+        # n_identities is the number of virtual identities (up to 256) hosted on the socket.
+        # max_queue_depth, max_writer_lag and spill_size control the backpressure (see MAX_QUEUE_DEPTH above).
+        # bootstrapping_nodes are the (host, port) pairs queried while the routing tables are empty.
+        self._bootstrapping_nodes = bootstrapping_nodes
         self._node_stat = None
         self._hash_stat = None
         if debug_path:
-            if not os.path.exists(debug_path):
-                os.makedirs(debug_path)
-            self._node_stat = open(os.path.join(debug_path, 'nodes.log'), 'ab')
-            self._hash_stat = open(os.path.join(debug_path, 'hashes.log'), 'ab')
+            self._node_stat = statslog.StatsLog(
+                debug_path, statslog.KIND_NODES, debug_max_file_size, debug_rotate_interval)
+            self._hash_stat = statslog.StatsLog(
+                debug_path, statslog.KIND_HASHES, debug_max_file_size, debug_rotate_interval)
         self._stats_interval = stats_interval
-        self.__true_id = os.urandom(20)
-        self._memcache = Client((
+        self._capture = capture.CaptureWriter(capture_path) if capture_path else None
+        self._memcache = memcached.MemcachedClient(
             memcache.split(':')[0],
             int(memcache.split(':')[1])
-        ), no_delay=True) if memcache else None
+        ) if memcache else None
 
         self._error = False
-        self._nodes_collisions = 0
-        self._collisions = 0
-        self._hashes = set()
-        self._cnt = Counter()
-        self._timers = Counter()
-        self._routing_table = {}  # type: typing.Dict[NodeID, NodeAddress]
-        self._skip = 0
-
-        self.__token_secret = os.urandom(4)
+        self._recent_nodes = RECENT_NODES if recent_nodes is None else recent_nodes  # type: dedup.TTLSet
+        self._excluded = EXCLUDED if excluded is None else excluded  # type: iprange.IPv4RangeSet
+        assert 1 <= n_identities <= 256, "n_identities must be between 1 and 256"
+        self._identities = [VirtualIdentity(i, n_identities) for i in range(n_identities)]
+        # The families are enabled as the node is launched.
+        self._ipv4 = True
+        self._ipv6 = False
+
+        # transaction ID -> (expires on, kind, IP address (as an integer) of the queried node, info hash or None,
+        # identity that has sent the query), in the order they are sent (hence expire).
+        self._transactions = collections.OrderedDict()  # type: typing.MutableMapping[bytes, typing.Tuple]
+        self.__next_transaction_id = int.from_bytes(os.urandom(4), "big")
+        self._samples_per_tick = samples_per_tick
+        # IP address (as an integer) -> time.monotonic() before which the node must not be sampled
+        self.__sample_schedule = {}  # type: typing.Dict[int, float]
+        self.__lookups = {}  # type: typing.Dict[InfoHash, GetPeersLookup]
+
         # Maximum number of neighbours (this is a THRESHOLD where, once reached, the search for new neighbours will
         # stop; but until then, the total number of neighbours might exceed the threshold).
         self._n_max_neighbours = max_neighbours
         self._n_real_max_neighbours = max_neighbours
-        self.__parent_futures = {}  # type: typing.Dict[InfoHash, asyncio.Future]
         self._is_infohash_new = is_infohash_new
-        self.__max_metadata_size = max_metadata_size
+        self._peers_per_hash = peers_per_hash
+        if fetcher:
+            self.__fetcher = fetcher(self.__on_fetch_done)
+        elif fetch_pool:
+            self.__fetcher = workers.RemoteFetchEngine(fetch_pool, self.__on_fetch_done)
+        else:
+            self.__fetcher = fetch.FetchEngine(max_metadata_size, peer_timeout, peers_per_hash, self.__on_fetch_done)
         # Complete metadatas will be added to the queue, to be retrieved and committed to the database.
         self.__metadata_queue = asyncio.Queue()  # typing.Collection[typing.Tuple[InfoHash, Metadata]]
+        # time.monotonic() at which the metadata in the queue have been put in it, oldest first
+        self.__enqueued_on = collections.deque()  # type: typing.Deque[float]
+        self._max_queue_depth = max_queue_depth
+        self._max_writer_lag = max_writer_lag
+        self._pressure = 0.0
+        self._writer_lag = 0.0
+        # (info hash, peer address) of the announces deferred under pressure, oldest first
+        self.__spill = collections.deque(maxlen=spill_size)  # type: typing.Deque[typing.Tuple[InfoHash, PeerAddress]]
         self._is_writing_paused = False
         self._tick_task = None
 
-        logging.info("SybilNode %s initialized!", self.__true_id.hex().upper())
-
-    def __del__(self):
-        if self._node_stat:
-            self._node_stat.close()
-        if self._hash_stat:
-            self._hash_stat.close()
+        _nodes.add(self)
+        for attribute, stage in (
+                ("datagram_received", "dht.datagram_received"),
+                ("_SybilNode__on_FIND_NODE_response", "dht.find_node_response"),
+                ("_SybilNode__on_GET_PEERS_query", "dht.get_peers"),
+                ("_SybilNode__on_ANNOUNCE_PEER_query", "dht.announce_peer"),
+                ("_SybilNode__on_SAMPLE_INFOHASHES_response", "dht.sample_infohashes_response"),
+                ("_SybilNode__on_GET_PEERS_response", "dht.get_peers_response"),
+                ("_SybilNode__lookup", "dht.lookup"),
+                ("_SybilNode__decode_nodes", "dht.decode_nodes"),
+                ("_SybilNode__decode_nodes6", "dht.decode_nodes6"),
+                ("_is_infohash_new", "db.is_infohash_new"),
+                ("sendto", "dht.sendto")):
+            profiling.PROFILER.register(self, attribute, stage)
+        if self._memcache:
+            profiling.PROFILER.register(self._memcache, "add", "memcached.add")
+        logging.info("SybilNode %s initialized!", ", ".join(identity.id.hex().upper() for identity in self._identities))
 
     def metadata_q(self):
         return self.__metadata_queue
 
     async def launch(self, address):
-        await asyncio.get_event_loop().create_datagram_endpoint(lambda: self, local_addr=address)
+        if self._memcache:
+            await self._memcache.start()
+        event_loop = asyncio.get_event_loop()
+        host, port = address
+        if ":" in host:
+            # IPv4 datagrams are received on the same (dual-stack) socket if it is bound to the wildcard address, with
+            # their addresses mapped to IPv6 (::ffff:a.b.c.d).
+            try:
+                sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+                try:
+                    sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0 if host == "::" else 1)
+                    sock.bind((host, port))
+                except OSError:
+                    sock.close()
+                    raise
+            except OSError:
+                if host != "::":
+                    raise
+                logging.warning("IPv6 is not available, falling back to IPv4 only!", exc_info=True)
+                address = ("0.0.0.0", port)
+            else:
+                self._ipv4 = host == "::"
+                self._ipv6 = True
+                await event_loop.create_datagram_endpoint(lambda: self, sock=sock)
+                logging.info("SybliNode is launched on %s (%s)!", address, "dual-stack" if self._ipv4 else "IPv6")
+                return
+        await event_loop.create_datagram_endpoint(lambda: self, local_addr=address)
         logging.info("SybliNode is launched on %s!", address)
 
     # mypy ignored: mypy errors because we explicitly stated `transport`s type =)
     def connection_made(self, transport: asyncio.DatagramTransport) -> None:  # type: ignore
         # mypy ignored: mypy doesn't know (yet) about coroutines
-        self._tick_task = asyncio.get_event_loop().create_task(self.tick_periodically())  # type: ignore
+        if self._stats_interval:
+            self._tick_task = asyncio.get_event_loop().create_task(self.tick_periodically())  # type: ignore
         self._transport = transport
+        if self._node_stat:
+            self._node_stat.start()
+            self._hash_stat.start()
         logging.info('Initial write transport buffer size: ' + str(transport.get_write_buffer_limits()))
         transport.set_write_buffer_limits(high=TRANSPORT_BUFFER_SIZE, low=int(TRANSPORT_BUFFER_SIZE * 0.9))
         logging.info('Current write transport buffer size: ' + str(transport.get_write_buffer_limits()))
@@ -124,139 +451,238 @@ class SybilNode(asyncio.DatagramProtocol):
     def resume_writing(self) -> None:
         self._is_writing_paused = False
 
-    def sendto(self, data, addr) -> None:
-        if not self._is_writing_paused:
-            self._transport.sendto(data, addr)
+    def sendto(self, data, addr, counter=None) -> None:
+        if self._is_writing_paused:
+            _DROPPED_PAUSED.inc()
+            return
+        if self._ipv6 and ":" not in addr[0]:
+            addr = ("::ffff:" + addr[0], addr[1])
+        self._transport.sendto(data, addr)
+        if counter:
+            counter.inc()
 
     def error_received(self, exc: Exception) -> None:
         self._error = exc
 
     @property
     def metadata_tasks(self):
-        return sum(x.child_count for x in self.__parent_futures.values())
+        return self.__fetcher.n_active
+
+    @property
+    def metadata_jobs(self):
+        return len(self.__fetcher)
+
+    @property
+    def n_lookups(self) -> int:
+        return len(self.__lookups)
+
+    @property
+    def n_spilled(self) -> int:
+        return len(self.__spill)
 
     async def tick_periodically(self) -> None:
         while True:
             await asyncio.sleep(self._stats_interval)
-            # Bootstrap (by querying the bootstrapping servers) ONLY IF the routing table is empty (i.e. we don't have
-            # any neighbours). Otherwise we'll increase the load on those central servers by querying them every second.
-            if not self._routing_table:
-                await self.__bootstrap()
-            self.__make_neighbours()
-            self._routing_table.clear()
-            if not self._is_writing_paused:
-                n = max(self._n_max_neighbours * 101 // 100, self._n_max_neighbours + 1)
-                self._n_max_neighbours = min(n, self._n_real_max_neighbours)
-            # mypy ignore: because .child_count on Future is monkey-patched
-            logging.debug("fetch metadata task count: %d", self.metadata_tasks)  # type: ignore
-            logging.debug("asyncio task count: %d", len(asyncio.Task.all_tasks()))
-
-            if self._error:
-                exc = self._error
-                if isinstance(exc, PermissionError):
-                    pass
-                elif isinstance(exc, OSError) and exc.errno == errno.ENOBUFS:
-                    # This exception (EPERM errno: 1) is kernel's way of saying that "you are far too fast, chill".
-                    # It is also likely that we have received a ICMP source quench packet (meaning, that we really need to
-                    # slow down.
-                    #
-                    # Read more here: http://www.archivum.info/comp.protocols.tcp-ip/2009-05/00088/UDP-socket-amp-amp-sendto
-                    #                 -amp-amp-EPERM.html
-
-                    # > Note On BSD systems (OS X, FreeBSD, etc.) flow control is not supported for DatagramProtocol, because
-                    # > send failures caused by writing too many packets cannot be detected easily. The socket always appears
-                    # > ‘ready’ and excess packets are dropped; an OSError with errno set to errno.ENOBUFS may or may not be
-                    # > raised; if it is raised, it will be reported to DatagramProtocol.error_received() but otherwise ignored.
-                    # Source: https://docs.python.org/3/library/asyncio-protocol.html#flow-control-callbacks
-
-                    # In case of congestion, decrease the maximum number of nodes to the 90% of the current value.
-
-                    self._n_max_neighbours = self._n_max_neighbours * 9 // 10
-                    logging.debug(
-                        "Maximum number of neighbours now %d (error_received)",
-                        self._n_max_neighbours)
-                    logging.error("SybilNode error.",
-                                  exc_info=self._error)
-                else:
-                    # The previous "exception" was kind of "unexceptional", but we should log anything else.
-                    logging.error("SybilNode operational error.", exc_info=self._error)
-            self._error = False
+            await self.tick()
+
+    async def tick(self, bootstrap: bool = True) -> None:
+        # Bootstrap (by querying the bootstrapping servers) ONLY the identities whose routing tables are empty (i.e. that
+        # don't have any neighbours). Otherwise we'll increase the load on those central servers by querying them every
+        # second.
+        if bootstrap:
+            orphans = [identity for identity in self._identities
+                       if not identity.routing_table and not identity.routing_table6]
+            if orphans:
+                await self.__bootstrap(orphans)
+        self.__expire_transactions()
+        self.__update_pressure()
+        if self.__spill and self._pressure < PRESSURE_LOW:
+            self.__drain_spill()
+        if self._samples_per_tick:
+            self.__sample_infohashes()
+        self.__make_neighbours()
+        for identity in self._identities:
+            identity.routing_table.clear()
+            identity.routing_table6.clear()
+        if not self._is_writing_paused:
+            n = max(self._n_max_neighbours * 101 // 100, self._n_max_neighbours + 1)
+            self._n_max_neighbours = min(n, self._n_real_max_neighbours)
+        logging.debug("fetch metadata task count: %d (%d info hashes)", self.metadata_tasks, self.metadata_jobs)
+
+        if self._error:
+            exc = self._error
+            if isinstance(exc, PermissionError):
+                pass
+            elif isinstance(exc, OSError) and exc.errno == errno.ENOBUFS:
+                # This exception (EPERM errno: 1) is kernel's way of saying that "you are far too fast, chill".
+                # It is also likely that we have received a ICMP source quench packet (meaning, that we really need to
+                # slow down.
+                #
+                # Read more here: http://www.archivum.info/comp.protocols.tcp-ip/2009-05/00088/UDP-socket-amp-amp-sendto
+                #                 -amp-amp-EPERM.html
+
+                # > Note On BSD systems (OS X, FreeBSD, etc.) flow control is not supported for DatagramProtocol, because
+                # > send failures caused by writing too many packets cannot be detected easily. The socket always appears
+                # > ‘ready’ and excess packets are dropped; an OSError with errno set to errno.ENOBUFS may or may not be
+                # > raised; if it is raised, it will be reported to DatagramProtocol.error_received() but otherwise ignored.
+                # Source: https://docs.python.org/3/library/asyncio-protocol.html#flow-control-callbacks
+
+                # In case of congestion, decrease the maximum number of nodes to the 90% of the current value.
+
+                self._n_max_neighbours = self._n_max_neighbours * 9 // 10
+                logging.debug(
+                    "Maximum number of neighbours now %d (error_received)",
+                    self._n_max_neighbours)
+                logging.error("SybilNode error.",
+                              exc_info=self._error)
+            else:
+                # The previous "exception" was kind of "unexceptional", but we should log anything else.
+                logging.error("SybilNode operational error.", exc_info=self._error)
+        self._error = False
 
 
     def datagram_received(self, data, addr) -> None:
+        if self._ipv6:
+            # (host, port, flow info, scope ID) of the IPv6 sockets; IPv4 addresses are unmapped so that they are
+            # handled the same as on the IPv4 sockets.
+            host = addr[0]
+            if host.startswith("::ffff:") and "." in host:
+                addr = (host[7:], addr[1])
+            else:
+                addr = (host, addr[1])
+
+        if self._capture:
+            self._capture.append(data, addr)
+
         # Ignore nodes that "uses" port 0, as we cannot communicate with them reliably across the different systems.
         # See https://tools.cisco.com/security/center/viewAlert.x?alertId=19935 for slightly more details
         if addr[1] == 0:
+            _DROPPED_PORT_ZERO.inc()
             return
 
         if self._transport.is_closing():
+            _DROPPED_CLOSING.inc()
             return
 
         try:
             message = bencode.loads(data)
         except bencode.BencodeDecodingError:
+            _DROPPED_UNDECODABLE.inc()
             return
 
-        if message == StopIteration:
+        if message == StopIteration or not isinstance(message, dict):
+            _DROPPED_UNDECODABLE.inc()
             return
 
-        if isinstance(message.get(b"r"), dict) and type(message[b"r"].get(b"nodes")) is bytes:
+        # Responses to the queries we keep track of are routed by their transaction IDs.
+        transaction_id = message.get(b"t")
+        if type(transaction_id) is bytes and transaction_id in self._transactions \
+                and message.get(b"y") in (b"r", b"e") and self.__on_response(message, addr, transaction_id):
+            return
+
+        if _has_nodes(message.get(b"r")):
+            _RECEIVED_FIND_NODE.inc()
             self.__on_FIND_NODE_response(message, addr)
         elif message.get(b"q") == b"get_peers":
+            _RECEIVED_GET_PEERS.inc()
             self.__on_GET_PEERS_query(message, addr)
         elif message.get(b"q") == b"announce_peer":
+            _RECEIVED_ANNOUNCE_PEER.inc()
             self.__on_ANNOUNCE_PEER_query(message, addr)
+        else:
+            _RECEIVED_OTHER.inc()
 
     async def shutdown(self) -> None:
-        parent_futures = list(self.__parent_futures.values())
-        for pf in parent_futures:
-            pf.set_result(None)
-        self._tick_task.cancel()
-        await asyncio.wait([self._tick_task])
+        self.__fetcher.shutdown()
+        if self._tick_task:
+            self._tick_task.cancel()
+            await asyncio.wait([self._tick_task])
         self._transport.close()
+        if self._capture:
+            self._capture.close()
+        if self._memcache:
+            await self._memcache.close()
+        if self._node_stat:
+            await self._node_stat.close()
+            await self._hash_stat.close()
 
-    def __on_FIND_NODE_response(self, message: bencode.KRPCDict, addr: NodeAddress) -> None:  # pylint: disable=invalid-name
-        # Well, we are not really interested in your response if our routing table is already full; sorry.
-        # (Thanks to Glandos@GitHub for the heads up!)
+    def __on_FIND_NODE_response(self, message: bencode.KRPCDict, addr: NodeAddress,  # pylint: disable=invalid-name
+                                identity: typing.Optional[VirtualIdentity] = None) -> None:
+        if identity is None:
+            identity = self.__identity_of_transaction(message.get(b"t"))
 
         try:
-            nodes_arg = message[b"r"][b"nodes"]
+            response = message[b"r"]
+            nodes_arg = response.get(b"nodes", b"")
             assert type(nodes_arg) is bytes and len(nodes_arg) % 26 == 0
-        except (TypeError, KeyError, AssertionError):
+            nodes6_arg = response.get(b"nodes6", b"")
+            assert type(nodes6_arg) is bytes and len(nodes6_arg) % 38 == 0
+        except (TypeError, KeyError, AttributeError, AssertionError):
+            _DROPPED_MALFORMED.inc()
             return
 
-        try:
-            nodes = self.__decode_nodes(nodes_arg)
-        except AssertionError:
+        nodes = self.__decode_nodes(nodes_arg) if nodes_arg and self._ipv4 else []
+        nodes6 = self.__decode_nodes6(nodes6_arg) if nodes6_arg and self._ipv6 else []
+
+        # Stats logs have room for IPv4 addresses only.
+        if self._node_stat and ":" not in addr[0]:
+            self._node_stat.append(socket.inet_aton(addr[0]), addr[1], len(nodes) + len(nodes6))
+
+        if nodes:
+            # Ignore nodes with port 0, and the ones in the excluded networks.
+            excluded = self._excluded
+            self.__add_nodes(identity.routing_table, nodes, lambda n: n[2] != 0 and n[1] not in excluded)
+        if nodes6:
+            self.__add_nodes(identity.routing_table6, nodes6, lambda n: n[2] != 0 and _is_global6(n[1]))
+
+    def __identity_of_transaction(self, transaction_id: typing.Any) -> VirtualIdentity:
+        """ The identity that has sent the find_node query `transaction_id` (or the first one if it is not ours). """
+        if type(transaction_id) is bytes and len(transaction_id) == 2 and transaction_id[0] == 0x6E \
+                and transaction_id[1] < len(self._identities):  # b"n"
+            return self._identities[transaction_id[1]]
+        return self._identities[0]
+
+    def __identity_of(self, info_hash: InfoHash) -> VirtualIdentity:
+        """ The identity whose region of the ID space `info_hash` is in. """
+        return self._identities[info_hash[0] * len(self._identities) >> 8]
+
+    def __add_nodes(self, routing_table: typing.Dict[NodeID, CompactNode], nodes: typing.List[CompactNode],
+                    is_valid: typing.Callable[[CompactNode], bool]) -> None:
+        # Well, we are not really interested in your response if our routing table is already full; sorry.
+        # (Thanks to Glandos@GitHub for the heads up!)
+        if len(routing_table) >= self._n_max_neighbours:
+            NODES_SKIPPED.inc(len(nodes))
             return
 
-        if self._node_stat:
-            self._node_stat.write(b'%s:%d %d\n' % (addr[0].encode(), addr[1], len(nodes)))
+        nodes = [n for n in nodes if is_valid(n)]
 
-        if len(self._routing_table) >= self._n_max_neighbours:
-            self._skip += len(nodes)
-            return
-
-        nodes = [n for n in nodes if n[1][1] != 0]  # Ignore nodes with port 0.
+        add_recent_node = self._recent_nodes.add
+        n_nodes = len(nodes)
+        nodes = [n for n in nodes if add_recent_node(n[1])]
+        NODES_COLLISIONS.inc(n_nodes - len(nodes))
 
         if self._memcache:
-            _nodes = []
             for n in nodes:
-                nhash = n[1][0].encode()
-                known = self._memcache.get(nhash)
-                if not known:
-                    _nodes.append(n)
-                    self._memcache.set(nhash, '1', 15 * 60)
-                else:
-                    self._nodes_collisions += 1
-            nodes = _nodes
-
-        update_nodes = nodes[:self._n_max_neighbours - len(self._routing_table)]
-        self._skip += len(nodes) - len(update_nodes)
-        self._routing_table.update(update_nodes)
+                self._memcache.add(
+                    _format_ip(n[1]).encode(), 15 * 60, functools.partial(self.__on_node_checked, routing_table, n))
+            return
+
+        update_nodes = nodes[:self._n_max_neighbours - len(routing_table)]
+        NODES_SKIPPED.inc(len(nodes) - len(update_nodes))
+        routing_table.update({n[0]: n for n in update_nodes})
+
+    def __on_node_checked(self, routing_table: typing.Dict[NodeID, CompactNode], node: CompactNode, is_new: bool) \
+            -> None:
+        if not is_new:
+            NODES_COLLISIONS.inc()
+        elif len(routing_table) >= self._n_max_neighbours:
+            NODES_SKIPPED.inc()
+        else:
+            routing_table[node[0]] = node
 
     def __on_GET_PEERS_query(self, message: bencode.KRPCDict, addr: NodeAddress) -> None:  # pylint: disable=invalid-name
-        if exclude_ip(addr[0]):
+        if self.__is_excluded(addr[0]):
+            _DROPPED_EXCLUDED.inc()
             return
 
         try:
@@ -265,10 +691,12 @@ class SybilNode(asyncio.DatagramProtocol):
             info_hash = message[b"a"][b"info_hash"]
             assert type(info_hash) is bytes and len(info_hash) == 20
         except (TypeError, KeyError, AssertionError):
+            _DROPPED_MALFORMED.inc()
             return
 
-        data = self.__build_GET_PEERS_query(
-            info_hash[:15] + self.__true_id[:5], transaction_id, self.__calculate_token(addr, info_hash)
+        identity = self.__identity_of(info_hash)
+        data = self.__build_GET_PEERS_response(
+            identity.forge_id(info_hash), transaction_id, self.__calculate_token(identity, addr, info_hash)
         )
 
         # TODO:
@@ -276,10 +704,11 @@ class SybilNode(asyncio.DatagramProtocol):
         # discovery of an info hash & metadata! But there is no easy way to do this with asyncio...
         # Maybe use priority queues to prioritise certain messages and let them accumulate, and dispatch them to the
         # transport at every tick?
-        self.sendto(data, addr)
+        self.sendto(data, addr, _SENT_GET_PEERS)
 
     def __on_ANNOUNCE_PEER_query(self, message: bencode.KRPCDict, addr: NodeAddress) -> None:  # pylint: disable=invalid-name
-        if exclude_ip(addr[0]):
+        if self.__is_excluded(addr[0]):
+            _DROPPED_EXCLUDED.inc()
             return
 
         try:
@@ -300,165 +729,422 @@ class SybilNode(asyncio.DatagramProtocol):
 
             assert type(port) is int and 0 < port < 65536
         except (TypeError, KeyError, AssertionError):
+            _DROPPED_MALFORMED.inc()
             return
 
-        data = self.__build_ANNOUNCE_PEER_query(node_id[:15] + self.__true_id[:5], transaction_id)
-        self.sendto(data, addr)
+        data = self.__build_ANNOUNCE_PEER_query(self.__identity_of(info_hash).forge_id(node_id), transaction_id)
+        self.sendto(data, addr, _SENT_ANNOUNCE_PEER)
 
         if implied_port:
             peer_addr = (addr[0], addr[1])
         else:
             peer_addr = (addr[0], port)
 
-        if self._hash_stat:
-            self._hash_stat.write(b'%s:%d %s\n' % (addr[0].encode(), addr[1], base64.b32encode(info_hash)))
+        if self._hash_stat and ":" not in addr[0]:
+            self._hash_stat.append(socket.inet_aton(addr[0]), addr[1], info_hash)
+
+        if self._pressure >= PRESSURE_LOW and not self.__admit(info_hash, peer_addr):
+            return
+
+        self.__check_info_hash(info_hash, functools.partial(self.__fetcher.add_peer, info_hash, peer_addr))
+
+    def __admit(self, info_hash: InfoHash, peer_addr: PeerAddress) -> bool:
+        """ Whether the announced peer should be fetched from right away, under pressure; spills it if need be. """
+        if info_hash in self.__fetcher:
+            effective_peers_per_hash = max(1, int(self._peers_per_hash * (1 - self._pressure) / (1 - PRESSURE_LOW)))
+            if self.__fetcher.peers_of(info_hash) < effective_peers_per_hash:
+                return True
+            _SHED_PEER.inc()
+            return False
+        if self._pressure < 1:
+            return True
+
+        spill = self.__spill
+        if len(spill) == spill.maxlen:
+            _SHED_DROPPED.inc()
+        spill.append((info_hash, peer_addr))
+        _SHED_DEFERRED.inc()
+        return False
+
+    def __update_pressure(self) -> None:
+        queue_depth = self.__metadata_queue.qsize()
+        enqueued_on = self.__enqueued_on
+        # Metadata are taken off the queue in order, hence the ones that are gone are the oldest.
+        while len(enqueued_on) > queue_depth:
+            enqueued_on.popleft()
+        self._writer_lag = time.monotonic() - enqueued_on[0] if enqueued_on else 0.0
+        self._pressure = max(queue_depth / self._max_queue_depth, self._writer_lag / self._max_writer_lag)
+
+    def __drain_spill(self) -> None:
+        spill = self.__spill
+        for _ in range(min(len(spill), SPILL_DRAIN_PER_TICK)):
+            info_hash, peer_addr = spill.popleft()
+            self.__check_info_hash(info_hash, functools.partial(self.__fetcher.add_peer, info_hash, peer_addr))
+
+    def __is_excluded(self, host: str) -> bool:
+        if ":" in host:
+            try:
+                return not _is_global6(int.from_bytes(socket.inet_pton(socket.AF_INET6, host), "big"))
+            except OSError:
+                return True
+        return self._excluded.contains_str(host)
 
-        m_info_hash = base64.b32encode(info_hash)
+    def __check_info_hash(self, info_hash: InfoHash, on_new: typing.Callable[[], typing.Any]) -> None:
+        """ Calls `on_new` (maybe later) if `info_hash` is neither in memcached (if any) nor in the database. """
         if self._memcache:
-            known = self._memcache.get(m_info_hash)
-            if known:
-                self._collisions += 1
-                self._is_infohash_new(info_hash, skip_check=True)
-                return
-            self._memcache.set(m_info_hash, '1')
+            self._memcache.add(
+                base64.b32encode(info_hash), 0, functools.partial(self.__on_info_hash_checked, info_hash, on_new))
+        else:
+            self.__on_info_hash_checked(info_hash, on_new, True)
+
+    def __on_info_hash_checked(self, info_hash: InfoHash, on_new: typing.Callable[[], typing.Any], is_new: bool) \
+            -> None:
+        if not is_new:
+            INFOHASH_COLLISIONS.inc()
+            self._is_infohash_new(info_hash, skip_check=True)
+            return
 
         if not self._is_infohash_new(info_hash):
             return
 
-        # if self._memcache:
-        #     self._memcache.set(m_info_hash, '1', expire=8 * 3600)
+        on_new()
 
-        event_loop = asyncio.get_event_loop()
+    def __on_response(self, message: bencode.KRPCDict, addr: NodeAddress, transaction_id: bytes) -> bool:
+        """ Handles the response (or error) to a query we keep track of; False if it is not from the queried node. """
+        _, kind, ip, info_hash, identity = self._transactions[transaction_id]
+        try:
+            if int.from_bytes(_pack_ip(addr[0]), "big") != ip:
+                return False
+        except OSError:
+            return False
+        del self._transactions[transaction_id]
+
+        if message[b"y"] == b"e":
+            _RECEIVED_ERROR.inc()
+        if kind == _SAMPLE_INFOHASHES:
+            _RECEIVED_SAMPLE_INFOHASHES.inc()
+            self.__on_SAMPLE_INFOHASHES_response(message, addr, ip, identity)
+        elif kind == _GET_PEERS:
+            _RECEIVED_GET_PEERS_RESPONSE.inc()
+            self.__on_GET_PEERS_response(message, addr, info_hash)
+        return True
+
+    def __on_SAMPLE_INFOHASHES_response(self, message: bencode.KRPCDict, addr: NodeAddress, ip: int,  # pylint: disable=invalid-name
+                                        identity: VirtualIdentity) -> None:
+        response = message.get(b"r")
+        samples = response.get(b"samples") if isinstance(response, dict) else None
+        if type(samples) is not bytes or len(samples) % 20 != 0:
+            # Most likely an error ("204 Method Unknown"), or a find_node response from an older node.
+            _SAMPLE_RESPONSES_UNSUPPORTED.inc()
+            self.__sample_schedule[ip] = time.monotonic() + SAMPLE_UNSUPPORTED_INTERVAL
+        else:
+            _SAMPLE_RESPONSES_SUPPORTED.inc()
+            interval = response.get(b"interval")
+            if type(interval) is not int:
+                interval = SAMPLE_NO_RESPONSE_INTERVAL
+            self.__sample_schedule[ip] = \
+                time.monotonic() + min(max(interval, SAMPLE_MIN_INTERVAL), SAMPLE_MAX_INTERVAL)
+
+            add_recent_sample = RECENT_SAMPLES.add
+            for i in range(0, len(samples), 20):
+                info_hash = samples[i:i + 20]
+                if not add_recent_sample(info_hash):
+                    _SAMPLED_RECENT.inc()
+                    continue
+                _SAMPLED_NEW.inc()
+                # The sampling node has (or has had) the peers of the info hash, so ask it first.
+                self.__check_info_hash(info_hash, functools.partial(self.__lookup, info_hash, (ip, addr[1])))
+
+        # Responses carry nodes too, just like the find_node responses.
+        if _has_nodes(response):
+            self.__on_FIND_NODE_response(message, addr, identity)
+
+    def __on_GET_PEERS_response(self, message: bencode.KRPCDict, addr: NodeAddress, info_hash: InfoHash) -> None:  # pylint: disable=invalid-name
+        response = message.get(b"r")
+        values = response.get(b"values") if isinstance(response, dict) else None
+        peers = []  # type: typing.List[PeerAddress]
+        if type(values) is list:
+            inet_ntoa = socket.inet_ntoa
+            inet_ntop = socket.inet_ntop
+            excluded = self._excluded
+            for value in values:
+                if type(value) is not bytes:
+                    continue
+                if len(value) == 6:
+                    if value[4:] == b"\0\0" or excluded.contains_packed(value[:4]):
+                        continue
+                    peers.append((inet_ntoa(value[:4]), int.from_bytes(value[4:], "big")))
+                elif len(value) == 18 and self._ipv6:
+                    # BEP 32: IPv6 peers, which must be global unicast addresses (2000::/3).
+                    if value[16:] == b"\0\0" or value[0] & 0xE0 != 0x20:
+                        continue
+                    peers.append((inet_ntop(socket.AF_INET6, value[:16]), int.from_bytes(value[16:], "big")))
+
+        lookup = self.__lookups.get(info_hash)
+        if peers:
+            _GET_PEERS_PEERS.inc()
+        else:
+            _GET_PEERS_NO_PEERS.inc()
+        # The lookup is over once the metadata are fetched: late responses must not start another fetch.
+        if lookup is None:
+            return
+        if peers:
+            lookup.n_peers += len(peers)
+            self.__add_lookup_peers(info_hash, peers)
+        lookup.in_flight -= 1
+        if isinstance(response, dict):
+            nodes = response.get(b"nodes")
+            if self._ipv4 and type(nodes) is bytes and len(nodes) % 26 == 0:
+                excluded = self._excluded
+                for node_id, ip, port in self.__decode_nodes(nodes):
+                    if port != 0 and ip not in excluded:
+                        lookup.add_node(node_id, ip, port)
+            nodes6 = response.get(b"nodes6")
+            if self._ipv6 and type(nodes6) is bytes and len(nodes6) % 38 == 0:
+                for node_id, ip, port in self.__decode_nodes6(nodes6):
+                    if port != 0 and _is_global6(ip):
+                        lookup.add_node(node_id, ip, port)
+        self.__step_lookup(lookup)
+
+    def __add_lookup_peers(self, info_hash: InfoHash, peers: typing.List[PeerAddress]) -> None:
+        if self._pressure >= PRESSURE_LOW:
+            peers = [peer_addr for peer_addr in peers if self.__admit(info_hash, peer_addr)]
+            if not peers:
+                return
+        # The info hash was new when the lookup started, and the lookup ends as soon as its metadata are fetched.
+        self.__fetcher.add_peers(info_hash, peers)
 
-        # A little clarification about parent and child futures might be really useful here:
-        # For every info hash we are interested in, we create ONE parent future and save it under self.__tasks
-        # (info_hash -> task) dictionary.
-        # For EVERY DisposablePeer working to fetch the metadata of that info hash, we create a child future. Hence, for
-        # every parent future, there should be *at least* one child future.
-        #
-        # Parent and child futures are "connected" to each other through `add_done_callback` functionality:
-        #     When a child is successfully done, it sets the result of its parent (`set_result()`), and if it was
-        #   unsuccessful to fetch the metadata, it just checks whether there are any other child futures left and if not
-        #   it terminates the parent future (by setting its result to None) and quits.
-        #     When a parent future is successfully done, (through the callback) it adds the info hash to the set of
-        #   completed metadatas and puts the metadata in the queue to be committed to the database.
-
-        # create the parent future
-        if info_hash not in self.__parent_futures:
-            parent_f = event_loop.create_future()
-            # mypy ignore: because .child_count on Future is being monkey-patched here!
-            parent_f.child_count = 0  # type: ignore
-            if info_hash not in self._timers:
-                self._timers[info_hash] = -datetime.datetime.now().timestamp()
-            parent_f.add_done_callback(lambda f: self._parent_task_done(f, info_hash))
-            self.__parent_futures[info_hash] = parent_f
-
-        parent_f = self.__parent_futures[info_hash]
-
-        if parent_f.done():
+    def __lookup(self, info_hash: InfoHash, first: typing.Optional[typing.Tuple[int, int]] = None) -> None:
+        """
+        Starts looking up the peers of `info_hash` (unless it has been looked up recently), to fetch its metadata from;
+        `first` is the (IP address as an integer, port) of a node to be queried before all the others.
+        """
+        if self._pressure >= 1:
+            _SHED_LOOKUP.inc()
             return
-        # mypy ignore: because .child_count on Future is monkey-patched
-        if parent_f.child_count > self._peers_per_hash:  # type: ignore
+        if info_hash in self.__lookups:
+            return
+        # Checked before the info hash is remembered as looked up, so that a dropped lookup can be retried.
+        if len(self.__lookups) >= MAX_LOOKUPS:
+            _LOOKUPS_DROPPED.inc()
+            return
+        if not RECENT_LOOKUPS.add(info_hash):
             return
 
-        task = asyncio.ensure_future(bittorrent.fetch_metadata_from_peer(
-            info_hash, peer_addr, self.__max_metadata_size, timeout=self._peer_timeout))
-        task.add_done_callback(lambda task: self._got_child_result(parent_f, task))
-        # mypy ignore: because .child_count on Future is monkey-patched
-        parent_f.child_count += 1  # type: ignore
-        parent_f.add_done_callback(lambda f: task.cancel())
-
-    def _got_child_result(self, parent_task, child_task):
-        parent_task.child_count -= 1
-        try:
-            metadata = child_task.result()
-            # Bora asked:
-            #     Why do we check for parent_task being done here when a child got result? I mean, if parent_task is
-            #     done before, and successful, all of its childs will be terminated and this function cannot be called
-            #     anyway.
-            #
-            # --- https://github.com/boramalper/magnetico/pull/76#discussion_r119555423
-            #
-            #     Suppose two child tasks are fetching the same metadata for a parent and they finish at the same time
-            #     (or very close). The first one wakes up, sets the parent_task result which will cause the done
-            #     callback to be scheduled. The scheduler might still then chooses the second child task to run next
-            #     (why not? It's been waiting longer) before the parent has a chance to cancel it.
-            #
-            # Thus spoke Richard.
-            if metadata and not parent_task.done():
-                parent_task.set_result(metadata)
-        except asyncio.CancelledError:
-            pass
-        except Exception:
-            logging.exception("child result is exception", exc_info=False)
-        if parent_task.child_count <= 0 and not parent_task.done():
-            parent_task.set_result(None)
-
-    def _parent_task_done(self, parent_task, info_hash):
-        try:
-            metadata = parent_task.result()
-            if metadata:
-                self.__metadata_queue.put_nowait((info_hash, metadata))
-                if info_hash in self._timers:
-                    self._timers[info_hash] += datetime.datetime.now().timestamp()
-                    self._cnt['timers'] += self._timers[info_hash]
-                    self._cnt['timers_count'] += 1
-        except asyncio.CancelledError:
-            pass
-        del self.__parent_futures[info_hash]
-
-    async def __bootstrap(self) -> None:
+        lookup = GetPeersLookup(info_hash)
+        if first:
+            lookup.add_node(None, *first)
+        target = lookup.target
+        # The identity whose region the info hash is in has (most likely) the closest neighbours, but any other might
+        # have come across some too.
+        for node_id, ip, port in heapq.nsmallest(
+                LOOKUP_SEEDS,
+                itertools.chain.from_iterable(
+                    itertools.chain(identity.routing_table.values(), identity.routing_table6.values())
+                    for identity in self._identities),
+                key=lambda n: int.from_bytes(n[0], "big") ^ target):
+            lookup.add_node(node_id, ip, port)
+        self.__lookups[info_hash] = lookup
+        self.__step_lookup(lookup)
+
+    def __step_lookup(self, lookup: GetPeersLookup) -> None:
+        """ Queries the closest candidates while there is room, or finishes the lookup if there is nothing left. """
+        identity = self.__identity_of(lookup.info_hash)
+        while lookup.in_flight < LOOKUP_ALPHA and lookup.candidates and lookup.n_queries < LOOKUP_MAX_QUERIES \
+                and lookup.n_peers < LOOKUP_ENOUGH_PEERS:
+            _, ip, port = heapq.heappop(lookup.candidates)
+            transaction_id = self.__new_transaction(_GET_PEERS, ip, lookup.info_hash, identity)
+            if transaction_id is None:
+                break
+            lookup.in_flight += 1
+            lookup.n_queries += 1
+            self.sendto(
+                self.__build_GET_PEERS_query(identity.forge_id(lookup.info_hash), lookup.info_hash, transaction_id),
+                (_format_ip(ip), port),
+                _SENT_GET_PEERS_QUERY
+            )
+
+        if lookup.in_flight == 0:
+            self.__end_lookup(lookup)
+
+    def __end_lookup(self, lookup: GetPeersLookup) -> None:
+        del self.__lookups[lookup.info_hash]
+        if lookup.n_peers:
+            _LOOKUPS_PEERS.inc()
+        else:
+            _LOOKUPS_NO_PEERS.inc()
+
+    def __sample_infohashes(self) -> None:
+        now = time.monotonic()
+        schedule = self.__sample_schedule
+        if len(schedule) > MAX_SAMPLE_SCHEDULE:
+            self.__sample_schedule = schedule = {ip: t for ip, t in schedule.items() if t > now}
+            if len(schedule) > MAX_SAMPLE_SCHEDULE:
+                schedule.clear()
+
+        budget = self._samples_per_tick
+        for identity in self._identities:
+            for node_id, ip, port in itertools.chain(identity.routing_table.values(), identity.routing_table6.values()):
+                if schedule.get(ip, 0) > now:
+                    continue
+                transaction_id = self.__new_transaction(_SAMPLE_INFOHASHES, ip, None, identity)
+                if transaction_id is None:
+                    return
+                schedule[ip] = now + SAMPLE_NO_RESPONSE_INTERVAL
+                self.sendto(
+                    self.__build_SAMPLE_INFOHASHES_query(identity.forge_id(node_id), transaction_id),
+                    (_format_ip(ip), port),
+                    _SENT_SAMPLE_INFOHASHES
+                )
+                budget -= 1
+                if budget == 0:
+                    return
+
+    def __new_transaction(self, kind: int, ip: int, info_hash: typing.Optional[InfoHash], identity: VirtualIdentity) \
+            -> typing.Optional[bytes]:
+        """ Returns the ID of a new transaction, or None if there are too many of them already. """
+        if len(self._transactions) >= MAX_TRANSACTIONS:
+            return None
+        self.__next_transaction_id = (self.__next_transaction_id + 1) & 0xFFFFFFFF
+        transaction_id = self.__next_transaction_id.to_bytes(4, "big")
+        self._transactions[transaction_id] = (time.monotonic() + TRANSACTION_TIMEOUT, kind, ip, info_hash, identity)
+        return transaction_id
+
+    def __expire_transactions(self) -> None:
+        now = time.monotonic()
+        transactions = self._transactions
+        while transactions:
+            transaction_id = next(iter(transactions))
+            expires_on, kind, _, info_hash, _ = transactions[transaction_id]
+            if expires_on > now:
+                break
+            del transactions[transaction_id]
+            _TIMED_OUT[kind].inc()
+            if kind == _GET_PEERS:
+                lookup = self.__lookups.get(info_hash)
+                if lookup:
+                    lookup.in_flight -= 1
+                    self.__step_lookup(lookup)
+
+    def __on_fetch_done(self, job: fetch.FetchJob) -> None:
+        logging.debug("%r", job)
+        FETCH_BYTES_RECEIVED.inc(job.bytes_received)
+        if job.state != fetch.SUCCEEDED:
+            _FETCHES_FAILED.inc()
+            _FETCH_DURATION_FAILED.observe(job.elapsed)
+            # The peer(s) we have tried might be gone or behind a NAT; look for the others.
+            self.__lookup(job.info_hash)
+            return
+        _FETCHES_SUCCEEDED.inc()
+        _FETCH_DURATION_SUCCEEDED.observe(job.elapsed)
+        lookup = self.__lookups.get(job.info_hash)
+        if lookup is not None:
+            self.__end_lookup(lookup)
+        self.__metadata_queue.put_nowait((job.info_hash, job.metadata, job.elapsed))
+        self.__enqueued_on.append(time.monotonic())
+
+    async def __bootstrap(self, identities: typing.List[VirtualIdentity]) -> None:
         event_loop = asyncio.get_event_loop()
-        for node in BOOTSTRAPPING_NODES:
+        if self._ipv4 and self._ipv6:
+            family = socket.AF_UNSPEC
+        else:
+            family = socket.AF_INET6 if self._ipv6 else socket.AF_INET
+        for node in self._bootstrapping_nodes:
             try:
-                # AF_INET means ip4 only
-                responses = await event_loop.getaddrinfo(*node, family=socket.AF_INET)
-                for (family, type, proto, canonname, sockaddr) in responses:
-                    data = self.__build_FIND_NODE_query(self.__true_id)
-                    self.sendto(data, sockaddr)
+                responses = await event_loop.getaddrinfo(*node, family=family, type=socket.SOCK_DGRAM)
+                for (family_, type_, proto, canonname, sockaddr) in responses:
+                    for identity in identities:
+                        data = self.__build_FIND_NODE_query(
+                            identity.id, identity.target_prefix, identity.find_node_transaction_id,
+                            self._ipv4 and self._ipv6)
+                        # IPv6 socket addresses are (host, port, flow info, scope ID).
+                        self.sendto(data, sockaddr[:2], _SENT_FIND_NODE)
             except Exception:
                 logging.exception("An exception occurred during bootstrapping!")
 
     def __make_neighbours(self) -> None:
-        for node_id, addr in self._routing_table.items():
-            self._cnt['nodes'] += 1
-            if exclude_ip(addr[0]):
-                continue
-            self.sendto(self.__build_FIND_NODE_query(node_id[:15] + self.__true_id[:5]), addr)
+        # Nodes are kept with their addresses as integers (to be filtered cheaply as they are received), and converted
+        # to strings only here, once and only for the ones we actually query.
+        inet_ntoa = socket.inet_ntoa
+        inet_ntop = socket.inet_ntop
+        # Dual-stack nodes ask for the nodes of both families (BEP 32), whichever family the query is sent over.
+        want_both = self._ipv4 and self._ipv6
+        build = self.__build_FIND_NODE_query
+        for identity in self._identities:
+            forge_id, target_prefix, transaction_id = \
+                identity.forge_id, identity.target_prefix, identity.find_node_transaction_id
+            for node_id, ip, port in identity.routing_table.values():
+                self.sendto(
+                    build(forge_id(node_id), target_prefix, transaction_id, want_both),
+                    (inet_ntoa(ip.to_bytes(4, "big")), port),
+                    _SENT_FIND_NODE
+                )
+            for node_id, ip, port in identity.routing_table6.values():
+                self.sendto(
+                    build(forge_id(node_id), target_prefix, transaction_id, want_both),
+                    (inet_ntop(socket.AF_INET6, ip.to_bytes(16, "big")), port),
+                    _SENT_FIND_NODE
+                )
 
     @staticmethod
-    def __decode_nodes(infos: bytes) -> typing.List[typing.Tuple[NodeID, NodeAddress]]:
+    def __decode_nodes(infos: bytes) -> typing.List[CompactNode]:
         """ Reference Implementation:
         nodes = []
         for i in range(0, len(infos), 26):
             info = infos[i: i + 26]
             node_id = info[:20]
-            node_host = socket.inet_ntoa(info[20:24])
+            node_ip = int.from_bytes(info[20:24], "big")
             node_port = int.from_bytes(info[24:], "big")
-            nodes.append((node_id, (node_host, node_port)))
+            nodes.append((node_id, node_ip, node_port))
         return nodes
         """
         """ Optimized Version: """
-        # Because dot-access also has a cost
-        inet_ntoa = socket.inet_ntoa
-        int_from_bytes = int.from_bytes
-        return [
-            (infos[i:i+20], (inet_ntoa(infos[i+20:i+24]), int_from_bytes(infos[i+24:i+26], "big")))
-            for i in range(0, len(infos), 26)
-        ]
+        # All the nodes are unpacked in a single pass in C (`len(infos)` must be a multiple of 26); see
+        # benchmarks/decode_nodes.py for the alternatives.
+        return list(_COMPACT_NODE.iter_unpack(infos))
+
+    @staticmethod
+    def __decode_nodes6(infos: bytes) -> typing.List[CompactNode]:
+        """ `len(infos)` must be a multiple of 38 (BEP 32). """
+        return [(node_id, high << 64 | low, port) for node_id, high, low, port in _COMPACT_NODE6.iter_unpack(infos)]
 
-    def __calculate_token(self, addr: NodeAddress, info_hash: InfoHash) -> bytes:
+    @staticmethod
+    def __calculate_token(identity: VirtualIdentity, addr: NodeAddress, info_hash: InfoHash) -> bytes:
         # Believe it or not, faster than using built-in hash (including conversion from int -> bytes of course)
-        checksum = zlib.adler32(b"%s%s%d%s" % (self.__token_secret, socket.inet_aton(addr[0]), addr[1], info_hash))
+        checksum = zlib.adler32(b"%s%s%d%s" % (identity.token_secret, _pack_ip(addr[0]), addr[1], info_hash))
         return checksum.to_bytes(4, "big")
 
     @staticmethod
-    def __build_FIND_NODE_query(id_: bytes) -> bytes:  # pylint: disable=invalid-name
+    def __build_FIND_NODE_query(id_: bytes, target_prefix: bytes, transaction_id: bytes, want_both: bool = False) \
+            -> bytes:  # pylint: disable=invalid-name
         """ Reference Implementation:
         bencode.dumps({
             b"y": b"q",
             b"q": b"find_node",
-            b"t": b"aa",
+            b"t": transaction_id,
+            b"a": {
+                b"id": id_,
+                b"target": target_prefix + self.__random_bytes(20 - len(target_prefix)),
+                b"want": [b"n4", b"n6"]  # only if want_both
+            }
+        })
+        """
+        """ Optimized Version: """
+        if want_both:
+            return b"d1:ad2:id20:%s6:target20:%s%s4:wantl2:n42:n6ee1:q9:find_node1:t%d:%s1:y1:qe" % (
+                id_, target_prefix, os.urandom(20 - len(target_prefix)), len(transaction_id), transaction_id
+            )
+        return b"d1:ad2:id20:%s6:target20:%s%se1:q9:find_node1:t%d:%s1:y1:qe" % (
+            id_, target_prefix, os.urandom(20 - len(target_prefix)), len(transaction_id), transaction_id
+        )
+
+    @staticmethod
+    def __build_SAMPLE_INFOHASHES_query(id_: bytes, transaction_id: bytes) -> bytes:  # pylint: disable=invalid-name
+        """ Reference Implementation:
+        bencode.dumps({
+            b"y": b"q",
+            b"q": b"sample_infohashes",
+            b"t": transaction_id,
             b"a": {
                 b"id": id_,
                 b"target": self.__random_bytes(20)
@@ -466,22 +1152,39 @@ class SybilNode(asyncio.DatagramProtocol):
         })
         """
         """ Optimized Version: """
-        return b"d1:ad2:id20:%s6:target20:%se1:q9:find_node1:t2:aa1:y1:qe" % (
-            id_,
-            os.urandom(20)
+        return b"d1:ad2:id20:%s6:target20:%se1:q17:sample_infohashes1:t%d:%s1:y1:qe" % (
+            id_, os.urandom(20), len(transaction_id), transaction_id
+        )
+
+    @staticmethod
+    def __build_GET_PEERS_query(id_: bytes, info_hash: InfoHash, transaction_id: bytes) -> bytes:  # pylint: disable=invalid-name
+        """ Reference Implementation:
+        bencode.dumps({
+            b"y": b"q",
+            b"q": b"get_peers",
+            b"t": transaction_id,
+            b"a": {
+                b"id": id_,
+                b"info_hash": info_hash
+            }
+        })
+        """
+        """ Optimized Version: """
+        return b"d1:ad2:id20:%s9:info_hash20:%se1:q9:get_peers1:t%d:%s1:y1:qe" % (
+            id_, info_hash, len(transaction_id), transaction_id
         )
 
     @staticmethod
-    def __build_GET_PEERS_query(id_: bytes, transaction_id: bytes, token: bytes) -> bytes:  # pylint: disable=invalid-name
+    def __build_GET_PEERS_response(id_: bytes, transaction_id: bytes, token: bytes) -> bytes:  # pylint: disable=invalid-name
         """ Reference Implementation:
 
         bencode.dumps({
             b"y": b"r",
             b"t": transaction_id,
             b"r": {
-                b"id": info_hash[:15] + self.__true_id[:5],
+                b"id": identity.forge_id(info_hash),
                 b"nodes": b"",
-                b"token": self.__calculate_token(addr, info_hash)
+                b"token": self.__calculate_token(identity, addr, info_hash)
             }
         })
         """
@@ -498,7 +1201,7 @@ class SybilNode(asyncio.DatagramProtocol):
             b"y": b"r",
             b"t": transaction_id,
             b"r": {
-                b"id": node_id[:15] + self.__true_id[:5]
+                b"id": identity.forge_id(node_id)
             }
         })
         """
@@ -0,0 +1,246 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Bulk export of the torrents and their files (`magneticod export`).
+
+The ids of the torrents up to the last one at the start of the export are split into as many ranges as there are
+processes, and every process walks its range in chunks (`WHERE id > last ORDER BY id LIMIT chunk_size`), merging the
+torrents of a chunk with their files as both are streamed in the order of the torrents; hence the memory used does not
+depend on the size of the database. Torrents are written to files of up to `rows_per_file` torrents each, named after
+the first id of their range:
+
+    jsonl    torrents.<id>.<n>.jsonl.gz, a JSON object per line:
+             {"id": ..., "info_hash": "<hex>", "name": ..., "total_size": ..., "discovered_on": ...,
+              "files": [{"path": ..., "size": ...}, ...]}
+    parquet  torrents.<id>.<n>.parquet (needs the pyarrow package), the same columns (info hashes as 20 bytes
+             binaries), zstd compressed, a row group per chunk
+
+Files are written under a temporary name and renamed once they are complete. Finally, `manifest.json` records the last
+id exported; passing it as `since_id` to the next export exports only the torrents added since.
+"""
+import concurrent.futures
+import datetime
+import gzip
+import json
+import logging
+import os
+import time
+import typing
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from . import filelist
+from .models import File, Torrent
+
+FORMATS = ("jsonl", "parquet")
+MANIFEST = "manifest.json"
+
+# (id, info hash, name, total size, discovered on, files)
+Row = typing.Tuple[int, bytes, str, int, int, typing.List[filelist.File]]
+
+
+class JsonlWriter:
+    extension = ".jsonl.gz"
+
+    def __init__(self, path: str) -> None:
+        self.__file = gzip.open(path, "wt", encoding="utf-8", compresslevel=6)
+
+    def write(self, rows: typing.List[Row]) -> None:
+        for torrent_id, info_hash, name, total_size, discovered_on, files in rows:
+            self.__file.write(json.dumps({
+                "id": torrent_id,
+                "info_hash": info_hash.hex(),
+                "name": name,
+                "total_size": total_size,
+                "discovered_on": discovered_on,
+                "files": [{"path": path, "size": size} for path, size in files]
+            }, ensure_ascii=False))
+            self.__file.write("\n")
+
+    def close(self) -> None:
+        self.__file.close()
+
+
+class ParquetWriter:
+    extension = ".parquet"
+
+    def __init__(self, path: str) -> None:
+        self.__schema = pyarrow.schema([
+            ("id", pyarrow.int64()),
+            ("info_hash", pyarrow.binary(20)),
+            ("name", pyarrow.string()),
+            ("total_size", pyarrow.int64()),
+            ("discovered_on", pyarrow.int64()),
+            ("files", pyarrow.list_(pyarrow.struct([("path", pyarrow.string()), ("size", pyarrow.int64())]))),
+        ])
+        self.__writer = pyarrow.parquet.ParquetWriter(path, self.__schema, compression="zstd")
+
+    def write(self, rows: typing.List[Row]) -> None:
+        columns = list(zip(*rows))
+        self.__writer.write_table(pyarrow.Table.from_arrays([
+            pyarrow.array(columns[0], pyarrow.int64()),
+            pyarrow.array(columns[1], pyarrow.binary(20)),
+            pyarrow.array(columns[2], pyarrow.string()),
+            pyarrow.array(columns[3], pyarrow.int64()),
+            pyarrow.array(columns[4], pyarrow.int64()),
+            pyarrow.array([[{"path": path, "size": size} for path, size in files] for files in columns[5]],
+                          self.__schema.field("files").type),
+        ], schema=self.__schema))
+
+    def close(self) -> None:
+        self.__writer.close()
+
+
+WRITERS = {"jsonl": JsonlWriter, "parquet": ParquetWriter}
+
+
+def _chunks(after_id: int, until_id: int, since: typing.Optional[int], chunk_size: int, files_table: bool) \
+        -> typing.Iterator[typing.List[Row]]:
+    """ Yields the torrents with ids in (after_id, until_id] (discovered on or after `since`, if given), by chunks. """
+    last_id = after_id
+    while True:
+        query = Torrent.select(Torrent.id, Torrent.info_hash, Torrent.name, Torrent.total_size,
+                               Torrent.discovered_on, Torrent.file_list) \
+            .where((Torrent.id > last_id) & (Torrent.id <= until_id))
+        if since is not None:
+            query = query.where(Torrent.discovered_on >= since)
+        torrents = list(query.order_by(Torrent.id).limit(chunk_size).tuples())
+        if not torrents:
+            return
+        last_id = torrents[-1][0]
+
+        # A range rather than a list of ids, which could have more variables than SQLite allows.
+        files = iter(())  # type: typing.Iterator[typing.Tuple[int, str, int]]
+        if files_table:
+            files = File.select(File.torrent, File.path, File.size) \
+                .where((File.torrent >= torrents[0][0]) & (File.torrent <= last_id)) \
+                .order_by(File.torrent, File.id) \
+                .tuples() \
+                .iterator()
+        yield list(_merge(torrents, files))
+
+
+def _merge(torrents: typing.List[typing.Tuple], files: typing.Iterator[typing.Tuple[int, str, int]]) \
+        -> typing.Iterator[Row]:
+    """ Merges the torrents with their files, both in the order of the ids of the torrents. """
+    file = next(files, None)
+    for torrent_id, info_hash, name, total_size, discovered_on, file_list in torrents:
+        if file_list is not None:
+            torrent_files = list(filelist.iter_files(bytes(file_list)))
+        else:
+            torrent_files = []
+        while file is not None and file[0] <= torrent_id:
+            if file[0] == torrent_id:
+                torrent_files.append((file[1], file[2]))
+            file = next(files, None)
+        yield torrent_id, bytes(info_hash), name, total_size, discovered_on, torrent_files
+
+
+def _initialize(database: str) -> None:
+    # Every process has a connection of its own.
+    from . import persistence
+    persistence.Database(database)
+
+
+def _export_range(directory: str, format_: str, after_id: int, until_id: int, since: typing.Optional[int],
+                  rows_per_file: int, chunk_size: int) -> typing.Tuple[int, typing.List[str]]:
+    """ Exports the torrents with ids in (after_id, until_id], and returns their number and the files written. """
+    files_table = File.table_exists()
+    writer_class = WRITERS[format_]
+    paths = []  # type: typing.List[str]
+    writer = None
+    n = n_in_file = 0
+    started_on = reported_on = time.monotonic()
+    try:
+        for rows in _chunks(after_id, until_id, since, chunk_size, files_table):
+            if writer and n_in_file + len(rows) > rows_per_file:
+                writer.close()
+                os.rename(paths[-1] + ".tmp", paths[-1])
+                writer = None
+            if writer is None:
+                paths.append(os.path.join(directory, "torrents.%012d.%04d%s" % (
+                    after_id + 1, len(paths), writer_class.extension)))
+                writer = writer_class(paths[-1] + ".tmp")
+                n_in_file = 0
+            writer.write(rows)
+            n += len(rows)
+            n_in_file += len(rows)
+
+            now = time.monotonic()
+            if now - reported_on >= 10:
+                logging.info("Export: %d torrents of (%d, %d] in total (%.0f/s), at torrent #%d.",
+                             n, after_id, until_id, n / (now - started_on), rows[-1][0])
+                reported_on = now
+    finally:
+        if writer:
+            writer.close()
+    if paths:
+        os.rename(paths[-1] + ".tmp", paths[-1])
+    return n, [os.path.basename(path) for path in paths]
+
+
+def export(database: str, directory: str, format_: str = "jsonl", n_processes: int = 1, since_id: int = 0,
+           since: typing.Optional[int] = None, rows_per_file: int = 1000000, chunk_size: int = 10000) -> int:
+    """
+    Exports the torrents with ids greater than `since_id` (and discovered on or after `since`, if given) to
+    `directory`, and returns their number.
+    """
+    if format_ not in WRITERS:
+        raise ValueError("unknown format %r (must be one of %s)" % (format_, ", ".join(FORMATS)))
+    if format_ == "parquet" and pyarrow is None:
+        raise ValueError("parquet needs the pyarrow package (pip install pyarrow)")
+    os.makedirs(directory, exist_ok=True)
+
+    # Torrents added during the export are left for the next one.
+    until_id = Torrent.select(Torrent.id).order_by(Torrent.id.desc()).limit(1).scalar() or since_id
+    span = max(until_id - since_id, 0)
+    bounds = sorted({since_id + span * i // n_processes for i in range(n_processes)} | {until_id})
+    ranges = list(zip(bounds, bounds[1:]))
+
+    started_on = time.monotonic()
+    n = 0
+    paths = []  # type: typing.List[str]
+    with concurrent.futures.ProcessPoolExecutor(n_processes, initializer=_initialize, initargs=(database,)) \
+            as executor:
+        futures = [
+            executor.submit(_export_range, directory, format_, after_id, range_until_id, since, rows_per_file,
+                            chunk_size)
+            for after_id, range_until_id in ranges
+        ]
+        for future in futures:
+            range_n, range_paths = future.result()
+            n += range_n
+            paths += range_paths
+
+    with open(os.path.join(directory, MANIFEST + ".tmp"), "w") as file:
+        json.dump({
+            "format": format_,
+            "since_id": since_id,
+            "since": since,
+            "last_id": until_id,
+            "torrents": n,
+            "files": paths,
+            "exported_on": int(datetime.datetime.now().timestamp())
+        }, file, indent=2)
+    os.rename(os.path.join(directory, MANIFEST + ".tmp"), os.path.join(directory, MANIFEST))
+
+    duration = time.monotonic() - started_on
+    logging.info("Export: %d torrents (up to #%d) are exported to %d files in %.1fs (%.0f/s).",
+                 n, until_id, len(paths), duration, n / duration if duration else 0)
+    return n
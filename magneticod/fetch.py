@@ -0,0 +1,179 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+import asyncio
+import functools
+import logging
+import time
+import typing
+
+from . import bittorrent
+
+InfoHash = bytes
+PeerAddress = typing.Tuple[str, int]
+
+# States of a FetchJob. A job is created RUNNING and makes exactly one transition to one of the final states.
+RUNNING = 0
+SUCCEEDED = 1
+FAILED = 2
+CANCELLED = 3
+
+STATE_NAMES = ("running", "succeeded", "failed", "cancelled")
+
+
+class FetchJob:
+    """
+    Fetch state of a single info hash.
+
+    Every peer we try to fetch the metadata from runs as a *child* task of the job. The job succeeds as soon as one of
+    its children returns a verified metadata, and fails once all of its children have returned nothing.
+    """
+    __slots__ = ("info_hash", "state", "started_on", "finished_on", "peers_tried", "peers_failed", "bytes_received",
+                 "metadata", "children")
+
+    def __init__(self, info_hash: InfoHash) -> None:
+        self.info_hash = info_hash
+        self.state = RUNNING
+        self.started_on = time.monotonic()
+        self.finished_on = 0.0
+        self.peers_tried = 0
+        self.peers_failed = 0
+        # Amount of metadata bytes received from *all* peers, including the ones that failed or lied to us.
+        self.bytes_received = 0
+        self.metadata = None  # type: typing.Optional[bytes]
+        self.children = set()  # type: typing.Set[asyncio.Future]
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_on or time.monotonic()) - self.started_on
+
+    def __repr__(self) -> str:
+        return "<FetchJob %s %s tried=%d failed=%d active=%d bytes=%d elapsed=%.2f>" % (
+            self.info_hash.hex(), STATE_NAMES[self.state], self.peers_tried, self.peers_failed, len(self.children),
+            self.bytes_received, self.elapsed
+        )
+
+
+class FetchEngine:
+    """
+    Orchestrates metadata fetching for all the info hashes of a SybilNode.
+
+    `on_done` is called with the FetchJob once it has SUCCEEDED or FAILED; cancelled jobs are dropped silently.
+    """
+    def __init__(self, max_metadata_size: int, peer_timeout: typing.Optional[float], peers_per_hash: int,
+                 on_done: typing.Callable[[FetchJob], None]) -> None:
+        self.__max_metadata_size = max_metadata_size
+        self.__peer_timeout = peer_timeout
+        self.__peers_per_hash = peers_per_hash
+        self.__on_done = on_done
+        self.__jobs = {}  # type: typing.Dict[InfoHash, FetchJob]
+        # Number of child tasks (i.e. peers being fetched from) across all jobs.
+        self.n_active = 0
+
+    def __len__(self) -> int:
+        return len(self.__jobs)
+
+    def __contains__(self, info_hash: InfoHash) -> bool:
+        return info_hash in self.__jobs
+
+    def peers_of(self, info_hash: InfoHash) -> int:
+        """ Number of peers the metadata of `info_hash` is being fetched from. """
+        job = self.__jobs.get(info_hash)
+        return len(job.children) if job else 0
+
+    def add_peer(self, info_hash: InfoHash, peer_addr: PeerAddress) -> bool:
+        """
+        Starts fetching the metadata of `info_hash` from `peer_addr`, creating a new job if there is none.
+
+        Returns False if the peer is not tried because the job has reached the maximum number of active peers.
+        """
+        job = self.__jobs.get(info_hash)
+        if job is None:
+            job = FetchJob(info_hash)
+            self.__jobs[info_hash] = job
+        elif len(job.children) > self.__peers_per_hash:
+            return False
+
+        child = asyncio.ensure_future(self.__fetch(job, peer_addr))
+        child.add_done_callback(functools.partial(self.__on_child_done, job))
+        job.children.add(child)
+        job.peers_tried += 1
+        self.n_active += 1
+        return True
+
+    def add_peers(self, info_hash: InfoHash, peers: typing.List[PeerAddress]) -> bool:
+        added = False
+        for peer_addr in peers:
+            added = self.add_peer(info_hash, peer_addr) or added
+        return added
+
+    def cancel(self, info_hash: InfoHash) -> None:
+        job = self.__jobs.get(info_hash)
+        if job is not None:
+            self.__finish(job, CANCELLED)
+
+    def shutdown(self) -> None:
+        for job in list(self.__jobs.values()):
+            self.__finish(job, CANCELLED)
+
+    async def __fetch(self, job: FetchJob, peer_addr: PeerAddress) -> typing.Optional[bytes]:
+        peer = bittorrent.DisposablePeer(job.info_hash, peer_addr, self.__max_metadata_size)
+        try:
+            return await asyncio.wait_for(peer.run(), timeout=self.__peer_timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            job.bytes_received += peer.metadata_received
+
+    def __on_child_done(self, job: FetchJob, child: asyncio.Future) -> None:
+        # The child might have been already discarded (and counted) by __finish if the job is not RUNNING anymore.
+        if child not in job.children:
+            return
+        job.children.discard(child)
+        self.n_active -= 1
+
+        metadata = None
+        if not child.cancelled():
+            try:
+                metadata = child.result()
+            except Exception:
+                logging.exception("child result is exception", exc_info=False)
+
+        # Two children might finish (nearly) at the same time, so the job might have succeeded already; see
+        # https://github.com/boramalper/magnetico/pull/76#discussion_r119555423
+        if job.state != RUNNING:
+            return
+
+        if metadata:
+            job.metadata = metadata
+            self.__finish(job, SUCCEEDED)
+        else:
+            job.peers_failed += 1
+            if not job.children:
+                self.__finish(job, FAILED)
+
+    def __finish(self, job: FetchJob, state: int) -> None:
+        assert job.state == RUNNING, "FetchJob %r cannot transition to %s" % (job, STATE_NAMES[state])
+        job.state = state
+        job.finished_on = time.monotonic()
+        del self.__jobs[job.info_hash]
+
+        # Cancel the remaining children; their done callbacks will find themselves discarded and return immediately.
+        self.n_active -= len(job.children)
+        for child in job.children:
+            child.cancel()
+        job.children.clear()
+
+        if state != CANCELLED:
+            self.__on_done(job)
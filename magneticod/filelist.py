@@ -0,0 +1,134 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Compact file lists (`--file-storage blob`): the files of a torrent are stored as a single blob in the `file_list` column
+of its row, instead of as one row (with its full path, a foreign key and an index entry) per file in the `files` table.
+
+A blob is a version byte followed by a zlib stream of records, one per file in the order of the metadata:
+
+    shared (varint)  length of the prefix the path shares with the previous one, in bytes of UTF-8
+    length (varint)  length of the rest of the path, in bytes of UTF-8
+    suffix           rest of the path
+    size (varint)    size of the file
+
+Varints are unsigned LEB128. Paths of the same torrent tend to share long prefixes (e.g. their directories), which
+front coding removes before zlib sees them.
+"""
+import typing
+import zlib
+
+VERSION = 1
+_VERSION_BYTE = bytes([VERSION])
+# Compressed bytes decompressed at once by iter_files()
+_CHUNK_SIZE = 16 * 1024
+
+File = typing.Tuple[str, int]  # path, size
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def encode(files: typing.Iterable[File]) -> bytes:
+    records = bytearray()
+    previous = b""
+    for path, size in files:
+        if size < 0:
+            raise ValueError("negative size %d of %r" % (size, path))
+        path_bytes = path.encode("utf-8")
+        limit = min(len(previous), len(path_bytes))
+        shared = 0
+        while shared < limit and previous[shared] == path_bytes[shared]:
+            shared += 1
+        records += _varint(shared)
+        records += _varint(len(path_bytes) - shared)
+        records += path_bytes[shared:]
+        records += _varint(size)
+        previous = path_bytes
+    return _VERSION_BYTE + zlib.compress(bytes(records), 9)
+
+
+def iter_files(blob: bytes) -> typing.Iterator[File]:
+    """ Yields the (path, size) of the files in `blob` lazily, decompressing it a chunk at a time. """
+    blob = memoryview(blob)
+    if not blob or blob[0] != VERSION:
+        raise ValueError("not a file list (or of an unknown version)")
+
+    decompressor = zlib.decompressobj()
+    compressed = blob[1:]
+    buffer = bytearray()
+    position = 0
+    previous = b""
+
+    def fill() -> bool:
+        """ Decompresses some more into the buffer (dropping what has been parsed); False if there is no more. """
+        nonlocal compressed, buffer, position
+        del buffer[:position]
+        position = 0
+        if decompressor.unconsumed_tail:
+            buffer += decompressor.decompress(decompressor.unconsumed_tail, _CHUNK_SIZE)
+            return True
+        if compressed:
+            buffer += decompressor.decompress(compressed[:_CHUNK_SIZE], _CHUNK_SIZE)
+            compressed = compressed[_CHUNK_SIZE:]
+            return True
+        return False
+
+    def read_varint() -> int:
+        nonlocal position
+        n = shift = 0
+        while True:
+            while position >= len(buffer):
+                if not fill():
+                    raise ValueError("truncated file list")
+            byte = buffer[position]
+            position += 1
+            n |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return n
+            shift += 7
+
+    def read(length: int) -> bytes:
+        nonlocal position
+        while position + length > len(buffer):
+            if not fill():
+                raise ValueError("truncated file list")
+        data = bytes(buffer[position:position + length])
+        position += length
+        return data
+
+    while True:
+        while position >= len(buffer):
+            if not fill():
+                return
+        shared = read_varint()
+        path = previous[:shared] + read(read_varint())
+        yield path.decode("utf-8"), read_varint()
+        previous = path
+
+
+def files_of(torrent: typing.Any) -> typing.Iterator[File]:
+    """ Yields the (path, size) of the files of a Torrent, whichever way they are stored. """
+    if torrent.file_list is not None:
+        return iter_files(bytes(torrent.file_list))
+    from .models import File as FileModel
+    return ((path, size) for path, size in
+            FileModel.select(FileModel.path, FileModel.size).where(FileModel.torrent == torrent.id)
+            .order_by(FileModel.id).tuples())
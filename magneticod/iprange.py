@@ -0,0 +1,103 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Sets of IPv4 address ranges, for excluding networks (`constants.EXCLUDE` and `--blocklist`) from the crawl.
+"""
+import bisect
+import ipaddress
+import socket
+import typing
+
+Range = typing.Tuple[int, int]  # first and last addresses (inclusive), as integers
+
+
+class IPv4RangeSet:
+    """
+    Ranges are merged (overlapping and adjacent ones into one) and kept as two sorted lists of their first and last
+    addresses, so a lookup is a single binary search (~20 steps for a million ranges) in C.
+    """
+    def __init__(self, ranges: typing.Iterable[Range] = ()) -> None:
+        self.__firsts = []  # type: typing.List[int]
+        self.__lasts = []  # type: typing.List[int]
+        for first, last in sorted(ranges):
+            if self.__lasts and first <= self.__lasts[-1] + 1:
+                self.__lasts[-1] = max(self.__lasts[-1], last)
+            else:
+                self.__firsts.append(first)
+                self.__lasts.append(last)
+
+    @classmethod
+    def parse(cls, lines: typing.Iterable[str]) -> "IPv4RangeSet":
+        """
+        Accepts one range per line, as a CIDR (`10.0.0.0/8`), a single address, or a range (`1.2.3.4-1.2.3.9`)
+        optionally prefixed with a description (`description:1.2.3.4-1.2.3.9`, as in the P2P blocklists). Empty lines,
+        comments (lines starting with #, or whatever follows a # after the range) and IPv6 ranges are skipped; anything
+        else raises ValueError.
+        """
+        ranges = []  # type: typing.List[Range]
+        for lineno, line in enumerate(lines, 1):
+            line = line.strip()
+            if line.startswith("#"):
+                continue
+            # Whatever is before the last colon is a description (which might contain a #, hence split off first); an
+            # IPv6 range has no dots after its last colon.
+            line = line.rpartition(":")[2].split("#", 1)[0].strip()
+            if "." not in line:
+                continue
+            try:
+                if "/" in line:
+                    network = ipaddress.IPv4Network(line, strict=False)
+                    ranges.append((int(network.network_address), int(network.broadcast_address)))
+                elif "-" in line:
+                    first, last = line.split("-")
+                    ranges.append((_to_int(first.strip()), _to_int(last.strip())))
+                else:
+                    ip = _to_int(line)
+                    ranges.append((ip, ip))
+            except (OSError, ValueError):
+                raise ValueError("line %d: %r is not an IPv4 address range" % (lineno, line))
+        return cls(ranges)
+
+    @classmethod
+    def load(cls, lines: typing.Iterable[str], paths: typing.Iterable[str] = ()) -> "IPv4RangeSet":
+        """ Ranges of `lines`, and of the files at `paths` in the format of `parse`. """
+        lines = list(lines)
+        for path in paths:
+            with open(path, encoding="utf-8", errors="replace") as file:
+                lines.extend(file)
+        return cls.parse(lines)
+
+    def __len__(self) -> int:
+        """ Number of (merged) ranges. """
+        return len(self.__firsts)
+
+    def __contains__(self, ip: int) -> bool:
+        i = bisect.bisect_right(self.__firsts, ip) - 1
+        return i >= 0 and ip <= self.__lasts[i]
+
+    def contains_packed(self, ip: bytes) -> bool:
+        """ `ip` is a packed (4 bytes) IPv4 address. """
+        return int.from_bytes(ip, "big") in self
+
+    def contains_str(self, ip: str) -> bool:
+        """ `ip` is a dotted IPv4 address; anything else (e.g. an IPv6 address) is never contained. """
+        try:
+            return int.from_bytes(socket.inet_aton(ip), "big") in self
+        except OSError:
+            return False
+
+
+def _to_int(ip: str) -> int:
+    return int(ipaddress.IPv4Address(ip))
@@ -0,0 +1,176 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Non-blocking memcached client for the deduplication of nodes and info hashes.
+
+The only operation is `add(key, ttl, callback)`, which stores the key unless it exists already (memcached's `add`
+command, i.e. a get-and-set in a single round trip) and calls `callback(True)` if it is new, `callback(False)` if it
+is known. Keys added (or found) recently are remembered in a local LRU, and answered without asking memcached at all.
+
+Requests are queued and sent at most once per event loop iteration, pipelined over one of the connections of the pool
+in turn (skipping the ones that are down); the replies are matched to the callbacks in order. Whenever memcached cannot
+answer (no connection is up with room for the requests) the keys are assumed to be new, as they would be without
+memcached.
+"""
+import asyncio
+import collections
+import logging
+import math
+import time
+import typing
+
+from . import metrics
+
+ADDS = metrics.counter("magneticod_memcached_adds_total", "Keys checked against memcached, by result.", ["result"])
+_ADDS_NEW = ADDS.labels("new")
+_ADDS_KNOWN = ADDS.labels("known")
+_ADDS_CACHED = ADDS.labels("cached")
+_ADDS_FAILED = ADDS.labels("failed")
+BATCH_SIZE = metrics.histogram(
+    "magneticod_memcached_batch_size", "Number of requests pipelined at once.",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000))
+
+Callback = typing.Callable[[bool], None]
+
+
+class _Connection:
+    __slots__ = ("writer", "callbacks", "task")
+
+    def __init__(self) -> None:
+        self.writer = None  # type: typing.Optional[asyncio.StreamWriter]
+        # (key, ttl, callback) of the requests sent, in order, waiting for their replies
+        self.callbacks = collections.deque()  # type: typing.Deque[typing.Tuple[bytes, int, Callback]]
+        self.task = None  # type: typing.Optional[asyncio.Task]
+
+
+class MemcachedClient:
+    def __init__(self, host: str, port: int, n_connections: int = 4, lru_size: int = 1 << 20,
+                 max_in_flight: int = 100000, reconnect_interval: float = 1.0) -> None:
+        self.__host = host
+        self.__port = port
+        self.__lru_size = lru_size
+        self.__max_in_flight = max_in_flight
+        self.__reconnect_interval = reconnect_interval
+
+        self.__connections = [_Connection() for _ in range(n_connections)]
+        self.__next = 0
+        self.__queue = []  # type: typing.List[typing.Tuple[bytes, int, Callback]]
+        self.__flush_handle = None  # type: typing.Optional[asyncio.Handle]
+        # key -> time.monotonic() until when it is known to exist in memcached
+        self.__lru = collections.OrderedDict()  # type: typing.MutableMapping[bytes, float]
+        self.__closing = False
+
+    async def start(self) -> None:
+        for connection in self.__connections:
+            await self.__connect(connection)
+
+    def add(self, key: bytes, ttl: int, callback: Callback) -> None:
+        """ `ttl` is in seconds, 0 for never. `callback` might be called before `add` returns. """
+        expires_on = self.__lru.get(key)
+        if expires_on is not None:
+            if expires_on > time.monotonic():
+                self.__lru.move_to_end(key)  # type: ignore
+                _ADDS_CACHED.inc()
+                callback(False)
+                return
+            del self.__lru[key]
+
+        self.__queue.append((key, ttl, callback))
+        if self.__flush_handle is None:
+            self.__flush_handle = asyncio.get_event_loop().call_soon(self.__flush)
+
+    async def close(self) -> None:
+        self.__closing = True
+        if self.__flush_handle:
+            self.__flush_handle.cancel()
+            self.__flush()
+        for connection in self.__connections:
+            if connection.task:
+                connection.task.cancel()
+            if connection.writer:
+                connection.writer.close()
+            self.__fail(connection)
+
+    def __flush(self) -> None:
+        self.__flush_handle = None
+        queue, self.__queue = self.__queue, []
+
+        n_connections = len(self.__connections)
+        for i in range(n_connections):
+            connection = self.__connections[(self.__next + i) % n_connections]
+            if connection.writer is not None and len(connection.callbacks) + len(queue) <= self.__max_in_flight:
+                self.__next = (self.__next + i + 1) % n_connections
+                break
+        else:
+            _ADDS_FAILED.inc(len(queue))
+            for _, _, callback in queue:
+                callback(True)
+            return
+
+        BATCH_SIZE.observe(len(queue))
+        connection.writer.write(b"".join(b"add %s 0 %d 1\r\n1\r\n" % (key, ttl) for key, ttl, _ in queue))
+        connection.callbacks.extend(queue)
+
+    async def __connect(self, connection: _Connection) -> None:
+        try:
+            reader, connection.writer = await asyncio.open_connection(self.__host, self.__port)
+        except OSError:
+            logging.exception("Could NOT connect to memcached at %s:%d!", self.__host, self.__port, exc_info=False)
+            connection.task = asyncio.get_event_loop().create_task(self.__reconnect(connection))
+            return
+        connection.task = asyncio.get_event_loop().create_task(self.__read_replies(connection, reader))
+
+    async def __reconnect(self, connection: _Connection) -> None:
+        await asyncio.sleep(self.__reconnect_interval)
+        if not self.__closing:
+            await self.__connect(connection)
+
+    async def __read_replies(self, connection: _Connection, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.endswith(b"\r\n"):
+                    raise ConnectionError("connection to memcached is lost")
+                key, ttl, callback = connection.callbacks.popleft()
+                if line == b"STORED\r\n":
+                    _ADDS_NEW.inc()
+                    self.__remember(key, ttl)
+                    callback(True)
+                elif line == b"NOT_STORED\r\n":
+                    _ADDS_KNOWN.inc()
+                    self.__remember(key, ttl)
+                    callback(False)
+                else:  # SERVER_ERROR, CLIENT_ERROR, ...
+                    _ADDS_FAILED.inc()
+                    callback(True)
+        except (OSError, IndexError):
+            logging.exception("Memcached connection error!", exc_info=False)
+            connection.writer.close()
+            connection.writer = None
+            self.__fail(connection)
+            if not self.__closing:
+                connection.task = asyncio.get_event_loop().create_task(self.__reconnect(connection))
+
+    def __fail(self, connection: _Connection) -> None:
+        _ADDS_FAILED.inc(len(connection.callbacks))
+        callbacks, connection.callbacks = connection.callbacks, collections.deque()
+        for _, _, callback in callbacks:
+            callback(True)
+
+    def __remember(self, key: bytes, ttl: int) -> None:
+        # For a known key, we do not know when it expires in memcached; `ttl` is an upper bound.
+        self.__lru[key] = time.monotonic() + ttl if ttl else math.inf
+        if len(self.__lru) > self.__lru_size:
+            self.__lru.popitem(last=False)  # type: ignore
@@ -0,0 +1,217 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Process-wide metrics registry, exposed over HTTP in the Prometheus text format.
+
+Metrics are shared by all the nodes of the process, so they are always aggregated across all ports. Counters are
+monotonic and never reset; compute rates on the scraping side.
+
+Metrics without labels are returned as bare Counter/Gauge/Histogram objects; for the labelled ones, hot paths should
+bind the labels once, at import time:
+
+    PACKETS_RECEIVED = metrics.counter("magneticod_packets_received_total", "...", ["type"])
+    _RECEIVED_GET_PEERS = PACKETS_RECEIVED.labels("get_peers")
+    ...
+    _RECEIVED_GET_PEERS.inc()
+"""
+import asyncio
+import bisect
+import logging
+import math
+import typing
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, n: float = 1) -> None:
+        self.value += n
+
+    def samples(self, name: str, labels: str) -> typing.Iterator[str]:
+        yield "%s%s %s" % (name, labels, _format_value(self.value))
+
+
+class Gauge:
+    __slots__ = ("value", "function")
+
+    def __init__(self) -> None:
+        self.value = 0
+        self.function = None  # type: typing.Optional[typing.Callable[[], float]]
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, n: float = 1) -> None:
+        self.value += n
+
+    def dec(self, n: float = 1) -> None:
+        self.value -= n
+
+    def set_function(self, function: typing.Callable[[], float]) -> None:
+        """ The value of the gauge will be computed by calling `function` at every scrape. """
+        self.function = function
+
+    def samples(self, name: str, labels: str) -> typing.Iterator[str]:
+        yield "%s%s %s" % (name, labels, _format_value(self.function() if self.function else self.value))
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: typing.Sequence[float]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is the +Inf bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name: str, labels: str) -> typing.Iterator[str]:
+        # `labels` is either empty or "{...}", and we need to add the `le` label to it.
+        prefix = labels[:-1] + "," if labels else "{"
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield '%s_bucket%sle="%s"} %d' % (name, prefix, _format_value(bound), cumulative)
+        yield '%s_bucket%sle="+Inf"} %d' % (name, prefix, self.count)
+        yield "%s_sum%s %s" % (name, labels, _format_value(self.sum))
+        yield "%s_count%s %d" % (name, labels, self.count)
+
+
+class Family:
+    """
+    A metric with its labelled children.
+    """
+    def __init__(self, name: str, help_: str, type_: str, label_names: typing.Sequence[str],
+                 factory: typing.Callable[[], typing.Any]) -> None:
+        self.name = name
+        self.help = help_
+        self.type = type_
+        self.label_names = tuple(label_names)
+        self.__factory = factory
+        self.__children = {}  # type: typing.Dict[typing.Tuple[str, ...], typing.Any]
+
+    def labels(self, *values: str) -> typing.Any:
+        assert len(values) == len(self.label_names), "%s expects labels %s" % (self.name, self.label_names)
+        child = self.__children.get(values)
+        if child is None:
+            child = self.__children[values] = self.__factory()
+        return child
+
+    def children(self) -> typing.List[typing.Any]:
+        return list(self.__children.values())
+
+    def render(self) -> typing.Iterator[str]:
+        yield "# HELP %s %s" % (self.name, self.help.replace("\\", r"\\").replace("\n", r"\n"))
+        yield "# TYPE %s %s" % (self.name, self.type)
+        for values, child in sorted(self.__children.items()):
+            if values:
+                labels = "{%s}" % ",".join(
+                    '%s="%s"' % (k, v.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+                    for k, v in zip(self.label_names, values)
+                )
+            else:
+                labels = ""
+            yield from child.samples(self.name, labels)
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.__families = {}  # type: typing.Dict[str, Family]
+
+    def register(self, family: Family) -> Family:
+        assert family.name not in self.__families, "Duplicate metric %s" % (family.name,)
+        self.__families[family.name] = family
+        return family
+
+    def render(self) -> str:
+        lines = []  # type: typing.List[str]
+        for family in self.__families.values():
+            try:
+                lines.extend(family.render())
+            except Exception:
+                logging.exception("Could NOT render metric %s!", family.name)
+        lines.append("")
+        return "\n".join(lines)
+
+
+REGISTRY = Registry()
+
+# Default buckets (in seconds) for latency histograms.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def counter(name: str, help_: str, label_names: typing.Sequence[str] = (), registry: Registry = REGISTRY) \
+        -> typing.Any:
+    return _register(registry, Family(name, help_, "counter", label_names, Counter))
+
+
+def gauge(name: str, help_: str, label_names: typing.Sequence[str] = (), registry: Registry = REGISTRY) -> typing.Any:
+    return _register(registry, Family(name, help_, "gauge", label_names, Gauge))
+
+
+def histogram(name: str, help_: str, label_names: typing.Sequence[str] = (),
+              buckets: typing.Sequence[float] = DEFAULT_BUCKETS, registry: Registry = REGISTRY) -> typing.Any:
+    buckets = tuple(sorted(buckets))
+    return _register(registry, Family(name, help_, "histogram", label_names, lambda: Histogram(buckets)))
+
+
+def _register(registry: Registry, family: Family) -> typing.Any:
+    registry.register(family)
+    return family if family.label_names else family.labels()
+
+
+def _format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+async def serve(host: str, port: int, registry: Registry = REGISTRY) -> asyncio.AbstractServer:
+    """ Starts serving `registry` at http://host:port/metrics """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+            # Skip the headers; we are not interested in any of them.
+            while (await asyncio.wait_for(reader.readline(), timeout=10)) not in (b"\r\n", b"\n", b""):
+                pass
+
+            parts = request_line.split()
+            if len(parts) < 2 or parts[0] != b"GET":
+                status, body = "405 Method Not Allowed", b""
+            elif parts[1].split(b"?")[0] not in (b"/", b"/metrics"):
+                status, body = "404 Not Found", b""
+            else:
+                status, body = "200 OK", registry.render().encode()
+
+            writer.write(b"HTTP/1.1 %s\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         b"Content-Length: %d\r\nConnection: close\r\n\r\n%s" % (status.encode(), len(body), body))
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logging.info("Metrics are served on http://%s:%d/metrics", host, port)
+    return server
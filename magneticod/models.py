@@ -1,5 +1,5 @@
 from peewee import Proxy, Model, BlobField, TextField, IntegerField, Check, \
-    ForeignKeyField, BigIntegerField
+    ForeignKeyField, BigIntegerField, SmallIntegerField
 from playhouse.shortcuts import model_to_dict
 
 database_proxy = Proxy()
@@ -33,6 +33,8 @@ class Torrent(BaseModel):
     name = TextField()
     total_size = BigIntegerField(constraints=[Check('total_size > 0')])
     discovered_on = IntegerField(constraints=[Check('discovered_on > 0')])
+    # The files of the torrent, if they are stored compactly (see filelist) instead of in `files`.
+    file_list = BlobField(null=True)
 
 
 class File(BaseModel):
@@ -43,3 +45,23 @@ class File(BaseModel):
         Torrent, on_delete='CASCADE', on_update='RESTRICT')
     size = BigIntegerField()
     path = TextField()
+
+
+class MetadataDictionary(BaseModel):
+    """ zstd dictionaries the raw metadata are compressed with (see rawmetadata). """
+    class Meta:
+        db_table = 'metadata_dictionaries'
+
+    data = BlobField()
+
+
+class RawMetadata(BaseModel):
+    class Meta:
+        db_table = 'raw_metadata'
+
+    torrent = ForeignKeyField(
+        Torrent, unique=True, on_delete='CASCADE', on_update='RESTRICT')
+    codec = SmallIntegerField()
+    dictionary = ForeignKeyField(
+        MetadataDictionary, null=True, on_delete='RESTRICT', on_update='RESTRICT')
+    data = BlobField()
@@ -0,0 +1,152 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Time-partitioned torrents (`--partition`), for large PostgreSQL deployments.
+
+The torrents are range-partitioned by `discovered_on`, a partition (`torrents_pYYYYMMDD`, after the UTC date it starts
+on) per day, week or month. Every partition has its own, smaller indices, and old torrents are removed by dropping
+whole partitions instead of deleting rows.
+
+Since the partition key must be a part of every unique constraint of a partitioned table, the index of `info_hash` is
+not a unique one: duplicates are avoided by checking before inserting (as `Database.is_infohash_new` does anyway), but
+not guaranteed across multiple crawlers sharing a database. For the same reason, nothing can reference the torrents by
+their ids alone; hence the files are stored in the rows of the torrents (`--file-storage blob`), and neither
+`--raw-metadata` nor `--search-index` can be used.
+
+Partitions are created ahead of time (`PARTITIONS_AHEAD` of them after the current one), as rows for which there is no
+partition cannot be inserted.
+"""
+import datetime
+import logging
+import re
+import typing
+
+import peewee
+
+from . import metrics
+
+PERIODS = ("day", "week", "month")
+# Partitions created after the current one.
+PARTITIONS_AHEAD = 2
+
+PARTITIONS_CREATED = metrics.counter("magneticod_db_partitions_created_total", "Partitions of the torrents created.")
+PARTITIONS_DROPPED = metrics.counter(
+    "magneticod_db_partitions_dropped_total", "Partitions of the torrents dropped because they are past the retention.")
+
+_PREFIX = "torrents_p"
+_BOUND = re.compile(r"FROM \('?(-?\d+)'?\) TO \('?(-?\d+)'?\)")
+
+
+def period_start(period: str, date: datetime.date) -> datetime.date:
+    """ Returns the date the partition that `date` belongs to starts on. """
+    if period == "day":
+        return date
+    if period == "week":
+        return date - datetime.timedelta(days=date.weekday())
+    return date.replace(day=1)
+
+
+def next_period_start(period: str, start: datetime.date) -> datetime.date:
+    if period == "day":
+        return start + datetime.timedelta(days=1)
+    if period == "week":
+        return start + datetime.timedelta(days=7)
+    return (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+
+def _timestamp(date: datetime.date) -> int:
+    return int(datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc).timestamp())
+
+
+def _relkind(database: peewee.Database, table: str) -> typing.Optional[str]:
+    row = database.execute_sql("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,)).fetchone()
+    return row[0] if row else None
+
+
+def is_partitioned(database: peewee.Database) -> bool:
+    return isinstance(database, peewee.PostgresqlDatabase) and _relkind(database, "torrents") == "p"
+
+
+def create_schema(database: peewee.Database, period: str) -> None:
+    """ Creates the partitioned torrents table, unless it exists already (as a partitioned one). """
+    if not isinstance(database, peewee.PostgresqlDatabase):
+        raise ValueError("partitioning is supported on PostgreSQL only")
+    relkind = _relkind(database, "torrents")
+    if relkind == "p":
+        return
+    if relkind is not None:
+        raise ValueError("the torrents table exists already, and it is not partitioned")
+
+    logging.info("Creating the torrents table, partitioned by %s...", period)
+    with database.atomic():
+        database.execute_sql(
+            "CREATE TABLE torrents ("
+            "id SERIAL NOT NULL, "
+            "info_hash BYTEA NOT NULL, "
+            "name TEXT NOT NULL, "
+            "total_size BIGINT NOT NULL CHECK (total_size > 0), "
+            "discovered_on INTEGER NOT NULL CHECK (discovered_on > 0), "
+            "file_list BYTEA, "
+            "PRIMARY KEY (id, discovered_on)"
+            ") PARTITION BY RANGE (discovered_on)")
+        database.execute_sql("CREATE INDEX torrents_info_hash ON torrents (info_hash)")
+
+
+def _partitions(database: peewee.Database) -> typing.List[typing.Tuple[str, int, int]]:
+    """ Returns the (name, from, to) of the partitions of the torrents, by their bounds. """
+    partitions = []
+    for name, bound in database.execute_sql(
+            "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = to_regclass('torrents')").fetchall():
+        match = _BOUND.search(bound or "")
+        if match:
+            partitions.append((name, int(match.group(1)), int(match.group(2))))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def create_partitions(database: peewee.Database, period: str, now: typing.Optional[datetime.date] = None) -> None:
+    """
+    Creates the partition of `now` (today by default) and the `PARTITIONS_AHEAD` ones after it, if missing; if the
+    period has been changed, the first new partition starts where the existing ones end instead.
+    """
+    covered_until = max((to for _, _, to in _partitions(database)), default=0)
+    start = period_start(period, now or datetime.datetime.utcnow().date())
+    for _ in range(PARTITIONS_AHEAD + 1):
+        end = next_period_start(period, start)
+        from_ = max(_timestamp(start), covered_until)
+        if from_ < _timestamp(end):
+            name = _PREFIX + datetime.datetime.utcfromtimestamp(from_).strftime("%Y%m%d")
+            database.execute_sql("CREATE TABLE %s PARTITION OF torrents FOR VALUES FROM (%d) TO (%d)" % (
+                name, from_, _timestamp(end)))
+            PARTITIONS_CREATED.inc()
+            logging.info("Partition %s is created.", name)
+        start = end
+
+
+def drop_partitions(database: peewee.Database, retention: datetime.timedelta,
+                    now: typing.Optional[datetime.date] = None) -> int:
+    """ Drops the partitions that end before `retention` ago, and returns how many of them have been dropped. """
+    cutoff = _timestamp((now or datetime.datetime.utcnow().date()) - retention)
+    n = 0
+    for name, _, to in _partitions(database):
+        # Partitions attached by hand are left be.
+        if to > cutoff or not name.startswith(_PREFIX):
+            continue
+        database.execute_sql("DROP TABLE %s" % (name,))
+        PARTITIONS_DROPPED.inc()
+        logging.info("Partition %s is dropped (past the retention).", name)
+        n += 1
+    return n
@@ -12,19 +12,57 @@
 #
 # You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
 # <http://www.gnu.org/licenses/>.
-import asyncio
 import base64
+import concurrent.futures
 import datetime
 import logging
+import time
 import typing
-from collections import Counter
 
 import peewee
 from playhouse.db_url import connect, schemes, PooledMySQLDatabase
+from playhouse.migrate import SchemaMigrator, migrate
 from playhouse.shortcuts import RetryOperationalError
 
 from magneticod import bencode
-from .models import Torrent, File, database_proxy
+from . import filelist
+from . import metrics
+from . import partitions
+from . import rawmetadata
+from . import search
+from . import spool as spool_
+from .models import Torrent, File, MetadataDictionary, RawMetadata, database_proxy
+
+INFOHASHES_SEEN = metrics.counter(
+    "magneticod_infohashes_seen_total", "Info hashes announced to us, including the ones we already have.")
+INFOHASHES_KNOWN = metrics.counter(
+    "magneticod_infohashes_known_total", "Announced info hashes that are already in the database.")
+METADATA_INVALID = metrics.counter(
+    "magneticod_metadata_invalid_total", "Fetched metadata that could NOT be parsed.")
+TORRENTS_COMMITTED = metrics.counter(
+    "magneticod_db_torrents_committed_total", "Torrents committed to the database.")
+TORRENTS_DROPPED = metrics.counter(
+    "magneticod_db_torrents_dropped_total", "Torrents dropped because their batch could NOT be committed.")
+FLUSH_DURATION = metrics.histogram(
+    "magneticod_db_flush_duration_seconds", "Time it takes to commit a batch of metadata to the database.")
+PENDING_METADATA = metrics.gauge(
+    "magneticod_db_pending_metadata", "Metadata waiting in the buffer to be committed to the database.")
+TORRENTS_SPOOLED = metrics.counter(
+    "magneticod_db_torrents_spooled_total",
+    "Torrents not committed (right away) because the database is down, to be added from the spool once it is back.")
+TORRENTS_REPLAYED = metrics.counter(
+    "magneticod_db_torrents_replayed_total", "Torrents added to the database from the spool.")
+TORRENTS_DEAD_LETTERED = metrics.counter(
+    "magneticod_db_torrents_dead_lettered_total",
+    "Spooled torrents the database refuses (even one by one), moved to the dead letters of the spool.")
+TORRENTS_INDEXED = metrics.counter(
+    "magneticod_db_torrents_indexed_total", "Torrents added to the full-text search index.")
+
+# How the files of the torrents are stored: a row per file in `files`, or a blob per torrent in `torrents.file_list`.
+FILE_STORAGES = ("rows", "blob")
+
+# Memcached key of the id of the last torrent added by `Database.heat_memcache`.
+HEAT_MEMCACHE_LAST_ID_KEY = b"magneticod:heat_memcache:last_id"
 
 
 class RetryPooledMySQLDatabase(RetryOperationalError, PooledMySQLDatabase):
@@ -35,13 +73,24 @@ schemes['mysql'] = RetryPooledMySQLDatabase
 
 
 class Database:
-    def __init__(self, database, commit_n=10) -> None:
+    def __init__(self, database, commit_n=10, spool_path=None, raw_metadata=None, raw_metadata_level=None,
+                 file_storage="rows", search_index=False, partition=None, retention=None) -> None:
+        # raw_metadata is the codec ("zlib" or "zstd") to store the raw metadata with, if they are to be stored at all.
+        # partition is the period ("day", "week" or "month") to partition the torrents by, if they are to be partitioned
+        # at all (see partitions), and retention the number of days the partitions are kept for (forever if None).
+        if partition and (file_storage != "blob" or raw_metadata or search_index):
+            raise ValueError("partitioned torrents need --file-storage blob, and cannot have the raw metadata or the "
+                             "search index")
+        if retention is not None and not partition:
+            raise ValueError("retention needs the torrents to be partitioned")
+        self._partition = partition
+        self._retention = retention
         self._commit_n = commit_n
+        self._file_storage = file_storage
+        self._search = search_index
+        self._search_index = None  # type: typing.Optional[search.SearchIndex]
+        self._raw_metadata = raw_metadata
         kw = {}
-        self.start = datetime.datetime.now().timestamp()
-        self._cnt = Counter()
-        self._catched = 0
-        self._new = 0
         if database.startswith('sqlite://'):
             kw['pragmas'] = [
                 ('journal_mode', 'WAL'),
@@ -51,81 +100,196 @@ class Database:
         self._db = database
         self._kw = kw
         self._connect()
+        self.__compressor = rawmetadata.Compressor(raw_metadata, raw_metadata_level) if raw_metadata else None
 
         # We buffer metadata to flush many entries at once, for performance reasons.
         # list of tuple (info_hash, name, total_size, discovered_on)
         self.__pending_metadata = []  # type: typing.List[typing.Dict]
         # list of tuple (info_hash, size, path)
         self.__pending_files = []  # type: typing.List[typing.Dict]
+        # list of tuple (info_hash, codec, dictionary, data)
+        self.__pending_raw_metadata = []  # type: typing.List[typing.Dict]
+        # list of tuple (info_hash, name, paths), as returned by search.document()
+        self.__pending_documents = []  # type: typing.List[typing.Tuple[bytes, str, str]]
+
+        # Metadata are written to the spool (if any) before they are buffered, so that a batch that cannot be committed
+        # is added from the spool later, starting at the position of its first metadata, instead of being lost. Once a
+        # batch fails, the metadata are only spooled until the spool is replayed.
+        self.__spool = spool_.Spool(spool_path) if spool_path else None
+        self.__batch_start = None  # type: typing.Optional[spool_.Position]
+        self.__replay_from = self.__spool.oldest if self.__spool else None  # type: typing.Optional[spool_.Position]
+        if self.__replay_from:
+            logging.info("The spool has metadata left over; they will be added to the database.")
 
     def _connect(self):
         db = connect(self._db, **self._kw)
         database_proxy.initialize(db)
-        database_proxy.create_tables([Torrent, File], safe=True)
+        if self._partition:
+            partitions.create_schema(db, self._partition)
+            partitions.create_partitions(db, self._partition)
+        elif not partitions.is_partitioned(db):
+            database_proxy.create_tables([Torrent, File], safe=True)
+            # Databases created before `file_list` was added to the torrents.
+            if "file_list" not in {column.name for column in database_proxy.get_columns("torrents")}:
+                logging.info("Adding the `file_list` column to the torrents...")
+                migrate(SchemaMigrator.from_database(db).add_column("torrents", "file_list", Torrent.file_list))
+        if self._raw_metadata:
+            database_proxy.create_tables([MetadataDictionary, RawMetadata], safe=True)
+        if self._search:
+            self._search_index = search.search_index(db)
+            self._search_index.create()
+
+    def heat_memcache(self, clients, chunk_size=10000, restart=False) -> int:
+        """
+        Adds the info hashes of all the torrents to memcached, and returns how many of them have been added.
+
+        Torrents are walked in the order of their ids (`WHERE id > last ORDER BY id LIMIT chunk_size`), so that every
+        query is an index range scan however sparse the ids are. Each chunk is split across `clients` (one connection
+        each) and written with pipelined `set_many` calls in threads, while the next chunk is being read from the
+        database. The last id whose chunk is fully written is saved in memcached, so that an interrupted warm-up
+        resumes where it has left off (unless `restart`), and starts over if memcached itself has been restarted.
+        """
+        if restart:
+            last_id = 0
+        else:
+            last_id = int(clients[0].get(HEAT_MEMCACHE_LAST_ID_KEY) or 0)
+            if last_id:
+                logging.info("Heat memcached: resuming after torrent #%d.", last_id)
 
-    def heat_memcache(self, cache, chunk_size=10000):
-        min_id = Torrent.select(Torrent.id).order_by(+Torrent.id).get().id
-        max_id = Torrent.select(Torrent.id).order_by(-Torrent.id).get().id + 1
-        chunks = (max_id - min_id) // chunk_size + 1
         n = 0
-        for ch_id in range(chunks):
-            a = ch_id * chunk_size + min_id
-            b = a + chunk_size
-            for torrent in Torrent.select(Torrent.info_hash).where(
-                            (Torrent.id >= a) & (Torrent.id < b)
-            ):
-                m_info_hash = base64.b32encode(torrent.info_hash)
-                cache.set(m_info_hash, '1')
-                n += 1
-            logging.info('Heat memcached: add %d hashes in total.', n)
-
-    async def reset_counters(self, node, delay=3600):
-        while True:
-            node._cnt = Counter()
-            node._skip = 0
-            self._cnt = Counter()
-            await asyncio.sleep(delay)
+        started_on = reported_on = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(len(clients)) as executor:
+            pending = []  # type: typing.List[concurrent.futures.Future]
+            pending_last_id = last_id
+            while True:
+                rows = list(Torrent.select(Torrent.id, Torrent.info_hash)
+                            .where(Torrent.id > last_id)
+                            .order_by(Torrent.id)
+                            .limit(chunk_size)
+                            .tuples())
+
+                # Wait for the previous chunk before saving its last id (and before queueing any more of them).
+                for future in pending:
+                    future.result()
+                if pending:
+                    clients[0].set(HEAT_MEMCACHE_LAST_ID_KEY, str(pending_last_id))
+                if not rows:
+                    break
+
+                values = {base64.b32encode(info_hash): "1" for _, info_hash in rows}
+                keys = list(values)
+                step = len(keys) // len(clients) + 1
+                pending = [
+                    executor.submit(client.set_many, {k: values[k] for k in keys[i * step:(i + 1) * step]})
+                    for i, client in enumerate(clients)
+                ]
+                last_id = pending_last_id = rows[-1][0]
+                n += len(rows)
+
+                now = time.monotonic()
+                if now - reported_on >= 10:
+                    logging.info("Heat memcached: %d hashes in total (%.0f/s), at torrent #%d.",
+                                 n, n / (now - started_on), last_id)
+                    reported_on = now
+
+        duration = time.monotonic() - started_on
+        logging.info("Heat memcached: %d hashes are added in %.1fs (%.0f/s).",
+                     n, duration, n / duration if duration else 0)
+        return n
 
-    async def print_info(self, node, delay=3600):
+    def migrate_files(self, chunk_size=1000) -> int:
+        """
+        Moves the files of the torrents from `files` into `torrents.file_list` (see filelist), and returns for how many
+        torrents they have been moved.
+
+        Torrents are walked in the order of their ids, as in `heat_memcache`, skipping the ones that have a file list
+        already; every chunk is converted (and its rows deleted from `files`) in a transaction of its own, hence an
+        interrupted migration resumes where it has left off, and the crawler can keep running (in either mode) in the
+        meantime.
+        """
+        last_id = 0
+        n = n_files = 0
+        started_on = reported_on = time.monotonic()
         while True:
-            try:
-                mcache_hashes = 0
-                if node._memcache:
-                    mcache_hashes = node._memcache.stats()[b'curr_items']
-                now = datetime.datetime.now().timestamp()
-                timediff = (now - self.start) or 0.000001
-                logging.info(
-                    'STATS nodes:%d/s=%d/c=%d catched:%d/%d/%d known:%d/%.2f%% added:%d/%.2f%% bderr:%d lcache:%d/%d task:%d/%d max:%d ft:%.2f',
-                    node._cnt['nodes'],
-                    node._skip,
-                    node._nodes_collisions,
-                    self._cnt['catched'],
-                    self._catched // timediff,
-                    self._new // timediff,
-                    self._cnt['known'],
-                    self._cnt['known'] * 100 / self._cnt['catched'] if
-                    self._cnt['catched'] else 0,
-                    self._cnt['added'],
-                    self._cnt['added'] * 100 / self._cnt['catched'] if
-                    self._cnt['catched'] else 0,
-                    self._cnt['errors'],
-                    len(node._hashes) + mcache_hashes,
-                    node._collisions,
-                    node.metadata_tasks,
-                    len(asyncio.Task.all_tasks()),
-                    node._n_max_neighbours,
-                    node._cnt['timers'] / (node._cnt['timers_count'] or 1)
-                    )
-                self._catched = 0
-                self._new = 0
-                self.start = now
-            except:
-                logging.exception('Error in printing stats!')
-            await asyncio.sleep(delay)
-
-    def add_metadata(self, info_hash: bytes, metadata: bytes, node) -> bool:
-        files = []
+            torrent_ids = [torrent_id for torrent_id, in Torrent.select(Torrent.id)
+                           .where((Torrent.id > last_id) & Torrent.file_list.is_null())
+                           .order_by(Torrent.id)
+                           .limit(chunk_size)
+                           .tuples()]
+            if not torrent_ids:
+                break
+            last_id = torrent_ids[-1]
+
+            files = {}  # type: typing.Dict[int, typing.List[filelist.File]]
+            for torrent_id, path, size in File.select(File.torrent, File.path, File.size) \
+                    .where(File.torrent << torrent_ids) \
+                    .order_by(File.torrent, File.id) \
+                    .tuples():
+                files.setdefault(torrent_id, []).append((path, size))
+            if not files:
+                continue
+
+            with database_proxy.atomic():
+                for torrent_id, torrent_files in files.items():
+                    Torrent.update(file_list=filelist.encode(torrent_files)).where(Torrent.id == torrent_id).execute()
+                File.delete().where(File.torrent << list(files)).execute()
+            n += len(files)
+            n_files += sum(len(torrent_files) for torrent_files in files.values())
+
+            now = time.monotonic()
+            if now - reported_on >= 10:
+                logging.info("Migrate files: %d torrents (%d files) in total (%.0f torrents/s), at torrent #%d.",
+                             n, n_files, n / (now - started_on), last_id)
+                reported_on = now
+
+        duration = time.monotonic() - started_on
+        logging.info("Migrate files: the files of %d torrents (%d files) are moved in %.1fs (%.0f torrents/s).",
+                     n, n_files, duration, n / duration if duration else 0)
+        return n
+
+    def add_metadata(self, info_hash: bytes, metadata: bytes, fetch_time: float = 0.0) -> bool:
         discovered_on = int(datetime.datetime.now().timestamp())
+        parsed = self.__parse_metadata(info_hash, metadata, discovered_on)
+        if parsed is None:
+            return False
+        torrent, files, torrent_files = parsed
+
+        if self.__spool:
+            position = self.__spool.append(info_hash, metadata, fetch_time, discovered_on)
+            if self.__replay_from is not None:
+                TORRENTS_SPOOLED.inc()
+                logging.info("Spooled: `%s` fetch_time:%.2f", torrent['name'], fetch_time)
+                return True
+            if not self.__pending_metadata:
+                self.__batch_start = position
+
+        self.__pending_metadata.append(torrent)
+        # MYPY BUG: error: Argument 1 to "__iadd__" of "list" has incompatible type List[Tuple[bytes, Any, str]];
+        #     expected Iterable[Tuple[bytes, int, bytes]]
+        # List is an Iterable man...
+        self.__pending_files += files  # type: ignore
+        if self.__compressor:
+            self.__pending_raw_metadata.append(self.__raw_metadata_row(info_hash, metadata))
+        if self._search_index:
+            self.__pending_documents.append(
+                (info_hash,) + search.document(torrent['name'], (path for path, _ in torrent_files)))
+
+        logging.info("Added: `%s` fetch_time:%.2f", torrent['name'], fetch_time)
+
+        # Automatically check if the buffer is full, and commit to the SQLite database if so.
+        if len(self.__pending_metadata) >= self._commit_n:
+            self.__commit_metadata()
+        PENDING_METADATA.set(len(self.__pending_metadata))
+
+        return True
+
+    def __parse_metadata(self, info_hash: bytes, metadata: bytes, discovered_on: int) \
+            -> typing.Optional[typing.Tuple[typing.Dict, typing.List[typing.Dict], typing.List[filelist.File]]]:
+        """
+        Returns the row of the torrent, the rows of its files (none if they are stored in the row of the torrent) and
+        its files, or None if `metadata` is invalid.
+        """
+        files = []  # type: typing.List[filelist.File]
         try:
             if metadata == b'test':
                 info = {b'name': b'test', b'length': 123}
@@ -137,70 +301,59 @@ class Database:
 
             if b"files" in info:  # Multiple File torrent:
                 for file in info[b"files"]:
-                    assert type(file[b"length"]) is int
+                    assert type(file[b"length"]) is int and file[b"length"] >= 0
                     # Refuse trailing slash in any of the path items
                     assert not any(b"/" in item for item in file[b"path"])
                     path = "/".join(i.decode("utf-8") for i in file[b"path"])
-                    subq = Torrent.select(Torrent.id).where(
-                        Torrent.info_hash == info_hash)
-                    files.append({
-                        'torrent': subq,
-                        'size': file[b"length"],
-                        'path': path
-                    })
+                    files.append((path, file[b"length"]))
             else:  # Single File torrent:
-                assert type(info[b"length"]) is int
-                subq = Torrent.select(Torrent.id).where(
-                    Torrent.info_hash == info_hash)
-                files.append({
-                    'torrent': subq,
-                    'size': info[b"length"],
-                    'path': name
-                })
+                assert type(info[b"length"]) is int and info[b"length"] >= 0
+                files.append((name, info[b"length"]))
+            # As the database would refuse it (see models.Torrent).
+            assert sum(size for _, size in files) > 0
         except peewee.InterfaceError:
             self._connect()
-            return False
+            return None
         except (
                 bencode.BencodeDecodingError, AssertionError, KeyError,
                 AttributeError,
                 UnicodeDecodeError, TypeError):
             logging.exception('Not critical error.', exc_info=False)
-            return False
+            METADATA_INVALID.inc()
+            return None
 
-        self.__pending_metadata.append({
+        torrent = {
             'info_hash': info_hash,
             'name': name,
-            'total_size': sum(f['size'] for f in files),
+            'total_size': sum(size for _, size in files),
             'discovered_on': discovered_on
-        })
-        # MYPY BUG: error: Argument 1 to "__iadd__" of "list" has incompatible type List[Tuple[bytes, Any, str]];
-        #     expected Iterable[Tuple[bytes, int, bytes]]
-        # List is an Iterable man...
-        self.__pending_files += files  # type: ignore
+        }
+        if self._file_storage == "blob":
+            torrent['file_list'] = filelist.encode(files)
+            return torrent, [], files
+        subq = Torrent.select(Torrent.id).where(Torrent.info_hash == info_hash)
+        return torrent, [{'torrent': subq, 'size': size, 'path': path} for path, size in files], files
 
-        logging.info("Added: `%s` fetch_time:%.2f", name,
-                     node._timers.get(info_hash, 0))
-        node._timers.pop(info_hash, None)
-
-        # Automatically check if the buffer is full, and commit to the SQLite database if so.
-        if len(self.__pending_metadata) >= self._commit_n:
-            self.__commit_metadata()
-
-        return True
+    def __raw_metadata_row(self, info_hash: bytes, metadata: bytes) -> typing.Dict:
+        codec, dictionary_id, data = self.__compressor.compress(metadata)
+        return {
+            'torrent': Torrent.select(Torrent.id).where(Torrent.info_hash == info_hash),
+            'codec': codec,
+            'dictionary': dictionary_id,
+            'data': data
+        }
 
     def is_infohash_new(self, info_hash, skip_check=False):
         try:
-            self._cnt['catched'] += 1
-            self._catched += 1
+            INFOHASHES_SEEN.inc()
             if skip_check:
                 return
             if info_hash in [x['info_hash'] for x in self.__pending_metadata]:
-                self._cnt['known'] += 1
+                INFOHASHES_KNOWN.inc()
                 return False
             x = Torrent.select().where(Torrent.info_hash == info_hash).count()
-            self._cnt['known'] += int(x > 0)
-            if x == 0:
-                self._new += 1
+            if x > 0:
+                INFOHASHES_KNOWN.inc()
             return x == 0
         except peewee.InterfaceError:
             self._connect()
@@ -209,18 +362,32 @@ class Database:
     def __commit_metadata(self) -> None:
         # noinspection PyBroadException
         n = len(self.__pending_metadata)
+        started_on = time.monotonic()
         try:
             with database_proxy.atomic():
                 Torrent.insert_many(self.__pending_metadata).execute()
-                File.insert_many(self.__pending_files).execute()
-                self._cnt['added'] += n
+                if self.__pending_files:
+                    File.insert_many(self.__pending_files).execute()
+                if self.__pending_raw_metadata:
+                    RawMetadata.insert_many(self.__pending_raw_metadata).execute()
+                if self.__pending_documents:
+                    self.__index(self.__pending_documents)
+                TORRENTS_COMMITTED.inc(n)
                 logging.info(
                     "%d metadata (%d files) are committed to the database.",
                     len(self.__pending_metadata), len(self.__pending_files)
                 )
                 self.__pending_metadata.clear()
                 self.__pending_files.clear()
+                self.__pending_raw_metadata.clear()
+                self.__pending_documents.clear()
+            if self.__spool:
+                self.__spool.release(self.__spool.position)
         except peewee.IntegrityError:
+            if self.__spool:
+                # The spool is replayed skipping the torrents that are in the database already.
+                self.__spool_batch("because of collisions")
+                return
             # Some collisions. Drop entire batch to avoid infinite loop.
             # TODO: find better solution
             logging.exception(
@@ -228,17 +395,221 @@ class Database:
                 len(self.__pending_metadata), exc_info=False)
             self.__pending_metadata.clear()
             self.__pending_files.clear()
-            self._cnt['errors'] += n
+            self.__pending_raw_metadata.clear()
+            self.__pending_documents.clear()
+            TORRENTS_DROPPED.inc(n)
         except peewee.InterfaceError:
+            if self.__spool:
+                self.__spool_batch("because the connection is lost")
             self._connect()
         except:
+            if self.__spool:
+                self.__spool_batch("")
+                return
             logging.exception(
                 "Could NOT commit metadata to the database! (%d metadata are pending)",
                 len(self.__pending_metadata), exc_info=False)
             self.__pending_metadata.clear()
             self.__pending_files.clear()
-            self._cnt['errors'] += n
+            self.__pending_raw_metadata.clear()
+            self.__pending_documents.clear()
+            TORRENTS_DROPPED.inc(n)
+        finally:
+            FLUSH_DURATION.observe(time.monotonic() - started_on)
+
+    def __spool_batch(self, reason: str) -> None:
+        logging.exception(
+            "Could NOT commit metadata to the database%s! (%d metadata will be added from the spool)",
+            " " + reason if reason else "", len(self.__pending_metadata), exc_info=False)
+        TORRENTS_SPOOLED.inc(len(self.__pending_metadata))
+        self.__replay_from = self.__batch_start
+        self.__pending_metadata.clear()
+        self.__pending_files.clear()
+        self.__pending_raw_metadata.clear()
+        self.__pending_documents.clear()
+
+    def maintain_partitions(self) -> None:
+        """ Creates the upcoming partitions of the torrents, and drops the ones past the retention (if any). """
+        if not self._partition:
+            return
+        try:
+            partitions.create_partitions(database_proxy.obj, self._partition)
+            if self._retention is not None:
+                partitions.drop_partitions(database_proxy.obj, datetime.timedelta(days=self._retention))
+        except peewee.InterfaceError:
+            self._connect()
+        except Exception:
+            logging.exception("Could NOT maintain the partitions of the torrents!", exc_info=False)
+
+    @property
+    def spool_sync_due(self) -> bool:
+        return self.__spool is not None and self.__spool.sync_due
+
+    def sync_spool(self) -> None:
+        """ Fsyncs the spool (if any); can be called from another thread. """
+        if self.__spool:
+            self.__spool.sync()
+
+    @property
+    def replaying(self) -> bool:
+        """ Whether there are spooled metadata to be added to the database. """
+        return self.__replay_from is not None
+
+    def replay_spool(self, max_duration: typing.Optional[float] = None) -> bool:
+        """
+        Adds the spooled metadata that are not in the database yet (if any) to it, in batches of `commit_n`, stopping
+        after the batch that exceeds `max_duration` seconds (if given) for the rest to be added by the next call;
+        returns False if the database is still down.
+        """
+        if self.__replay_from is None:
+            return True
+
+        n = 0
+        started_on = time.monotonic()
+        batch = []  # type: typing.List[typing.Tuple[bytes, bytes, float, float]]
+        try:
+            for position, info_hash, metadata, fetch_time, discovered_on in self.__spool.read(self.__replay_from):
+                batch.append((info_hash, metadata, fetch_time, discovered_on))
+                if len(batch) >= self._commit_n:
+                    n += self.__replay_batch(batch)
+                    batch.clear()
+                    self.__replay_from = position
+                    self.__spool.release(position)
+                    if max_duration is not None and time.monotonic() - started_on >= max_duration:
+                        return True
+            if batch:
+                n += self.__replay_batch(batch)
+        except peewee.InterfaceError:
+            self._connect()
+            return False
+        except Exception:
+            logging.exception("Could NOT add the spool to the database! (%d torrents are added so far)", n,
+                              exc_info=False)
+            return False
+
+        self.__replay_from = None
+        self.__spool.release(self.__spool.position)
+        logging.info("%d torrents are added to the database from the spool in %.1fs.", n, time.monotonic() - started_on)
+        return True
+
+    def __replay_batch(self, batch: typing.List[typing.Tuple[bytes, bytes, float, float]]) -> int:
+        """
+        Adds a batch of spooled metadata to the database, skipping the ones in it already. If the database refuses the
+        batch, they are added one by one instead, and the ones that are refused still are moved to the dead letters.
+        """
+        known = {info_hash for info_hash, in Torrent.select(Torrent.info_hash).where(
+            Torrent.info_hash << [info_hash for info_hash, _, _, _ in batch]).tuples()}
+        # (record, torrent, files, raw metadata, document), the last two are None if they are not stored
+        rows = []  # type: typing.List[typing.Tuple]
+        for record in batch:
+            info_hash, metadata, _, discovered_on = record
+            if info_hash in known:
+                continue
+            known.add(info_hash)
+            parsed = self.__parse_metadata(info_hash, metadata, int(discovered_on))
+            if parsed:
+                rows.append((
+                    record,
+                    parsed[0],
+                    parsed[1],
+                    self.__raw_metadata_row(info_hash, metadata) if self.__compressor else None,
+                    (info_hash,) + search.document(parsed[0]['name'], (path for path, _ in parsed[2]))
+                    if self._search_index else None
+                ))
+        if not rows:
+            return 0
+
+        try:
+            self.__insert_rows(rows)
+            n = len(rows)
+        except peewee.IntegrityError:
+            logging.exception("Could NOT add a batch of the spool to the database; adding them one by one.",
+                              exc_info=False)
+            n = 0
+            for row in rows:
+                try:
+                    self.__insert_rows([row])
+                    n += 1
+                except peewee.IntegrityError:
+                    logging.exception("Could NOT add `%s` from the spool to the database! (moved to the dead letters)",
+                                      row[1]['name'], exc_info=False)
+                    self.__spool.dead_letter(*row[0])
+                    TORRENTS_DEAD_LETTERED.inc()
+        TORRENTS_COMMITTED.inc(n)
+        TORRENTS_REPLAYED.inc(n)
+        return n
+
+    def __insert_rows(self, rows: typing.List[typing.Tuple]) -> None:
+        with database_proxy.atomic():
+            Torrent.insert_many([row[1] for row in rows]).execute()
+            files = [file for row in rows for file in row[2]]
+            if files:
+                File.insert_many(files).execute()
+            raw_metadata = [row[3] for row in rows if row[3] is not None]
+            if raw_metadata:
+                RawMetadata.insert_many(raw_metadata).execute()
+            documents = [row[4] for row in rows if row[4] is not None]
+            if documents:
+                self.__index(documents)
+
+    def __index(self, documents: typing.List[typing.Tuple[bytes, str, str]]) -> None:
+        """ Adds the (info hash, name, paths) documents of the torrents just inserted to the search index. """
+        ids = {bytes(info_hash): torrent_id for info_hash, torrent_id in Torrent.select(Torrent.info_hash, Torrent.id)
+               .where(Torrent.info_hash << [info_hash for info_hash, _, _ in documents]).tuples()}
+        self._search_index.add([(ids[info_hash], name, paths) for info_hash, name, paths in documents])
+        TORRENTS_INDEXED.inc(len(documents))
+
+    def build_search_index(self, chunk_size=1000) -> int:
+        """
+        Adds the torrents that are not in the search index yet (e.g. the ones added before it was enabled) to it, and
+        returns how many of them have been added. Torrents are walked in the order of their ids, a chunk per
+        transaction.
+        """
+        last_id = 0
+        n = 0
+        started_on = reported_on = time.monotonic()
+        while True:
+            torrents = self._search_index.unindexed(last_id, chunk_size)
+            if not torrents:
+                break
+            last_id = torrents[-1][0]
+            torrent_ids = [torrent_id for torrent_id, _ in torrents]
+
+            paths = {}  # type: typing.Dict[int, typing.List[str]]
+            for torrent_id, file_list in Torrent.select(Torrent.id, Torrent.file_list) \
+                    .where((Torrent.id << torrent_ids) & Torrent.file_list.is_null(False)) \
+                    .tuples():
+                paths[torrent_id] = [path for path, _ in filelist.iter_files(bytes(file_list))]
+            for torrent_id, path in File.select(File.torrent, File.path) \
+                    .where(File.torrent << torrent_ids) \
+                    .order_by(File.torrent, File.id) \
+                    .tuples():
+                paths.setdefault(torrent_id, []).append(path)
+
+            with database_proxy.atomic():
+                self._search_index.add([
+                    (torrent_id,) + search.document(name, paths.get(torrent_id, ())) for torrent_id, name in torrents
+                ])
+            TORRENTS_INDEXED.inc(len(torrents))
+            n += len(torrents)
+
+            now = time.monotonic()
+            if now - reported_on >= 10:
+                logging.info("Build search index: %d torrents in total (%.0f/s), at torrent #%d.",
+                             n, n / (now - started_on), last_id)
+                reported_on = now
+
+        duration = time.monotonic() - started_on
+        logging.info("Build search index: %d torrents are added in %.1fs (%.0f/s).",
+                     n, duration, n / duration if duration else 0)
+        return n
+
+    def search(self, query: str, limit: int = 20) -> typing.List[search.Result]:
+        """ Returns the (info hash, name, total size, discovered on, rank) of the best matches of `query`. """
+        return self._search_index.search(query, limit)
 
     def close(self) -> None:
         if self.__pending_metadata:
             self.__commit_metadata()
+        if self.__spool:
+            self.__spool.close()
@@ -0,0 +1,192 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Sampled, switchable timing of the hot paths.
+
+Modules register the callables they want to be timed (as attributes of an object, a class or a module) as *stages*
+with `PROFILER.register()`. Nothing is wrapped while the profiler is disabled, so registration is free; once enabled,
+every stage is replaced with a wrapper that times one call in `sample_every`, and the loop lag is measured
+periodically. Sampled calls and loop lags longer than `slow_threshold` are logged as they happen, so that it is known
+which stage blocked the loop. `kill -USR1` toggles the profiler and `kill -USR2` logs the per-stage breakdown.
+
+Objects are referred to weakly, so that registering (the methods of) an object does not keep it alive.
+
+Stages nest (e.g. `db.is_infohash_new` is called by `dht.announce_peer`), hence their times are inclusive.
+"""
+import asyncio
+import logging
+import signal
+import time
+import typing
+import weakref
+
+
+class StageStats:
+    __slots__ = ("calls", "sampled", "total", "max")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.sampled = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed: float) -> None:
+        self.sampled += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.sampled if self.sampled else 0.0
+
+    @property
+    def estimated_total(self) -> float:
+        return self.mean * self.calls
+
+
+class Profiler:
+    def __init__(self, sample_every: int = 64, lag_interval: float = 0.25, slow_threshold: float = 0.1) -> None:
+        self.sample_every = sample_every
+        self.lag_interval = lag_interval
+        self.slow_threshold = slow_threshold
+        self.enabled = False
+
+        # (weak reference to the object, attribute name, stage name)
+        self.__hooks = []  # type: typing.List[typing.Tuple[weakref.ref, str, str]]
+        # (weak reference to the object, attribute name, original attribute if it was set on the object itself)
+        self.__applied = []  # type: typing.List[typing.Tuple[weakref.ref, str, typing.Any]]
+        self.__stages = {}  # type: typing.Dict[str, StageStats]
+        self.__lag_task = None  # type: typing.Optional[asyncio.Task]
+        self.__enabled_on = 0.0
+
+    def register(self, obj: typing.Any, attribute: str, stage: str) -> None:
+        self.__hooks = [hook for hook in self.__hooks if hook[0]() is not None]
+        self.__hooks.append((weakref.ref(obj), attribute, stage))
+        if self.enabled:
+            self.__apply(obj, attribute, stage)
+
+    def enable(self) -> None:
+        if self.enabled:
+            return
+        self.enabled = True
+        self.__stages.clear()
+        self.__enabled_on = time.monotonic()
+        for ref, attribute, stage in self.__hooks:
+            obj = ref()
+            if obj is not None:
+                self.__apply(obj, attribute, stage)
+
+        # Callbacks that block the loop for long show up as the `loop.lag` stage, and are logged (rather than by
+        # asyncio's debug mode, which would slow every callback down, skewing the very times we measure).
+        self.__lag_task = asyncio.get_event_loop().create_task(self.__measure_lag())
+        logging.info("Profiler is enabled (sampling 1 in %d calls).", self.sample_every)
+
+    def disable(self) -> None:
+        if not self.enabled:
+            return
+        self.enabled = False
+        for ref, attribute, original in reversed(self.__applied):
+            obj = ref()
+            if obj is None:
+                continue
+            if original is None:
+                delattr(obj, attribute)
+            else:
+                setattr(obj, attribute, original)
+        self.__applied.clear()
+
+        if self.__lag_task:
+            self.__lag_task.cancel()
+            self.__lag_task = None
+        logging.info("Profiler is disabled.")
+
+    def toggle(self) -> None:
+        if self.enabled:
+            self.dump()
+            self.disable()
+        else:
+            self.enable()
+
+    def install_signal_handlers(self, event_loop: asyncio.AbstractEventLoop) -> None:
+        event_loop.add_signal_handler(signal.SIGUSR1, self.toggle)
+        event_loop.add_signal_handler(signal.SIGUSR2, self.dump)
+
+    def dump(self) -> None:
+        if not self.__stages:
+            logging.info("PROFILE nothing to report (profiler is %s).", "enabled" if self.enabled else "disabled")
+            return
+
+        duration = time.monotonic() - self.__enabled_on
+        lines = [
+            "PROFILE %.1fs, sampling 1 in %d calls (times are inclusive of the nested stages):"
+            % (duration, self.sample_every),
+            "  %-32s %12s %9s %11s %11s %11s %7s"
+            % ("stage", "calls", "sampled", "mean(us)", "max(us)", "est.tot(s)", "loop%")
+        ]
+        for name, stats in sorted(self.__stages.items(), key=lambda item: -item[1].estimated_total):
+            lines.append("  %-32s %12d %9d %11.1f %11.1f %11.3f %6.2f%%" % (
+                name, stats.calls, stats.sampled, stats.mean * 1e6, stats.max * 1e6, stats.estimated_total,
+                stats.estimated_total * 100 / duration if duration else 0
+            ))
+        logging.info("\n".join(lines))
+
+    def __stage(self, name: str) -> StageStats:
+        stats = self.__stages.get(name)
+        if stats is None:
+            stats = self.__stages[name] = StageStats()
+        return stats
+
+    def __apply(self, obj: typing.Any, attribute: str, stage: str) -> None:
+        original = getattr(obj, attribute)
+        own = vars(obj).get(attribute) if hasattr(obj, "__dict__") else None
+        # Static methods are unwrapped by getattr(); keep them as plain functions on the instance.
+        setattr(obj, attribute, self.__timed(stage, self.__stage(stage), original))
+        self.__applied.append((weakref.ref(obj), attribute, own))
+
+    def __timed(self, stage: str, stats: StageStats, func: typing.Callable) -> typing.Callable:
+        perf_counter = time.perf_counter
+        sample_every = self.sample_every
+        slow_threshold = self.slow_threshold
+
+        def wrapper(*args, **kwargs):
+            stats.calls += 1
+            if stats.calls % sample_every:
+                return func(*args, **kwargs)
+            started_on = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - started_on
+                stats.add(elapsed)
+                if elapsed > slow_threshold:
+                    logging.warning("PROFILE slow call of %s: %.1f ms", stage, elapsed * 1e3)
+
+        return wrapper
+
+    async def __measure_lag(self) -> None:
+        event_loop = asyncio.get_event_loop()
+        stats = self.__stage("loop.lag")
+        while True:
+            scheduled_on = event_loop.time() + self.lag_interval
+            await asyncio.sleep(self.lag_interval)
+            lag = max(event_loop.time() - scheduled_on, 0.0)
+            stats.calls += 1
+            stats.add(lag)
+            if lag > self.slow_threshold:
+                logging.warning("PROFILE the event loop lagged by %.1f ms", lag * 1e3)
+
+
+PROFILER = Profiler()
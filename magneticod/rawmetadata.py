@@ -0,0 +1,137 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Compressed storage of the raw metadata (i.e. the bencoded info dictionaries) in the database (`--raw-metadata`), so
+that the torrents can be reprocessed offline (`magneticod reprocess`) instead of being fetched from the swarm again.
+
+Metadata are compressed either with zlib, or with zstd (if the zstandard package is installed) using a dictionary
+trained on the first `training_samples` metadata (in a thread, so as not to stall the event loop; the metadata are
+compressed without a dictionary until it is done); dictionaries are stored in the database as well, so that any process
+can decompress the metadata later on. Most of the metadata is the SHA-1 hashes of the pieces, which do not compress,
+hence dictionaries help with the rest (keys, file names and paths) of the small metadata the most.
+"""
+import concurrent.futures
+import logging
+import typing
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import metrics
+from .models import MetadataDictionary
+
+CODEC_ZLIB = 0
+CODEC_ZSTD = 1
+CODECS = {"zlib": CODEC_ZLIB, "zstd": CODEC_ZSTD}
+
+BYTES_IN = metrics.counter("magneticod_raw_metadata_bytes_in_total", "Raw metadata bytes compressed.")
+BYTES_OUT = metrics.counter("magneticod_raw_metadata_bytes_out_total", "Compressed raw metadata bytes.")
+
+
+class Compressor:
+    def __init__(self, codec: str, level: typing.Optional[int] = None, training_samples: int = 1000,
+                 dictionary_size: int = 112640) -> None:
+        if codec not in CODECS:
+            raise ValueError("unknown codec %r (must be one of %s)" % (codec, ", ".join(CODECS)))
+        if codec == "zstd" and zstandard is None:
+            raise ValueError("zstd needs the zstandard package (pip install zstandard)")
+        self.__codec = CODECS[codec]
+        self.__level = level
+        self.__training_samples = training_samples
+        self.__dictionary_size = dictionary_size
+        self.__samples = []  # type: typing.List[bytes]
+        self.__training = None  # type: typing.Optional[concurrent.futures.Future]
+
+        self.__dictionary_id = None  # type: typing.Optional[int]
+        self.__zstd = None
+        if self.__codec == CODEC_ZSTD:
+            # Carry on with the last dictionary trained, if any.
+            dictionary = MetadataDictionary.select().order_by(MetadataDictionary.id.desc()).first()
+            if dictionary:
+                self.__use_dictionary(dictionary.id, bytes(dictionary.data))
+            else:
+                self.__zstd = zstandard.ZstdCompressor(level=level or 3)
+
+    def compress(self, metadata: bytes) -> typing.Tuple[int, typing.Optional[int], bytes]:
+        """ Returns (codec, id of the dictionary or None, compressed metadata). """
+        if self.__codec == CODEC_ZLIB:
+            data = zlib.compress(metadata, 6 if self.__level is None else self.__level)
+        else:
+            if self.__dictionary_id is None and self.__training_samples:
+                if self.__training is None:
+                    self.__collect(metadata)
+                elif self.__training.done():
+                    self.__trained()
+            data = self.__zstd.compress(metadata)
+        BYTES_IN.inc(len(metadata))
+        BYTES_OUT.inc(len(data))
+        return self.__codec, self.__dictionary_id, data
+
+    def __collect(self, metadata: bytes) -> None:
+        self.__samples.append(metadata)
+        if len(self.__samples) < self.__training_samples:
+            return
+        samples, self.__samples = self.__samples, []
+        # zstd releases the GIL while training, which takes seconds.
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.__training = executor.submit(zstandard.train_dictionary, self.__dictionary_size, samples)
+        executor.shutdown(wait=False)
+
+    def __trained(self) -> None:
+        training, self.__training = self.__training, None
+        try:
+            dictionary = training.result()
+        except zstandard.ZstdError:
+            logging.exception("Could NOT train a zstd dictionary for the raw metadata; carrying on without one.",
+                              exc_info=False)
+            self.__training_samples = 0
+            return
+        data = dictionary.as_bytes()
+        # The dictionary is stored by the thread that owns the database connection, hence not by the trainer.
+        self.__use_dictionary(MetadataDictionary.create(data=data).id, data)
+        logging.info("A zstd dictionary (%d bytes) is trained on %d raw metadata.", len(data), self.__training_samples)
+
+    def __use_dictionary(self, dictionary_id: int, data: bytes) -> None:
+        self.__dictionary_id = dictionary_id
+        self.__zstd = zstandard.ZstdCompressor(
+            level=self.__level or 3, dict_data=zstandard.ZstdCompressionDict(data))
+
+
+class Decompressor:
+    """ `dictionaries` is a mapping from the ids of the dictionaries to their data. """
+    def __init__(self, dictionaries: typing.Mapping[int, bytes]) -> None:
+        self.__dictionaries = dictionaries
+        # dictionary id (or None) -> zstd decompressor
+        self.__zstd = {}  # type: typing.Dict[typing.Optional[int], typing.Any]
+
+    def decompress(self, codec: int, dictionary_id: typing.Optional[int], data: bytes) -> bytes:
+        if codec == CODEC_ZLIB:
+            return zlib.decompress(data)
+        if codec != CODEC_ZSTD:
+            raise ValueError("unknown codec %d" % (codec,))
+        if zstandard is None:
+            raise ValueError("zstd needs the zstandard package (pip install zstandard)")
+        decompressor = self.__zstd.get(dictionary_id)
+        if decompressor is None:
+            if dictionary_id is None:
+                decompressor = zstandard.ZstdDecompressor()
+            else:
+                decompressor = zstandard.ZstdDecompressor(
+                    dict_data=zstandard.ZstdCompressionDict(self.__dictionaries[dictionary_id]))
+            self.__zstd[dictionary_id] = decompressor
+        return decompressor.decompress(data)
@@ -0,0 +1,187 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Offline replay of capture files (`magneticod replay`) through a SybilNode, for repeatable profiles of the real packet
+mix.
+
+Nothing is put on the network: sends are counted (and optionally captured) by a ReplayTransport, info hashes are
+checked against an in-memory set instead of a database, and fetches are only counted by a RecordingFetchEngine. Ticks
+are driven by the capture's clock rather than the wall clock.
+
+Fetches never succeed: every job fails as soon as the replay yields to the event loop, so that the failed fetches are
+looked up as they would be live. No metadata is ever queued, hence the writer pressure (and the shedding it causes) is
+not replayed.
+
+A replay is not deterministic though: besides the random IDs and tokens of the node, everything that expires inside it
+(the recent nodes and lookups, the transactions, the memcached cache) still follows the wall clock, so a faster replay
+remembers more and times out less than the live node did. Only `speed` 1 comes close to the original run.
+"""
+import asyncio
+import time
+import typing
+
+from . import capture
+from . import fetch
+
+InfoHash = bytes
+PeerAddress = typing.Tuple[str, int]
+
+
+class ReplayTransport(asyncio.DatagramTransport):
+    def __init__(self, sends: typing.Optional[capture.CaptureWriter] = None) -> None:
+        super().__init__()
+        self.__sends = sends
+        self.__closing = False
+        self.__limits = (0, 0)
+        self.n_sent = 0
+        self.bytes_sent = 0
+        # Timestamp of the datagram being replayed, recorded with the sends it causes.
+        self.now = 0.0
+
+    def sendto(self, data: bytes, addr: typing.Any = None) -> None:
+        self.n_sent += 1
+        self.bytes_sent += len(data)
+        if self.__sends:
+            self.__sends.append(data, addr, self.now)
+
+    def get_write_buffer_limits(self) -> typing.Tuple[int, int]:
+        return self.__limits
+
+    def set_write_buffer_limits(self, high: typing.Optional[int] = None, low: typing.Optional[int] = None) -> None:
+        self.__limits = (low or 0, high or 0)
+
+    def get_write_buffer_size(self) -> int:
+        return 0
+
+    def is_closing(self) -> bool:
+        return self.__closing
+
+    def close(self) -> None:
+        self.__closing = True
+
+    def abort(self) -> None:
+        self.__closing = True
+
+
+class RecordingFetchEngine:
+    """
+    FetchEngine look-alike that fetches nothing, and only counts what it would have fetched. Its jobs fail as soon as
+    the event loop gets to run the callbacks it schedules.
+    """
+    def __init__(self, on_done: typing.Callable[[fetch.FetchJob], None]) -> None:
+        self.__on_done = on_done
+        self.__jobs = {}  # type: typing.Dict[InfoHash, fetch.FetchJob]
+        self.__fail_handle = None  # type: typing.Optional[asyncio.Handle]
+        self.n_active = 0
+        self.n_peers = 0
+
+    def __len__(self) -> int:
+        return len(self.__jobs)
+
+    def __contains__(self, info_hash: InfoHash) -> bool:
+        return info_hash in self.__jobs
+
+    def peers_of(self, info_hash: InfoHash) -> int:
+        job = self.__jobs.get(info_hash)
+        return job.peers_tried if job else 0
+
+    def add_peer(self, info_hash: InfoHash, peer_addr: PeerAddress) -> bool:
+        job = self.__jobs.get(info_hash)
+        if job is None:
+            job = self.__jobs[info_hash] = fetch.FetchJob(info_hash)
+            if self.__fail_handle is None:
+                self.__fail_handle = asyncio.get_event_loop().call_soon(self.__fail_jobs)
+        job.peers_tried += 1
+        self.n_active += 1
+        self.n_peers += 1
+        return True
+
+    def add_peers(self, info_hash: InfoHash, peers: typing.List[PeerAddress]) -> bool:
+        for peer_addr in peers:
+            self.add_peer(info_hash, peer_addr)
+        return True
+
+    def cancel(self, info_hash: InfoHash) -> None:
+        job = self.__jobs.pop(info_hash, None)
+        if job is not None:
+            self.n_active -= job.peers_tried
+
+    def shutdown(self) -> None:
+        if self.__fail_handle:
+            self.__fail_handle.cancel()
+            self.__fail_handle = None
+        self.__jobs.clear()
+        self.n_active = 0
+
+    def __fail_jobs(self) -> None:
+        self.__fail_handle = None
+        jobs, self.__jobs = self.__jobs, {}
+        self.n_active = 0
+        for job in jobs.values():
+            job.state = fetch.FAILED
+            job.peers_failed = job.peers_tried
+            job.finished_on = time.monotonic()
+            self.__on_done(job)
+
+
+class InMemoryInfoHashes:
+    """ In-memory stand-in for `Database.is_infohash_new`. """
+    def __init__(self) -> None:
+        self.__seen = set()  # type: typing.Set[InfoHash]
+
+    def __call__(self, info_hash: InfoHash, skip_check: bool = False) -> typing.Optional[bool]:
+        if skip_check:
+            return None
+        if info_hash in self.__seen:
+            return False
+        self.__seen.add(info_hash)
+        return True
+
+
+async def replay(node: typing.Any, transport: ReplayTransport, paths: typing.List[str], speed: float = 0,
+                 tick_interval: float = 1) -> int:
+    """
+    Feeds the datagrams of the capture files (in the given order) to `node`, which must have been created with
+    `stats_interval=None` (so that it is ticked by us) and connected to `transport`.
+
+    With `speed` > 0 the original pacing is kept (2 is twice as fast as the capture); otherwise the datagrams are fed
+    as fast as possible, yielding to the event loop every now and then. Returns the number of datagrams replayed.
+    """
+    n = 0
+    first_timestamp = None  # type: typing.Optional[float]
+    next_tick = 0.0
+    started_on = time.monotonic()
+    for path in paths:
+        for timestamp, addr, data in capture.read_capture(path):
+            if first_timestamp is None:
+                first_timestamp = timestamp
+                next_tick = timestamp + tick_interval
+
+            while timestamp >= next_tick:
+                transport.now = next_tick
+                await node.tick(bootstrap=False)
+                next_tick += tick_interval
+
+            if speed > 0:
+                delay = (timestamp - first_timestamp) / speed - (time.monotonic() - started_on)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif n % 1024 == 0:
+                await asyncio.sleep(0)
+
+            transport.now = timestamp
+            node.datagram_received(data, addr)
+            n += 1
+    return n
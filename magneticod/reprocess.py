@@ -0,0 +1,135 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Reprocessing of the raw metadata stored in the database (`magneticod reprocess`), e.g. to backfill a new column.
+
+The raw metadata are read in chunks, in the order of their ids, and decompressed and decoded in a pool of processes by
+a *function* (given as MODULE:FUNCTION) that is called with the info hash and the info dictionary of every torrent, and
+returns the columns of the torrent to be updated (or None to leave it as it is). Updates are committed in a single
+transaction per chunk, while the next chunk is being processed.
+"""
+import concurrent.futures
+import importlib
+import logging
+import time
+import typing
+
+from . import bencode
+from . import rawmetadata
+from .models import database_proxy, MetadataDictionary, RawMetadata, Torrent
+
+# (torrent id, info hash, codec, dictionary id, compressed metadata)
+Row = typing.Tuple[int, bytes, int, typing.Optional[int], bytes]
+Function = typing.Callable[[bytes, typing.Dict], typing.Optional[typing.Dict[str, typing.Any]]]
+
+DEFAULT_FUNCTION = "magneticod.reprocess:torrent_fields"
+
+
+def torrent_fields(info_hash: bytes, info: typing.Dict) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """ Recomputes the name and the total size of the torrent, the same way `Database.add_metadata` does. """
+    if b"files" in info:
+        total_size = sum(file[b"length"] for file in info[b"files"])
+    else:
+        total_size = info[b"length"]
+    return {"name": info[b"name"].decode("utf-8"), "total_size": total_size}
+
+
+def load_function(path: str) -> Function:
+    module, _, name = path.partition(":")
+    if not name:
+        raise ValueError("%r is not MODULE:FUNCTION" % (path,))
+    return getattr(importlib.import_module(module), name)
+
+
+# State of the worker processes, set up by _initialize().
+_decompressor = None  # type: typing.Optional[rawmetadata.Decompressor]
+_function = None  # type: typing.Optional[Function]
+
+
+def _initialize(dictionaries: typing.Dict[int, bytes], function: str) -> None:
+    global _decompressor, _function
+    _decompressor = rawmetadata.Decompressor(dictionaries)
+    _function = load_function(function)
+
+
+def _process(rows: typing.List[Row]) -> typing.Tuple[typing.List[typing.Tuple[int, typing.Dict]], int]:
+    """ Returns the updates, and the number of torrents that could NOT be processed. """
+    updates = []
+    n_failed = 0
+    for torrent_id, info_hash, codec, dictionary_id, data in rows:
+        try:
+            fields = _function(info_hash, bencode.loads(_decompressor.decompress(codec, dictionary_id, data)))
+        except Exception:
+            n_failed += 1
+            continue
+        if fields:
+            updates.append((torrent_id, fields))
+    return updates, n_failed
+
+
+def reprocess(function: str = DEFAULT_FUNCTION, n_processes: typing.Optional[int] = None, chunk_size: int = 10000,
+              batch_size: int = 500) -> int:
+    """ Reprocesses all the raw metadata in the database, and returns the number of torrents updated. """
+    load_function(function)  # fail early, in this process
+    database_proxy.create_tables([MetadataDictionary, RawMetadata], safe=True)
+    dictionaries = {d.id: bytes(d.data) for d in MetadataDictionary.select()}
+
+    n_updated = n_failed = n = 0
+    last_id = 0
+    started_on = reported_on = time.monotonic()
+    with concurrent.futures.ProcessPoolExecutor(n_processes, initializer=_initialize,
+                                                initargs=(dictionaries, function)) as executor:
+        pending = []  # type: typing.List[concurrent.futures.Future]
+        while True:
+            rows = [
+                (raw_id, torrent_id, bytes(info_hash), codec, dictionary_id, bytes(data))
+                for raw_id, torrent_id, info_hash, codec, dictionary_id, data in
+                RawMetadata.select(RawMetadata.id, RawMetadata.torrent, Torrent.info_hash, RawMetadata.codec,
+                                   RawMetadata.dictionary, RawMetadata.data)
+                .join(Torrent)
+                .where(RawMetadata.id > last_id)
+                .order_by(RawMetadata.id)
+                .limit(chunk_size)
+                .tuples()
+            ]
+
+            # Commit the previous chunk while this one is being processed.
+            next_pending = [
+                executor.submit(_process, [row[1:] for row in rows[i:i + batch_size]])
+                for i in range(0, len(rows), batch_size)
+            ]
+            with database_proxy.atomic():
+                for future in pending:
+                    updates, failed = future.result()
+                    n_failed += failed
+                    for torrent_id, fields in updates:
+                        Torrent.update(**fields).where(Torrent.id == torrent_id).execute()
+                    n_updated += len(updates)
+            pending = next_pending
+
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            n += len(rows)
+
+            now = time.monotonic()
+            if now - reported_on >= 10:
+                logging.info("Reprocess: %d torrents in total (%.0f/s), at raw metadata #%d.",
+                             n, n / (now - started_on), last_id)
+                reported_on = now
+
+    logging.info("Reprocess: %d torrents are reprocessed in %.1fs; %d updated, %d could NOT be processed.",
+                 n, time.monotonic() - started_on, n_updated, n_failed)
+    return n_updated
@@ -0,0 +1,145 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Full-text index of the names and the file paths of the torrents (`--search-index`), and its queries.
+
+    SQLite      a contentless FTS5 table, `torrents_fts(name, paths)`, whose rowids are the ids of the torrents
+    PostgreSQL  a table `torrents_search(torrent_id, document)` of weighted tsvectors, with a GIN index
+
+The index is fed by persistence.Database in the same transaction as the torrents themselves. Names and paths are
+split into words at every non-alphanumeric character (so that e.g. `Some.Show.S01E02.mkv` is found by `show s01e02`)
+before they are indexed, and queries are split the same way; all of their words must match.
+"""
+import re
+import typing
+
+import peewee
+
+# Texts are indexed with these (e.g. "/" instead of "." or "_") between the words.
+_NON_WORD = re.compile(r"[\W_]+")
+# Longest text of paths indexed per torrent, in characters (tsvectors cannot be longer than 1 MiB).
+MAX_PATHS_LENGTH = 256 * 1024
+
+Result = typing.Tuple[bytes, str, int, int, float]  # info hash, name, total size, discovered on, rank
+
+
+def words(text: str) -> typing.List[str]:
+    return _NON_WORD.sub(" ", text).split()
+
+
+def document(name: str, paths: typing.Iterable[str]) -> typing.Tuple[str, str]:
+    """ Returns the texts of the name and of the paths of a torrent, to be indexed. """
+    paths_text = " ".join(" ".join(words(path)) for path in paths)
+    return " ".join(words(name)), paths_text[:MAX_PATHS_LENGTH]
+
+
+class SqliteSearchIndex:
+    # Variables per INSERT, staying below SQLITE_MAX_VARIABLE_NUMBER (999) of the older SQLite builds.
+    _ROWS_PER_INSERT = 300
+
+    def __init__(self, database: peewee.Database) -> None:
+        self.__database = database
+
+    def create(self) -> None:
+        self.__database.execute_sql(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS torrents_fts USING fts5(name, paths, content='', tokenize='unicode61')")
+
+    def add(self, documents: typing.Sequence[typing.Tuple[int, str, str]]) -> None:
+        """ Indexes (torrent id, name, paths) documents, as returned by `document()`. """
+        for i in range(0, len(documents), self._ROWS_PER_INSERT):
+            chunk = documents[i:i + self._ROWS_PER_INSERT]
+            self.__database.execute_sql(
+                "INSERT INTO torrents_fts (rowid, name, paths) VALUES " + ", ".join(["(?, ?, ?)"] * len(chunk)),
+                [value for row in chunk for value in row])
+
+    def unindexed(self, after_id: int, limit: int) -> typing.List[typing.Tuple[int, str]]:
+        """ Returns the (id, name) of up to `limit` torrents (with ids greater than `after_id`) not indexed yet. """
+        return list(self.__database.execute_sql(
+            "SELECT id, name FROM torrents WHERE id > ? AND NOT EXISTS "
+            "(SELECT 1 FROM torrents_fts WHERE torrents_fts.rowid = torrents.id) ORDER BY id LIMIT ?",
+            (after_id, limit)))
+
+    def search(self, query: str, limit: int) -> typing.List[Result]:
+        query_words = words(query)
+        if not query_words:
+            return []
+        # Every word is quoted, so that they are not taken for the operators of FTS5's query syntax.
+        match = " ".join('"%s"' % (word.replace('"', '""'),) for word in query_words)
+        # bm25() is lower for better matches; names weigh more than the paths.
+        return [
+            (bytes(info_hash), name, total_size, discovered_on, -rank)
+            for info_hash, name, total_size, discovered_on, rank in self.__database.execute_sql(
+                "SELECT torrents.info_hash, torrents.name, torrents.total_size, torrents.discovered_on, matches.rank "
+                "FROM (SELECT rowid, bm25(torrents_fts, 10.0, 1.0) AS rank FROM torrents_fts "
+                "WHERE torrents_fts MATCH ? ORDER BY rank LIMIT ?) AS matches "
+                "JOIN torrents ON torrents.id = matches.rowid ORDER BY matches.rank",
+                (match, limit))
+        ]
+
+
+class PostgresqlSearchIndex:
+    _VECTOR = "setweight(to_tsvector('simple', %s), 'A') || setweight(to_tsvector('simple', %s), 'B')"
+
+    def __init__(self, database: peewee.Database) -> None:
+        self.__database = database
+
+    def create(self) -> None:
+        self.__database.execute_sql(
+            "CREATE TABLE IF NOT EXISTS torrents_search ("
+            "torrent_id INTEGER PRIMARY KEY REFERENCES torrents (id) ON DELETE CASCADE, document TSVECTOR NOT NULL)")
+        self.__database.execute_sql(
+            "CREATE INDEX IF NOT EXISTS torrents_search_document ON torrents_search USING GIN (document)")
+
+    def add(self, documents: typing.Sequence[typing.Tuple[int, str, str]]) -> None:
+        """ Indexes (torrent id, name, paths) documents, as returned by `document()`. """
+        if not documents:
+            return
+        self.__database.execute_sql(
+            "INSERT INTO torrents_search (torrent_id, document) VALUES "
+            + ", ".join(["(%%s, %s)" % (self._VECTOR,)] * len(documents)),
+            [value for row in documents for value in row])
+
+    def unindexed(self, after_id: int, limit: int) -> typing.List[typing.Tuple[int, str]]:
+        """ Returns the (id, name) of up to `limit` torrents (with ids greater than `after_id`) not indexed yet. """
+        return list(self.__database.execute_sql(
+            "SELECT id, name FROM torrents WHERE id > %s AND NOT EXISTS "
+            "(SELECT 1 FROM torrents_search WHERE torrents_search.torrent_id = torrents.id) ORDER BY id LIMIT %s",
+            (after_id, limit)))
+
+    def search(self, query: str, limit: int) -> typing.List[Result]:
+        query_words = words(query)
+        if not query_words:
+            return []
+        return [
+            (bytes(info_hash), name, total_size, discovered_on, rank)
+            for info_hash, name, total_size, discovered_on, rank in self.__database.execute_sql(
+                "SELECT torrents.info_hash, torrents.name, torrents.total_size, torrents.discovered_on, "
+                "ts_rank(torrents_search.document, query) AS rank "
+                "FROM torrents_search JOIN torrents ON torrents.id = torrents_search.torrent_id, "
+                "plainto_tsquery('simple', %s) AS query WHERE torrents_search.document @@ query "
+                "ORDER BY rank DESC LIMIT %s",
+                (" ".join(query_words), limit))
+        ]
+
+
+SearchIndex = typing.Union[SqliteSearchIndex, PostgresqlSearchIndex]
+
+
+def search_index(database: peewee.Database) -> SearchIndex:
+    if isinstance(database, peewee.SqliteDatabase):
+        return SqliteSearchIndex(database)
+    if isinstance(database, peewee.PostgresqlDatabase):
+        return PostgresqlSearchIndex(database)
+    raise ValueError("the search index is supported on SQLite and PostgreSQL only")
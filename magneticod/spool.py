@@ -0,0 +1,241 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Durable, append-only spool of fetched metadata (`--spool`), so that the metadata fetched while the database is down
+are not lost but added to it in bulk once it is back.
+
+The spool is a directory of segment files (`segment.<sequence number>.bin`), each starting with an 8 bytes header
+(magic, version, 3 reserved bytes) followed by variable-width records: a little-endian fixed header (length of the
+metadata (u32), CRC-32 of the rest of the record (u32), discovered on (f64), fetch time (f64), info hash (20 bytes))
+followed by the metadata itself. Segments are rotated once they are `segment_size` bytes long, and deleted once all of
+their records are in the database.
+
+Records the database refuses for good (e.g. because of a constraint) are moved to `deadletter.bin`, which has the same
+format as the segments, so that they do not hold the rest of the spool back.
+
+Records are fsync'ed in batches (every `sync_bytes` bytes or `sync_interval` seconds, whichever comes first, see
+`sync_due`), hence the last ones might be lost if the machine (but not merely the process) crashes. `append` never
+fsyncs: `sync` is meant to be called in another thread, so that the event loop is not blocked meanwhile.
+"""
+import logging
+import os
+import re
+import struct
+import threading
+import time
+import typing
+import zlib
+
+from . import metrics
+
+MAGIC = b"MGSP"
+VERSION = 1
+HEADER = struct.Struct("<4sBxxx")
+RECORD = struct.Struct("<IIdd20s")
+
+InfoHash = bytes
+# (sequence number of the segment, offset in the segment)
+Position = typing.Tuple[int, int]
+
+DEAD_LETTERS = "deadletter.bin"
+
+_SEGMENT_NAME = re.compile(r"^segment\.(\d+)\.bin$")
+
+RECORDS_WRITTEN = metrics.counter("magneticod_spool_records_written_total", "Metadata written to the spool.")
+RECORDS_DEAD_LETTERED = metrics.counter(
+    "magneticod_spool_records_dead_lettered_total",
+    "Spooled metadata moved to the dead letters, as the database refuses them.")
+RECORDS_CORRUPT = metrics.counter(
+    "magneticod_spool_records_corrupt_total", "Spooled metadata skipped because they failed their checksum.")
+SYNC_DURATION = metrics.histogram("magneticod_spool_sync_duration_seconds", "Time it takes to fsync the spool.")
+SIZE = metrics.gauge("magneticod_spool_bytes", "Size of the spool (of the segments not deleted yet).")
+
+
+class Spool:
+    def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024, sync_interval: float = 1.0,
+                 sync_bytes: int = 1024 * 1024) -> None:
+        self.__directory = directory
+        self.__segment_size = segment_size
+        self.__sync_interval = sync_interval
+        self.__sync_bytes = sync_bytes
+
+        os.makedirs(directory, exist_ok=True)
+        # sequence number -> size of the segments on the disk, including the one being written to
+        self.__segments = {}  # type: typing.Dict[int, int]
+        for name in os.listdir(directory):
+            match = _SEGMENT_NAME.match(name)
+            if match:
+                self.__segments[int(match.group(1))] = os.path.getsize(os.path.join(directory, name))
+        SIZE.inc(sum(self.__segments.values()))
+
+        # Segments left over by the previous run (of which we know nothing) are never appended to.
+        self.__file = None  # type: typing.Optional[typing.BinaryIO]
+        self.__sequence = max(self.__segments, default=0)
+        self.__offset = 0
+        # Guards the file and the bookkeeping of what is synced against sync() in another thread.
+        self.__lock = threading.Lock()
+        self.__unsynced = 0
+        # Descriptors of the rotated segments, to be fsync'ed (and closed) by the next sync().
+        self.__rotated = []  # type: typing.List[int]
+        self.__synced_on = time.monotonic()
+        self.__rotate()
+
+    @property
+    def oldest(self) -> typing.Optional[Position]:
+        """ Position of the first record of the oldest segment, if there is any record in the spool. """
+        for sequence in sorted(self.__segments):
+            if self.__segments[sequence] > HEADER.size:
+                return sequence, HEADER.size
+        return None
+
+    @property
+    def position(self) -> Position:
+        """ Position of the next record to be appended. """
+        return self.__sequence, self.__offset
+
+    @property
+    def sync_due(self) -> bool:
+        return self.__unsynced >= self.__sync_bytes or \
+            (self.__unsynced > 0 and time.monotonic() - self.__synced_on >= self.__sync_interval)
+
+    def append(self, info_hash: InfoHash, metadata: bytes, fetch_time: float, discovered_on: float) -> Position:
+        """ Appends a record and returns its position. """
+        if self.__offset >= self.__segment_size:
+            self.__rotate()
+        position = self.position
+        size = RECORD.size + len(metadata)
+        with self.__lock:
+            self.__file.write(_pack_record(info_hash, metadata, fetch_time, discovered_on))
+            self.__file.write(metadata)
+            self.__unsynced += size
+
+        self.__offset += size
+        self.__segments[self.__sequence] = self.__offset
+        RECORDS_WRITTEN.inc()
+        SIZE.inc(size)
+        return position
+
+    def sync(self) -> None:
+        """ Fsyncs what has been appended so far; can be called from any thread. """
+        with self.__lock:
+            unsynced = self.__unsynced
+            descriptors, self.__rotated = self.__rotated, []
+            if unsynced:
+                self.__file.flush()
+                # A descriptor of our own, since the file might be rotated (and closed) while we are fsyncing it.
+                descriptors.append(os.dup(self.__file.fileno()))
+        started_on = time.monotonic()
+        try:
+            for descriptor in descriptors:
+                os.fsync(descriptor)
+        finally:
+            for descriptor in descriptors:
+                os.close(descriptor)
+        with self.__lock:
+            self.__unsynced -= unsynced
+        if unsynced:
+            SYNC_DURATION.observe(time.monotonic() - started_on)
+        self.__synced_on = time.monotonic()
+
+    def read(self, start: Position) -> typing.Iterator[typing.Tuple[Position, InfoHash, bytes, float, float]]:
+        """
+        Yields (position of the next record, info hash, metadata, fetch time, discovered on) tuples of the records from
+        `start` on, up to the last one appended (when the iteration has started).
+        """
+        with self.__lock:
+            self.__file.flush()
+        end = self.position
+        for sequence in sorted(s for s in self.__segments if s >= start[0]):
+            offset = start[1] if sequence == start[0] else HEADER.size
+            size = self.__segments[sequence] if sequence != end[0] else end[1]
+            with open(self.__path(sequence), "rb") as file:
+                header = file.read(HEADER.size)
+                if len(header) != HEADER.size or HEADER.unpack(header) != (MAGIC, VERSION):
+                    logging.warning("Spool segment %d is not a spool segment (or of an unknown version); skipping it.",
+                                    sequence)
+                    continue
+                file.seek(offset)
+                while offset + RECORD.size <= size:
+                    record = file.read(RECORD.size)
+                    length, checksum, discovered_on, fetch_time, info_hash = RECORD.unpack(record)
+                    metadata = file.read(length)
+                    if len(metadata) != length or zlib.crc32(metadata, zlib.crc32(record[8:])) != checksum:
+                        # A torn write at the end of a segment (after a crash), or a corrupt one; either way, nothing
+                        # after it can be trusted.
+                        RECORDS_CORRUPT.inc()
+                        logging.warning("Spool segment %d is corrupt at offset %d; skipping the rest of it.",
+                                        sequence, offset)
+                        break
+                    offset += RECORD.size + length
+                    yield (sequence, offset), info_hash, metadata, fetch_time, discovered_on
+            if sequence == end[0]:
+                return
+
+    def release(self, position: Position) -> None:
+        """
+        Deletes the segments all of whose records are before `position` (i.e. are in the database), except the one
+        being written to, which is deleted once it is rotated (and released again).
+        """
+        for sequence in sorted(self.__segments):
+            if sequence == self.__sequence or sequence > position[0] or \
+                    (sequence == position[0] and position[1] < self.__segments[sequence]):
+                return
+            SIZE.dec(self.__segments.pop(sequence))
+            os.remove(self.__path(sequence))
+
+    def dead_letter(self, info_hash: InfoHash, metadata: bytes, fetch_time: float, discovered_on: float) -> None:
+        """ Appends a record to the dead letters (and fsyncs them, which is rare enough). """
+        path = os.path.join(self.__directory, DEAD_LETTERS)
+        with open(path, "ab") as file:
+            if file.tell() == 0:
+                file.write(HEADER.pack(MAGIC, VERSION))
+            file.write(_pack_record(info_hash, metadata, fetch_time, discovered_on))
+            file.write(metadata)
+            file.flush()
+            os.fsync(file.fileno())
+        RECORDS_DEAD_LETTERED.inc()
+
+    def close(self) -> None:
+        if self.__file:
+            self.sync()
+            with self.__lock:
+                self.__file.close()
+                self.__file = None
+
+    def __rotate(self) -> None:
+        file = open(self.__path(self.__sequence + 1), "wb")
+        file.write(HEADER.pack(MAGIC, VERSION))
+        with self.__lock:
+            if self.__file:
+                # The rotated segment is fsync'ed by the next sync(), not here.
+                self.__file.flush()
+                self.__rotated.append(os.dup(self.__file.fileno()))
+                self.__file.close()
+            self.__file = file
+            self.__unsynced += HEADER.size
+        self.__sequence += 1
+        self.__offset = HEADER.size
+        self.__segments[self.__sequence] = self.__offset
+        SIZE.inc(HEADER.size)
+
+    def __path(self, sequence: int) -> str:
+        return os.path.join(self.__directory, "segment.%016d.bin" % (sequence,))
+
+
+def _pack_record(info_hash: InfoHash, metadata: bytes, fetch_time: float, discovered_on: float) -> bytes:
+    """ Returns the fixed header of the record of `metadata`. """
+    rest = RECORD.pack(len(metadata), 0, discovered_on, fetch_time, info_hash)[8:]
+    checksum = zlib.crc32(metadata, zlib.crc32(rest))
+    return RECORD.pack(len(metadata), checksum, discovered_on, fetch_time, info_hash)
@@ -0,0 +1,248 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Binary, rotating stats logs (`--stats`).
+
+Every file starts with an 8 bytes header (magic, version, record kind, 2 reserved bytes) followed by fixed-width,
+little-endian records:
+
+    KIND_NODES   timestamp (f64), IPv4 (4 bytes), port (u16), number of nodes in the find_node response (u16)
+    KIND_HASHES  timestamp (f64), IPv4 (4 bytes), port (u16), info hash (20 bytes)
+
+Records are appended to a ring of preallocated chunks in memory, and sealed chunks are written to the disk by a
+background task (in a thread) every `flush_interval` seconds or as soon as a chunk fills up. If the disk cannot keep up
+and the ring is full, records are dropped (and counted) instead of blocking the event loop.
+"""
+import asyncio
+import datetime
+import logging
+import os
+import socket
+import struct
+import time
+import typing
+
+from . import metrics
+
+MAGIC = b"MGSL"
+VERSION = 1
+HEADER = struct.Struct("<4sBBxx")
+
+KIND_NODES = 1
+KIND_HASHES = 2
+
+RECORDS = {
+    KIND_NODES: struct.Struct("<d4sHH"),
+    KIND_HASHES: struct.Struct("<d4sH20s"),
+}
+# Seconds before trying to open a new file again when rotating failed (the old one is written to meanwhile).
+ROTATE_RETRY_INTERVAL = 60
+
+FILE_PREFIXES = {
+    KIND_NODES: "nodes",
+    KIND_HASHES: "hashes",
+}
+
+RECORDS_WRITTEN = metrics.counter(
+    "magneticod_statslog_records_written_total", "Records written to the stats logs, by kind.", ["kind"])
+RECORDS_DROPPED = metrics.counter(
+    "magneticod_statslog_records_dropped_total",
+    "Records dropped because the stats log buffer was full or could not be written, by kind.", ["kind"])
+
+
+class StatsLog:
+    def __init__(self, directory: str, kind: int, max_file_size: int = 64 * 1024 * 1024,
+                 rotate_interval: float = 3600, flush_interval: float = 1.0, chunk_records: int = 4096,
+                 n_chunks: int = 16) -> None:
+        self.__directory = directory
+        self.__kind = kind
+        self.__record = RECORDS[kind]
+        self.__max_file_size = max_file_size
+        self.__rotate_interval = rotate_interval
+        self.__flush_interval = flush_interval
+        self.__written = RECORDS_WRITTEN.labels(FILE_PREFIXES[kind])
+        self.__dropped = RECORDS_DROPPED.labels(FILE_PREFIXES[kind])
+
+        self.__chunk_records = chunk_records
+        self.__chunks = [bytearray(chunk_records * self.__record.size) for _ in range(n_chunks)]
+        self.__lengths = [0] * n_chunks  # number of records in each chunk
+        self.__head = 0  # chunk being filled
+        self.__tail = 0  # oldest sealed chunk, to be written next
+        self.__n_sealed = 0
+
+        self.__file = None  # type: typing.Optional[typing.BinaryIO]
+        self.__file_size = 0
+        self.__file_opened_on = 0.0
+        self.__next_rotation_on = 0.0
+
+        self.__wakeup = None  # type: typing.Optional[asyncio.Event]
+        self.__writer_task = None  # type: typing.Optional[asyncio.Task]
+        self.__closing = False
+
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self) -> None:
+        self.__wakeup = asyncio.Event()
+        self.__writer_task = asyncio.get_event_loop().create_task(self.__write_periodically())
+
+    def append(self, *fields: typing.Any) -> None:
+        """ Appends a record (without the timestamp, which is added here) to the buffer. Never blocks. """
+        length = self.__lengths[self.__head]
+        if length == self.__chunk_records:
+            if not self.__seal():
+                self.__dropped.inc()
+                return
+            length = 0
+        self.__record.pack_into(self.__chunks[self.__head], length * self.__record.size, time.time(), *fields)
+        self.__lengths[self.__head] = length + 1
+
+    async def close(self) -> None:
+        if self.__writer_task:
+            # Let the writer finish (instead of cancelling it) so that no thread is left writing to the file.
+            self.__closing = True
+            self.__wakeup.set()
+            await asyncio.wait([self.__writer_task])
+            self.__writer_task = None
+        else:
+            self.__seal()
+            self.__release(self.__write(self.__sealed_chunks()))
+        if self.__file:
+            self.__file.close()
+            self.__file = None
+
+    def __seal(self) -> bool:
+        """ Seals the head chunk (if it's not empty) and moves onto the next one; False if there is none free. """
+        if self.__lengths[self.__head] == 0:
+            return True
+        if self.__n_sealed == len(self.__chunks) - 1:
+            return False
+        self.__head = (self.__head + 1) % len(self.__chunks)
+        self.__n_sealed += 1
+        if self.__wakeup:
+            self.__wakeup.set()
+        return True
+
+    def __sealed_chunks(self) -> typing.List[memoryview]:
+        return [
+            memoryview(self.__chunks[i])[:self.__lengths[i] * self.__record.size]
+            for i in ((self.__tail + n) % len(self.__chunks) for n in range(self.__n_sealed))
+        ]
+
+    def __release(self, written: typing.List[bool]) -> None:
+        """ Releases the oldest sealed chunks, one for each element of `written` (whether the chunk was written). """
+        for is_written in written:
+            (self.__written if is_written else self.__dropped).inc(self.__lengths[self.__tail])
+            self.__lengths[self.__tail] = 0
+            self.__tail = (self.__tail + 1) % len(self.__chunks)
+            self.__n_sealed -= 1
+
+    async def __write_periodically(self) -> None:
+        event_loop = asyncio.get_event_loop()
+        while not self.__closing:
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), timeout=self.__flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.__wakeup.clear()
+            self.__seal()
+
+            # Sealed chunks are never touched by append() until they are released, and all the bookkeeping is done in
+            # the event loop's thread, so it's safe to write them in another thread.
+            chunks = self.__sealed_chunks()
+            if not chunks:
+                continue
+            try:
+                written = await event_loop.run_in_executor(None, self.__write, chunks)
+            except Exception:
+                logging.exception("Could NOT write the stats log!")
+                written = [False] * len(chunks)
+            self.__release(written)
+
+        # Whatever has been appended while we were writing the last time.
+        self.__seal()
+        self.__release(self.__write(self.__sealed_chunks()))
+
+    def __write(self, chunks: typing.List[memoryview]) -> typing.List[bool]:
+        """ Returns whether each of the chunks is written. """
+        written = []
+        for data in chunks:
+            try:
+                self.__rotate_if_needed(len(data))
+                self.__file.write(data)
+                self.__file.flush()
+            except (OSError, ValueError):
+                logging.exception("Could NOT write the stats log!", exc_info=False)
+                written.append(False)
+                continue
+            self.__file_size += len(data)
+            written.append(True)
+        return written
+
+    def __rotate_if_needed(self, incoming: int) -> None:
+        now = time.monotonic()
+        if self.__file:
+            if self.__file_size + incoming <= self.__max_file_size and \
+                    now - self.__file_opened_on < self.__rotate_interval:
+                return
+            if now < self.__next_rotation_on:
+                return
+
+        path = os.path.join(self.__directory, "%s.%s.bin" % (
+            FILE_PREFIXES[self.__kind], datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")))
+        # Open the new file first, so that we carry on with the old one if it cannot be opened.
+        try:
+            file = open(path, "wb")
+        except OSError:
+            if not self.__file:
+                raise
+            logging.exception("Could NOT open a new stats log; carrying on with %s.", self.__file.name, exc_info=False)
+            self.__next_rotation_on = now + ROTATE_RETRY_INTERVAL
+            return
+        if self.__file:
+            self.__file.close()
+        self.__file = file
+        self.__file.write(HEADER.pack(MAGIC, VERSION, self.__kind))
+        self.__file_size = HEADER.size
+        self.__file_opened_on = now
+
+
+def read_records(path: str) -> typing.Iterator[typing.Tuple[int, typing.Tuple]]:
+    """ Yields (kind, record) tuples from a stats log. """
+    with open(path, "rb") as file:
+        header = file.read(HEADER.size)
+        if len(header) != HEADER.size:
+            raise ValueError("%s is not a stats log (it is too short)" % (path,))
+        magic, version, kind = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or kind not in RECORDS:
+            raise ValueError("%s is not a stats log (or of an unknown version)" % (path,))
+        record = RECORDS[kind]
+        while True:
+            data = file.read(record.size * 4096)
+            if not data:
+                return
+            # A file that is being written to might end with a partial record.
+            data = data[:len(data) - len(data) % record.size]
+            for fields in record.iter_unpack(data):
+                yield kind, fields
+
+
+def format_record(kind: int, fields: typing.Tuple) -> str:
+    timestamp, ip, port, value = fields
+    return "%s %s:%d %s" % (
+        datetime.datetime.fromtimestamp(timestamp).isoformat(),
+        socket.inet_ntoa(ip),
+        port,
+        value.hex() if kind == KIND_HASHES else value
+    )
@@ -0,0 +1,282 @@
+# magneticod - Autonomous BitTorrent DHT crawler and metadata fetcher.
+# Copyright (C) 2017  Mert Bora ALPER <bora@boramalper.org>
+# Dedicated to Cemile Binay, in whose hands I thrived.
+#
+# This program is free software: you can redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+"""
+Metadata fetching in a pool of worker processes.
+
+Every worker runs its own event loop and FetchEngine, and talks to the main process over a UNIX socket pair using
+length-prefixed pickles. Jobs for the same info hash always go to the same worker, so that the worker can enforce the
+peers-per-hash limit on its own. Sockets are driven by asyncio streams on both sides, hence neither side can ever block
+the other however large the metadata is.
+
+Every submission carries a sequence number, and results carry the one of the last submission of their info hash that
+the worker has seen, so that a result that crossed a newer submission on the way is not taken for the newer job's.
+Should a worker die, the jobs pending on it are failed, and its info hashes go to the next worker alive instead. Should
+a worker fall behind, the submissions to it are dropped once MAX_WRITE_BUFFER bytes are waiting to be sent to it.
+"""
+import asyncio
+import logging
+import multiprocessing
+import pickle
+import signal
+import socket
+import time
+import typing
+
+from . import fetch
+from . import metrics
+
+InfoHash = bytes
+PeerAddress = typing.Tuple[str, int]
+
+# Operations sent from the main process to the workers.
+OP_FETCH = 0
+OP_CANCEL = 1
+
+# Bytes that might be waiting to be sent to a worker before the submissions to it are dropped.
+MAX_WRITE_BUFFER = 16 * 1024 * 1024
+
+SUBMISSIONS_DROPPED = metrics.counter(
+    "magneticod_fetch_worker_submissions_dropped_total",
+    "Submissions to the fetch workers dropped because the worker did not keep up with them.")
+
+
+async def _recv(reader: asyncio.StreamReader) -> typing.Any:
+    length = int.from_bytes(await reader.readexactly(4), "big")
+    return pickle.loads(await reader.readexactly(length))
+
+
+def _send(writer: asyncio.StreamWriter, obj: typing.Any) -> None:
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    writer.write(len(data).to_bytes(4, "big"))
+    writer.write(data)
+
+
+def _worker_main(sock: socket.socket, inherited: typing.List[socket.socket], max_metadata_size: int,
+                 peer_timeout: typing.Optional[float], peers_per_hash: int) -> None:
+    # Parent's ends of the socket pairs must be closed in the child too, or workers would never see an EOF when the
+    # parent is gone.
+    for s in inherited:
+        s.close()
+    # KeyboardInterrupt is handled by the main process, which then closes our socket.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(_serve(sock, max_metadata_size, peer_timeout, peers_per_hash))
+    finally:
+        loop.close()
+
+
+async def _serve(sock: socket.socket, max_metadata_size: int, peer_timeout: typing.Optional[float],
+                 peers_per_hash: int) -> None:
+    reader, writer = await asyncio.open_unix_connection(sock=sock)
+    # info hash -> sequence number of its last submission
+    sequences = {}  # type: typing.Dict[InfoHash, int]
+    engine = fetch.FetchEngine(max_metadata_size, peer_timeout, peers_per_hash,
+                               lambda job: _send(writer, (sequences.pop(job.info_hash, None), job)))
+    try:
+        while True:
+            op, info_hash, peers, sequence = await _recv(reader)
+            if op == OP_FETCH:
+                sequences[info_hash] = sequence
+                engine.add_peers(info_hash, peers)
+            elif op == OP_CANCEL:
+                sequences.pop(info_hash, None)
+                engine.cancel(info_hash)
+    except asyncio.IncompleteReadError:
+        pass
+    finally:
+        engine.shutdown()
+        writer.close()
+
+
+class FetchWorkerPool:
+    """
+    Pool of worker processes fetching metadata on behalf of (possibly many) SybilNodes of this process.
+
+    Must be created before any event loop or database connection so that the workers do not inherit them.
+    """
+    def __init__(self, n_workers: int, max_metadata_size: int, peer_timeout: typing.Optional[float],
+                 peers_per_hash: int) -> None:
+        self.__processes = []  # type: typing.List[multiprocessing.Process]
+        self.__socks = []  # type: typing.List[socket.socket]
+        self.__writers = []  # type: typing.List[asyncio.StreamWriter]
+        self.__reader_tasks = []  # type: typing.List[asyncio.Task]
+        self.__alive = [True] * n_workers
+        # info hash -> engines that have submitted it; only the first one is notified of its result, so that the same
+        # metadata is not committed twice when multiple nodes of this process come across the same info hash.
+        self.__owners = {}  # type: typing.Dict[InfoHash, typing.List[RemoteFetchEngine]]
+        # info hash -> sequence number of its last submission
+        self.__sequences = {}  # type: typing.Dict[InfoHash, int]
+        self.__last_sequence = 0
+
+        for _ in range(n_workers):
+            parent_sock, child_sock = socket.socketpair()
+            self.__socks.append(parent_sock)
+            process = multiprocessing.Process(
+                target=_worker_main,
+                args=(child_sock, list(self.__socks), max_metadata_size, peer_timeout, peers_per_hash),
+                daemon=True
+            )
+            process.start()
+            child_sock.close()
+            self.__processes.append(process)
+
+        logging.info("%d fetch worker processes are started.", n_workers)
+
+    async def start(self) -> None:
+        event_loop = asyncio.get_event_loop()
+        for i, sock in enumerate(self.__socks):
+            reader, writer = await asyncio.open_unix_connection(sock=sock)
+            self.__writers.append(writer)
+            self.__reader_tasks.append(event_loop.create_task(self.__read_results(i, reader)))
+
+    def submit(self, engine: "RemoteFetchEngine", info_hash: InfoHash, peers: typing.List[PeerAddress]) -> bool:
+        """ Returns False if the submission is dropped because its worker is falling behind. """
+        worker = self.__worker_of(info_hash)
+        # _send() never waits for the worker to read, so that the buffer would grow without bounds if it stalled.
+        if worker is not None and self.__writers[worker].transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            SUBMISSIONS_DROPPED.inc()
+            return False
+
+        owners = self.__owners.setdefault(info_hash, [])
+        if engine not in owners:
+            owners.append(engine)
+        if worker is None:
+            # Not from within the call, which might be in the middle of the engine's own bookkeeping.
+            asyncio.get_event_loop().call_soon(self.__fail, info_hash)
+            return True
+        self.__last_sequence += 1
+        self.__sequences[info_hash] = self.__last_sequence
+        _send(self.__writers[worker], (OP_FETCH, info_hash, peers, self.__last_sequence))
+        return True
+
+    def cancel(self, engine: "RemoteFetchEngine", info_hash: InfoHash) -> None:
+        owners = self.__owners.get(info_hash, [])
+        if engine in owners:
+            owners.remove(engine)
+        if owners:
+            return
+        self.__owners.pop(info_hash, None)
+        self.__sequences.pop(info_hash, None)
+        self.__send_cancel(info_hash)
+
+    def __worker_of(self, info_hash: InfoHash) -> typing.Optional[int]:
+        """ Returns the worker the jobs of `info_hash` go to, or None if all of them are dead. """
+        for n in range(len(self.__alive)):
+            worker = (info_hash[0] + n) % len(self.__alive)
+            if self.__alive[worker]:
+                return worker
+        return None
+
+    def __send_cancel(self, info_hash: InfoHash) -> None:
+        worker = self.__worker_of(info_hash)
+        if worker is not None:
+            _send(self.__writers[worker], (OP_CANCEL, info_hash, None, None))
+
+    def __deliver(self, job: fetch.FetchJob) -> None:
+        self.__sequences.pop(job.info_hash, None)
+        owners = self.__owners.pop(job.info_hash, [])
+        for i, owner in enumerate(owners):
+            owner.on_result(job, notify=(i == 0))
+
+    def __fail(self, info_hash: InfoHash) -> None:
+        if info_hash not in self.__owners:
+            return
+        job = fetch.FetchJob(info_hash)
+        job.state = fetch.FAILED
+        job.finished_on = time.monotonic()
+        self.__deliver(job)
+
+    async def __read_results(self, worker: int, reader: asyncio.StreamReader) -> None:
+        while True:
+            try:
+                sequence, job = await _recv(reader)  # type: typing.Optional[int], fetch.FetchJob
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logging.critical("A fetch worker process has died! Its jobs are failed, and go to the others from now "
+                                 "on.")
+                pending = [info_hash for info_hash in self.__owners if self.__worker_of(info_hash) == worker]
+                self.__alive[worker] = False
+                for info_hash in pending:
+                    self.__fail(info_hash)
+                return
+
+            last_sequence = self.__sequences.get(job.info_hash)
+            if last_sequence is None:
+                # Cancelled meanwhile.
+                continue
+            if sequence != last_sequence:
+                # The result of an earlier job, which has finished before a newer submission reached the worker. A
+                # failure is left for the newer job to settle; a success settles it instead.
+                if job.state != fetch.SUCCEEDED:
+                    continue
+                self.__send_cancel(job.info_hash)
+            self.__deliver(job)
+
+    async def close(self) -> None:
+        for task in self.__reader_tasks:
+            task.cancel()
+        for writer in self.__writers:
+            writer.close()
+        for process in self.__processes:
+            await asyncio.get_event_loop().run_in_executor(None, process.join)
+
+
+class RemoteFetchEngine:
+    """
+    FetchEngine look-alike (for a single SybilNode) that forwards the jobs to a FetchWorkerPool.
+    """
+    def __init__(self, pool: FetchWorkerPool, on_done: typing.Callable[[fetch.FetchJob], None]) -> None:
+        self.__pool = pool
+        self.__on_done = on_done
+        # info hash -> number of peers submitted so far
+        self.__submitted = {}  # type: typing.Dict[InfoHash, int]
+
+    def __len__(self) -> int:
+        return len(self.__submitted)
+
+    def __contains__(self, info_hash: InfoHash) -> bool:
+        return info_hash in self.__submitted
+
+    def peers_of(self, info_hash: InfoHash) -> int:
+        # An upper bound too, see below.
+        return self.__submitted.get(info_hash, 0)
+
+    @property
+    def n_active(self) -> int:
+        # An upper bound, since workers do not report peers that have failed before the whole job.
+        return sum(self.__submitted.values())
+
+    def add_peer(self, info_hash: InfoHash, peer_addr: PeerAddress) -> bool:
+        return self.add_peers(info_hash, [peer_addr])
+
+    def add_peers(self, info_hash: InfoHash, peers: typing.List[PeerAddress]) -> bool:
+        if not self.__pool.submit(self, info_hash, peers):
+            return False
+        self.__submitted[info_hash] = self.__submitted.get(info_hash, 0) + len(peers)
+        return True
+
+    def cancel(self, info_hash: InfoHash) -> None:
+        if self.__submitted.pop(info_hash, None) is not None:
+            self.__pool.cancel(self, info_hash)
+
+    def shutdown(self) -> None:
+        for info_hash in list(self.__submitted):
+            self.cancel(info_hash)
+
+    def on_result(self, job: fetch.FetchJob, notify: bool = True) -> None:
+        if self.__submitted.pop(job.info_hash, None) is not None and notify:
+            self.__on_done(job)
@@ -29,13 +29,19 @@ def run_setup():
         author="Mert Bora ALPER",
         author_email="bora@boramalper.org",
         license="GNU Affero General Public License v3 or later (AGPLv3+)",
-        packages=find_packages(),
+        packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
         zip_safe=False,
         entry_points={
             "console_scripts": ["magneticod=magneticod.__main__:main"]
         },
 
         install_requires=install_requirements,
+        extras_require={
+            # zstd (instead of zlib) compression of the raw metadata (--raw-metadata zstd)
+            "zstd": ["zstandard"],
+            # Parquet output of `magneticod export --format parquet`
+            "parquet": ["pyarrow"],
+        },
 
         classifiers=[
             "Development Status :: 2 - Pre-Alpha",